@@ -0,0 +1,100 @@
+"""Scope comment tree per post
+
+Revision ID: 153d3bce5033
+Revises: 1f7fa73ff197
+Create Date: 2026-10-18 10:12:31.402918
+
+"""
+
+from collections import defaultdict
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "153d3bce5033"
+down_revision: Union[str, None] = "1f7fa73ff197"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+comments = sa.table(
+    "comments",
+    sa.column("id", sa.Integer),
+    sa.column("post_id", sa.Integer),
+    sa.column("parent_id", sa.Integer),
+    sa.column("lft", sa.Integer),
+    sa.column("rgt", sa.Integer),
+    sa.column("level", sa.Integer),
+)
+
+
+def renumber(rows, start=1):
+    """Rebuild lft/rgt/level of one post's comments from parent_id."""
+    ids = {row.id for row in rows}
+    children = defaultdict(list)
+    for row in rows:
+        children[row.parent_id if row.parent_id in ids else None].append(row.id)
+
+    numbering = {}
+    counter = start
+    stack = [(comment_id, 0, False) for comment_id in reversed(children[None])]
+    while stack:
+        comment_id, level, leaving = stack.pop()
+        if leaving:
+            numbering[comment_id]["_rgt"] = counter
+        else:
+            numbering[comment_id] = {
+                "_id": comment_id,
+                "_lft": counter,
+                "_level": level,
+            }
+            stack.append((comment_id, level, True))
+            stack.extend(
+                (child_id, level + 1, False)
+                for child_id in reversed(children[comment_id])
+            )
+        counter += 1
+
+    return list(numbering.values()), counter
+
+
+def apply(per_post_start) -> None:
+    connection = op.get_bind()
+    rows = connection.execute(
+        sa.select(comments.c.id, comments.c.post_id, comments.c.parent_id).order_by(
+            comments.c.post_id, comments.c.lft
+        )
+    ).all()
+
+    posts = defaultdict(list)
+    for row in rows:
+        posts[row.post_id].append(row)
+
+    params = []
+    start = 1
+    for post_rows in posts.values():
+        numbering, next_start = renumber(post_rows, 1 if per_post_start else start)
+        params.extend(numbering)
+        start = next_start
+
+    if params:
+        connection.execute(
+            sa.update(comments)
+            .where(comments.c.id == sa.bindparam("_id"))
+            .values(
+                lft=sa.bindparam("_lft"),
+                rgt=sa.bindparam("_rgt"),
+                level=sa.bindparam("_level"),
+            ),
+            params,
+        )
+
+
+def upgrade() -> None:
+    apply(per_post_start=True)
+
+
+def downgrade() -> None:
+    apply(per_post_start=False)
@@ -0,0 +1,177 @@
+"""Add materialized path and closure table comment storages
+
+Revision ID: 3036617ab97f
+Revises: 153d3bce5033
+Create Date: 2026-10-18 11:47:05.118342
+
+"""
+
+from collections import defaultdict
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3036617ab97f"
+down_revision: Union[str, None] = "153d3bce5033"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+PATH_STEP_WIDTH = 10
+
+comments = sa.table(
+    "comments",
+    sa.column("id", sa.Integer),
+    sa.column("post_id", sa.Integer),
+    sa.column("parent_id", sa.Integer),
+    sa.column("lft", sa.Integer),
+    sa.column("rgt", sa.Integer),
+    sa.column("level", sa.Integer),
+    sa.column("path", sa.String),
+)
+comment_closure = sa.table(
+    "comment_closure",
+    sa.column("ancestor_id", sa.Integer),
+    sa.column("descendant_id", sa.Integer),
+    sa.column("depth", sa.Integer),
+)
+
+
+def walk_posts(order_by):
+    """Depth-first walk over every post's comments, built from parent_id.
+
+    Yields (post_id, comment_id, ancestor_ids, leaving).
+    """
+    rows = (
+        op.get_bind()
+        .execute(
+            sa.select(comments.c.id, comments.c.post_id, comments.c.parent_id).order_by(
+                comments.c.post_id, order_by
+            )
+        )
+        .all()
+    )
+    posts = defaultdict(list)
+    for row in rows:
+        posts[row.post_id].append(row)
+
+    for post_id, post_rows in posts.items():
+        ids = {row.id for row in post_rows}
+        children = defaultdict(list)
+        for row in post_rows:
+            children[row.parent_id if row.parent_id in ids else None].append(row.id)
+
+        ancestors = []
+        stack = [(comment_id, False) for comment_id in reversed(children[None])]
+        while stack:
+            comment_id, leaving = stack.pop()
+            if leaving:
+                ancestors.pop()
+                yield post_id, comment_id, ancestors, True
+            else:
+                yield post_id, comment_id, ancestors, False
+                ancestors.append(comment_id)
+                stack.append((comment_id, True))
+                stack.extend(
+                    (child_id, False) for child_id in reversed(children[comment_id])
+                )
+
+
+def upgrade() -> None:
+    op.alter_column("comments", "lft", existing_type=sa.Integer(), nullable=True)
+    op.alter_column("comments", "rgt", existing_type=sa.Integer(), nullable=True)
+    op.add_column("comments", sa.Column("path", sa.String(), nullable=True))
+    op.create_index(
+        "ix_comments_path",
+        "comments",
+        ["path"],
+        unique=False,
+        postgresql_ops={"path": "varchar_pattern_ops"},
+    )
+    op.create_table(
+        "comment_closure",
+        sa.Column("ancestor_id", sa.Integer(), nullable=False),
+        sa.Column("descendant_id", sa.Integer(), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["ancestor_id"], ["comments.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["descendant_id"], ["comments.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("ancestor_id", "descendant_id"),
+    )
+    op.create_index(
+        op.f("ix_comment_closure_descendant_id"),
+        "comment_closure",
+        ["descendant_id"],
+        unique=False,
+    )
+
+    paths = []
+    pairs = []
+    for _, comment_id, ancestors, leaving in walk_posts(comments.c.lft):
+        if leaving:
+            continue
+        steps = [*ancestors, comment_id]
+        paths.append(
+            {
+                "_id": comment_id,
+                "_path": "".join(f"{step:0{PATH_STEP_WIDTH}d}/" for step in steps),
+            }
+        )
+        pairs.extend(
+            {
+                "ancestor_id": ancestor_id,
+                "descendant_id": comment_id,
+                "depth": len(steps) - 1 - index,
+            }
+            for index, ancestor_id in enumerate(steps)
+        )
+
+    if paths:
+        op.get_bind().execute(
+            sa.update(comments)
+            .where(comments.c.id == sa.bindparam("_id"))
+            .values(path=sa.bindparam("_path")),
+            paths,
+        )
+        op.get_bind().execute(sa.insert(comment_closure), pairs)
+
+
+def downgrade() -> None:
+    numbering = {}
+    counter = 1
+    previous_post_id = None
+    for post_id, comment_id, ancestors, leaving in walk_posts(comments.c.id):
+        if post_id != previous_post_id:
+            counter = 1
+            previous_post_id = post_id
+        if leaving:
+            numbering[comment_id]["_rgt"] = counter
+        else:
+            numbering[comment_id] = {
+                "_id": comment_id,
+                "_lft": counter,
+                "_level": len(ancestors),
+            }
+        counter += 1
+
+    if numbering:
+        op.get_bind().execute(
+            sa.update(comments)
+            .where(comments.c.id == sa.bindparam("_id"))
+            .values(
+                lft=sa.bindparam("_lft"),
+                rgt=sa.bindparam("_rgt"),
+                level=sa.bindparam("_level"),
+            ),
+            list(numbering.values()),
+        )
+
+    op.drop_index(
+        op.f("ix_comment_closure_descendant_id"), table_name="comment_closure"
+    )
+    op.drop_table("comment_closure")
+    op.drop_index("ix_comments_path", table_name="comments")
+    op.drop_column("comments", "path")
+    op.alter_column("comments", "rgt", existing_type=sa.Integer(), nullable=False)
+    op.alter_column("comments", "lft", existing_type=sa.Integer(), nullable=False)
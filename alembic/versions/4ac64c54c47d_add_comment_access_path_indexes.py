@@ -0,0 +1,60 @@
+"""Add comment and post access path indexes
+
+Revision ID: 4ac64c54c47d
+Revises: 3036617ab97f
+Create Date: 2026-10-18 13:20:44.571093
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4ac64c54c47d"
+down_revision: Union[str, None] = "3036617ab97f"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# (name, table, columns, partial index predicate)
+INDEXES = [
+    ("ix_comments_post_id_lft", "comments", ["post_id", "lft"], None),
+    ("ix_comments_post_id_rgt", "comments", ["post_id", "rgt"], None),
+    ("ix_comments_parent_id_rgt", "comments", ["parent_id", "rgt"], None),
+    ("ix_comments_post_id_roots", "comments", ["post_id", "id"], "parent_id IS NULL"),
+    (
+        "ix_comments_created_at_is_blocked",
+        "comments",
+        ["created_at", "is_blocked"],
+        None,
+    ),
+    ("ix_posts_user_id", "posts", ["user_id"], None),
+]
+
+
+def upgrade() -> None:
+    # Built concurrently so that writes to the tables are not blocked.
+    with op.get_context().autocommit_block():
+        for name, table, columns, where in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_where=sa.text(where) if where else None,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _, _ in reversed(INDEXES):
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
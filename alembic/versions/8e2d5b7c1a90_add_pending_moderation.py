@@ -0,0 +1,37 @@
+"""Add pending moderation flags to posts and comments
+
+Revision ID: 8e2d5b7c1a90
+Revises: 4ac64c54c47d
+Create Date: 2026-10-18 15:02:37.204118
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8e2d5b7c1a90"
+down_revision: Union[str, None] = "4ac64c54c47d"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    for table in ("posts", "comments"):
+        op.add_column(
+            table,
+            sa.Column(
+                "pending_moderation",
+                sa.Boolean(),
+                nullable=False,
+                server_default=sa.false(),
+            ),
+        )
+
+
+def downgrade() -> None:
+    for table in ("comments", "posts"):
+        op.drop_column(table, "pending_moderation")
@@ -0,0 +1,42 @@
+"""Add stored toxicity scores and re-moderation checkpoints
+
+Revision ID: b41f0c9d27e3
+Revises: 8e2d5b7c1a90
+Create Date: 2026-10-18 16:11:52.480913
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b41f0c9d27e3"
+down_revision: Union[str, None] = "8e2d5b7c1a90"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    for table in ("posts", "comments"):
+        op.add_column(table, sa.Column("toxicity_score", sa.Float(), nullable=True))
+    op.create_table(
+        "moderation_checkpoints",
+        sa.Column("table_name", sa.String(length=64), nullable=False),
+        sa.Column("last_id", sa.Integer(), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("(CURRENT_TIMESTAMP)"),
+            nullable=True,
+        ),
+        sa.PrimaryKeyConstraint("table_name"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("moderation_checkpoints")
+    for table in ("comments", "posts"):
+        op.drop_column(table, "toxicity_score")
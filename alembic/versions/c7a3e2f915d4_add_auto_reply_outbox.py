@@ -0,0 +1,47 @@
+"""Add the auto-reply outbox
+
+Revision ID: c7a3e2f915d4
+Revises: b41f0c9d27e3
+Create Date: 2026-10-18 18:42:07.316254
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "c7a3e2f915d4"
+down_revision: Union[str, None] = "b41f0c9d27e3"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "auto_reply_outbox",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("parent_id", sa.Integer(), nullable=False),
+        sa.Column("author_id", sa.Integer(), nullable=False),
+        sa.Column("due_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("relayed_at", sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(["post_id"], ["posts.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["parent_id"], ["comments.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["author_id"], ["user.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_auto_reply_outbox_relayed_at"),
+        "auto_reply_outbox",
+        ["relayed_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(
+        op.f("ix_auto_reply_outbox_relayed_at"), table_name="auto_reply_outbox"
+    )
+    op.drop_table("auto_reply_outbox")
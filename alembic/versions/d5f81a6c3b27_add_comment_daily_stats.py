@@ -0,0 +1,39 @@
+"""Add the comment_daily_stats rollup
+
+Revision ID: d5f81a6c3b27
+Revises: c7a3e2f915d4
+Create Date: 2026-10-18 20:03:41.582077
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "d5f81a6c3b27"
+down_revision: Union[str, None] = "c7a3e2f915d4"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "comment_daily_stats",
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("total_comments", sa.Integer(), nullable=False),
+        sa.Column("blocked_comments", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("day"),
+    )
+    op.execute("""
+        INSERT INTO comment_daily_stats (day, total_comments, blocked_comments)
+        SELECT date(created_at AT TIME ZONE 'UTC'), count(id),
+            count(id) FILTER (WHERE is_blocked)
+        FROM comments
+        GROUP BY date(created_at AT TIME ZONE 'UTC')
+        """)
+
+
+def downgrade() -> None:
+    op.drop_table("comment_daily_stats")
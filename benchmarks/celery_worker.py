@@ -0,0 +1,115 @@
+"""
+Tasks per second of a Celery worker process running moderation tasks with
+an event loop and the echoing engine per task, as async_to_sync did,
+against one long-lived loop with a pool of its own (src.services.worker).
+
+Usage:
+    python -m benchmarks.celery_worker [--tasks 500] [--url URL]
+
+Tasks are run in this process, without a broker, and score with the
+offline lexicon backend so that only the worker overhead is measured.
+Without --url a throwaway SQLite database is used; point it at a scratch
+Postgres database to include connection setup.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from asgiref.sync import async_to_sync
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import settings
+from database.database import Base, SessionLocal
+from src.post.comment.schemas import CommentImport
+from src.post.comment.utils import comment_tree_import
+from src.post.models import Post
+from src.services.celery_app import moderate_comment, moderate_comment_async
+from src.services.worker import setup_worker_process, shutdown_worker_process
+from src.user.models import User
+
+
+async def create_comments(url: str, count: int) -> list[int]:
+    engine = create_async_engine(url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    SessionLocal.configure(bind=engine)
+    async with SessionLocal() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        db.add(Post(id=1, title="Worker", content="Worker", user_id=1))
+        await db.flush()
+        ids = await comment_tree_import(
+            db,
+            1,
+            [
+                CommentImport(id=index, content=f"Comment {index}")
+                for index in range(count)
+            ],
+            1,
+        )
+        await db.commit()
+    await engine.dispose()
+    return list(ids.values())
+
+
+def per_task_loop(url: str, comment_ids: list[int]) -> float:
+    engine = create_async_engine(url, echo=True)
+    SessionLocal.configure(bind=engine)
+    # Statements are still logged, to nowhere.
+    handlers = (
+        logging.getLogger("sqlalchemy.engine.Engine").handlers
+        + logging.getLogger().handlers
+    )
+    with open(os.devnull, "w") as devnull:
+        streams = [handler.setStream(devnull) for handler in handlers]
+        started = time.perf_counter()
+        for comment_id in comment_ids:
+            async_to_sync(moderate_comment_async)(comment_id)
+        elapsed = time.perf_counter() - started
+        for handler, stream in zip(handlers, streams):
+            handler.setStream(stream)
+    async_to_sync(engine.dispose)()
+    return elapsed
+
+
+def worker_process_loop(url: str, comment_ids: list[int]) -> float:
+    setup_worker_process(url)
+    started = time.perf_counter()
+    for comment_id in comment_ids:
+        moderate_comment(comment_id)
+    elapsed = time.perf_counter() - started
+    shutdown_worker_process()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=500)
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    logging.getLogger("src.services.text_toxicity_analysis").setLevel(logging.WARNING)
+    settings.TOXICITY_BACKEND = "lexicon"
+    settings.TOXICITY_FALLBACK_BACKEND = ""
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    comment_ids = asyncio.run(create_comments(url, args.tasks))
+
+    print(f"{'worker':>20} {'tasks':>6} {'seconds':>8} {'tasks/s':>8}")
+    for name, run in [
+        ("loop per task", per_task_loop),
+        ("loop per process", worker_process_loop),
+    ]:
+        elapsed = run(url, comment_ids)
+        print(
+            f"{name:>20} {args.tasks:>6} {elapsed:>8.2f} {args.tasks / elapsed:>8.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
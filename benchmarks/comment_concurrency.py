@@ -0,0 +1,131 @@
+"""
+Throughput of simultaneous replies and the integrity of the trees they
+leave behind.
+
+Usage:
+    python -m benchmarks.comment_concurrency [--replies 500] [--posts 4]
+        [--connections 20] [--url URL]
+
+Replies are spread over `--posts` posts, so writes to one post queue on its
+lock while the other posts proceed. Without --url a throwaway SQLite
+database is used, which serializes all writers; point it at a scratch
+Postgres database, with `--connections` pooled connections, to see posts
+written in parallel. Exits with 1 when a tree is corrupted.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from database.database import Base
+from src.post.comment.models import Comment
+from src.post.comment.utils import comment_children_create, comment_root_create
+from src.post.models import Post
+from src.user.models import User
+
+
+def tree_errors(comments: list[Comment]) -> list[str]:
+    """Check the lft/rgt of one post's comments against their parent_id."""
+    errors = []
+    bounds = sorted(
+        value for comment in comments for value in (comment.lft, comment.rgt)
+    )
+    if len(set(bounds)) != len(bounds):
+        errors.append("duplicate lft/rgt values")
+
+    open_comments = []
+    for comment in sorted(comments, key=lambda comment: comment.lft):
+        while open_comments and open_comments[-1].rgt < comment.lft:
+            open_comments.pop()
+        parent = open_comments[-1] if open_comments else None
+        if comment.parent_id != (parent.id if parent else None):
+            errors.append(f"comment {comment.id} is not inside its parent")
+        if parent is not None and comment.rgt > parent.rgt:
+            errors.append(f"comment {comment.id} overlaps comment {parent.id}")
+        open_comments.append(comment)
+    return errors
+
+
+async def reply(session_maker, post_id: int, parent_id: int):
+    async with session_maker() as db:
+        new_comment = await comment_children_create(
+            db, post_id, parent_id, "Reply", 1, False
+        )
+        db.add(new_comment)
+        await db.commit()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replies", type=int, default=500)
+    parser.add_argument("--posts", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=20)
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    settings.COMMENT_TREE_STORAGE = "nested_set"
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    if url.startswith("sqlite"):
+        # Writers wait for SQLite's database lock instead of failing.
+        options = {"connect_args": {"timeout": 60}}
+    else:
+        options = {"pool_size": args.connections, "max_overflow": 0}
+    engine = create_async_engine(url, **options)
+    session_maker = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    parents = {}
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        for post_id in range(1, args.posts + 1):
+            db.add(Post(id=post_id, title="Busy", content="Busy", user_id=1))
+        await db.flush()
+        for post_id in range(1, args.posts + 1):
+            roots = [
+                await comment_root_create(db, post_id, "Root", 1, False)
+                for _ in range(5)
+            ]
+            await db.flush()
+            parents[post_id] = [root.id for root in roots]
+        await db.commit()
+
+    tasks = []
+    for _ in range(args.replies):
+        post_id = random.randint(1, args.posts)
+        tasks.append(reply(session_maker, post_id, random.choice(parents[post_id])))
+
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    print(f"{args.replies} replies in {elapsed:.2f}s: {args.replies / elapsed:.1f}/s")
+
+    failed = False
+    async with session_maker() as db:
+        for post_id in parents:
+            result = await db.execute(select(Comment).where(Comment.post_id == post_id))
+            errors = tree_errors(result.scalars().all())
+            failed = failed or bool(errors)
+            print(f"post {post_id}: {'; '.join(errors[:5]) or 'tree intact'}")
+
+    await engine.dispose()
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,97 @@
+"""
+Peak memory of exporting a post's comments as a stream compared with
+building the nested comment tree, for growing threads.
+
+Usage:
+    python -m benchmarks.comment_export [--sizes 10000 50000 200000] [--url URL]
+
+Without --url a throwaway SQLite database is used; point it at a scratch
+Postgres database to measure the production setup.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from src.post.comment.schemas import CommentImport
+from src.post.comment.utils import comment_tree_import
+from src.post.crud import get_comments_export, get_comments_tree
+from src.post.models import Post
+from src.user.models import User
+
+
+async def measure(coroutine_function):
+    tracemalloc.start()
+    started = time.perf_counter()
+    await coroutine_function()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 200000])
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    engine = create_async_engine(url)
+    session_maker = sessionmaker(bind=engine, class_=AsyncSession)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        await db.commit()
+
+    print(
+        f"{'comments':>9} {'export s':>9} {'export MiB':>11} {'tree s':>7} {'tree MiB':>9}"
+    )
+    for post_id, size in enumerate(args.sizes, start=1):
+        comments = [
+            CommentImport(
+                id=index,
+                parent_id=index - 1 if index % 10 else None,
+                content=f"Comment {index}",
+            )
+            for index in range(size)
+        ]
+        async with session_maker() as db:
+            db.add(Post(id=post_id, title="Export", content="Export", user_id=1))
+            await db.flush()
+            await comment_tree_import(db, post_id, comments, 1)
+            await db.commit()
+
+        async def export():
+            lines = await get_comments_export(session_maker(), post_id)
+            async for _ in lines:
+                pass
+
+        async def tree():
+            async with session_maker() as db:
+                await get_comments_tree(db, post_id)
+
+        export_time, export_peak = await measure(export)
+        tree_time, tree_peak = await measure(tree)
+        print(
+            f"{size:>9} {export_time:>9.2f} {export_peak:>11.1f} "
+            f"{tree_time:>7.2f} {tree_peak:>9.1f}"
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
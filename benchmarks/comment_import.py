@@ -0,0 +1,86 @@
+"""
+Bulk import time of growing comment trees with every COMMENT_TREE_STORAGE,
+to check that it stays linear in the number of comments.
+
+Usage:
+    python -m benchmarks.comment_import [--sizes 1000 10000 100000] [--url URL]
+
+Without --url a throwaway SQLite database is used. SQLite cannot return
+the ids of a batch in insert order, so there rows are inserted one at a
+time; point it at a scratch Postgres database to measure the batched
+inserts of the production setup.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from database.database import Base
+from src.post.comment.schemas import CommentImport
+from src.post.comment.storage import TREE_STORAGES
+from src.post.comment.utils import comment_tree_import
+from src.post.models import Post
+from src.user.models import User
+
+
+def random_tree(size: int) -> list[CommentImport]:
+    """Threads of up to 50 comments replying to a random earlier one."""
+    comments = []
+    for index in range(size):
+        parent_id = None
+        if index % 50:
+            parent_id = random.randint(index - index % 50, index - 1)
+        comments.append(
+            CommentImport(id=index, parent_id=parent_id, content=f"Comment {index}")
+        )
+    return comments
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    engine = create_async_engine(url)
+    session_maker = sessionmaker(bind=engine, class_=AsyncSession)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        await db.commit()
+
+    print(f"{'storage':>18} {'comments':>9} {'seconds':>8} {'comments/s':>11}")
+    post_id = 0
+    for storage in TREE_STORAGES:
+        settings.COMMENT_TREE_STORAGE = storage
+        for size in args.sizes:
+            post_id += 1
+            comments = random_tree(size)
+            async with session_maker() as db:
+                db.add(Post(id=post_id, title=storage, content=storage, user_id=1))
+                await db.commit()
+
+                started = time.perf_counter()
+                await comment_tree_import(db, post_id, comments, 1)
+                await db.commit()
+                elapsed = time.perf_counter() - started
+            print(f"{storage:>18} {size:>9} {elapsed:>8.2f} {size / elapsed:>11.0f}")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,164 @@
+"""
+EXPLAIN plans and timings of the comment queries without and with the
+access path indexes.
+
+Usage:
+    python -m benchmarks.comment_indexes --url URL [--comments 1000000]
+        [--output plans.txt]
+
+URL must point to a scratch Postgres database: its tables are dropped and
+seeded with `--comments` comments, 100 per post, in threads of one root
+comment and nine replies.
+"""
+
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from database.database import Base
+from src.post.comment.models import Comment
+from src.post.models import Post
+from src.user.models import User  # noqa: F401, registers the user table
+
+COMMENTS_PER_POST = 100
+INDEXES = [
+    index
+    for table in (Comment.__table__, Post.__table__)
+    for index in table.indexes
+    if index.name
+    in {
+        "ix_comments_post_id_lft",
+        "ix_comments_post_id_rgt",
+        "ix_comments_parent_id_rgt",
+        "ix_comments_post_id_roots",
+        "ix_comments_created_at_is_blocked",
+        "ix_posts_user_id",
+    }
+]
+
+SEED = [
+    """
+    INSERT INTO "user" (id, email, hashed_password, is_active, is_superuser,
+                        is_verified, auto_reply_enabled)
+    VALUES (1, 'bench@example.com', 'x', true, false, false, false)
+    """,
+    """
+    INSERT INTO posts (id, title, content, user_id, is_blocked)
+    SELECT p, 'Post ' || p, 'Content', 1, false
+    FROM generate_series(1, :posts) AS p
+    """,
+    """
+    INSERT INTO comments (id, post_id, content, user_id, is_blocked, parent_id,
+                          lft, rgt, level, created_at)
+    SELECT n + 1,
+           n / 100 + 1,
+           'Comment ' || n,
+           1,
+           n % 7 = 0,
+           CASE WHEN n % 10 = 0 THEN NULL ELSE n - n % 10 + 1 END,
+           (n % 100) / 10 * 20 + CASE WHEN n % 10 = 0 THEN 1 ELSE 2 * (n % 10) END,
+           (n % 100) / 10 * 20
+               + CASE WHEN n % 10 = 0 THEN 20 ELSE 2 * (n % 10) + 1 END,
+           CASE WHEN n % 10 = 0 THEN 0 ELSE 1 END,
+           now() - (n % 730) * interval '1 day'
+    FROM generate_series(0, :comments - 1) AS n
+    """,
+    "SELECT setval('comments_id_seq', :comments)",
+    "SELECT setval('posts_id_seq', :posts)",
+]
+
+QUERIES = {
+    "comment tree": "SELECT * FROM comments WHERE post_id = :post_id ORDER BY lft",
+    "thread page": """
+        SELECT id FROM comments
+        WHERE post_id = :post_id AND parent_id IS NULL AND id > 0
+        ORDER BY id LIMIT 20
+    """,
+    "replies": "SELECT * FROM comments WHERE parent_id = :parent_id",
+    "max rgt": "SELECT max(rgt) FROM comments WHERE post_id = :post_id",
+    "shift": """
+        UPDATE comments SET lft = lft + 2
+        WHERE post_id = :post_id AND lft > :lft
+    """,
+    "subtree delete": """
+        DELETE FROM comments
+        WHERE post_id = :post_id AND lft >= :lft AND rgt <= :rgt
+    """,
+    "daily breakdown": """
+        SELECT date(created_at), count(id),
+               count(is_blocked) FILTER (WHERE is_blocked)
+        FROM comments
+        WHERE created_at >= now() - interval '30 days' AND created_at < now()
+        GROUP BY date(created_at) ORDER BY date(created_at)
+    """,
+}
+
+
+async def explain_all(engine, params) -> list[str]:
+    report = []
+    for name, query in QUERIES.items():
+        async with engine.connect() as conn:
+            started = time.perf_counter()
+            result = await conn.execute(
+                text(f"EXPLAIN (ANALYZE, BUFFERS) {query}"), params
+            )
+            elapsed = time.perf_counter() - started
+            await conn.rollback()
+        report.append(f"--- {name}: {elapsed * 1000:.2f} ms")
+        report.extend(row[0] for row in result)
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", required=True)
+    parser.add_argument("--comments", type=int, default=1_000_000)
+    parser.add_argument("--output")
+    args = parser.parse_args()
+
+    posts = max(args.comments // COMMENTS_PER_POST, 1)
+    post_id = posts // 2 + 1
+    params = {
+        "post_id": post_id,
+        "parent_id": (post_id - 1) * COMMENTS_PER_POST + 1,
+        "lft": 40,
+        "rgt": 60,
+    }
+
+    engine = create_async_engine(args.url)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+        for index in INDEXES:
+            await conn.execute(text(f"DROP INDEX {index.name}"))
+        for statement in SEED:
+            await conn.execute(
+                text(statement), {"posts": posts, "comments": args.comments}
+            )
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE"))
+
+    report = ["===== without access path indexes"]
+    report += await explain_all(engine, params)
+
+    async with engine.begin() as conn:
+        for index in INDEXES:
+            await conn.run_sync(index.create)
+        await conn.execute(text("ANALYZE"))
+
+    report += ["", "===== with access path indexes"]
+    report += await explain_all(engine, params)
+    await engine.dispose()
+
+    output = "\n".join(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    print(output)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
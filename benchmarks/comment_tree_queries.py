@@ -0,0 +1,98 @@
+"""
+Query count and timing of GET /post/{post_id}/comments as the tree grows.
+
+Usage:
+    python -m benchmarks.comment_tree_queries
+"""
+
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from database.database import Base
+from src.post.comment.models import Comment
+from src.post.crud import get_comments_tree
+from src.post.models import Post
+from src.user.models import User
+
+TREE_SIZES = [10, 100, 1_000, 10_000]
+
+
+def random_tree(size: int, post_id: int, first_id: int) -> list[dict]:
+    """Build nested-set rows for a random tree with `size` comments."""
+    children = {None: []}
+    for comment_id in range(first_id, first_id + size):
+        parent_id = random.choice(list(children)) if children[None] else None
+        children[parent_id].append(comment_id)
+        children[comment_id] = []
+
+    rows = []
+    counter = 0
+
+    def visit(comment_id, parent_id, level):
+        nonlocal counter
+        counter += 1
+        row = {
+            "id": comment_id,
+            "post_id": post_id,
+            "parent_id": parent_id,
+            "content": f"Comment {comment_id}",
+            "user_id": 1,
+            "lft": counter,
+            "level": level,
+        }
+        rows.append(row)
+        for child_id in children[comment_id]:
+            visit(child_id, comment_id, level + 1)
+        counter += 1
+        row["rgt"] = counter
+
+    for root_id in children[None]:
+        visit(root_id, None, 0)
+    return rows
+
+
+async def main():
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_maker = sessionmaker(bind=engine, class_=AsyncSession)
+
+    statements = []
+    event.listen(
+        engine.sync_engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        await db.commit()
+
+        print(f"{'comments':>10} {'queries':>8} {'seconds':>9}")
+        first_id = 1
+        for post_id, size in enumerate(TREE_SIZES, start=1):
+            db.add(Post(id=post_id, title="Bench", content="Bench", user_id=1))
+            await db.execute(insert(Comment), random_tree(size, post_id, first_id))
+            await db.commit()
+
+            statements.clear()
+            started = time.perf_counter()
+            await get_comments_tree(db, post_id)
+            elapsed = time.perf_counter() - started
+            print(f"{size:>10} {len(statements):>8} {elapsed:>9.4f}")
+            first_id += size
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,110 @@
+"""
+Insert, read and delete throughput of every COMMENT_TREE_STORAGE.
+
+Usage:
+    python -m benchmarks.comment_tree_storage [--comments 2000] [--url URL]
+
+Without --url a throwaway SQLite database is used; point it at a scratch
+Postgres database to measure the production setup.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from database.database import Base
+from src.post.comment.models import Comment
+from src.post.comment.storage import TREE_STORAGES
+from src.post.comment.utils import (
+    comment_children_create,
+    comment_root_create,
+    comment_subtree_delete,
+)
+from src.post.crud import get_comments_tree
+from src.post.models import Post
+from src.user.models import User
+
+
+async def run(session_maker, storage: str, post_id: int, comments: int):
+    settings.COMMENT_TREE_STORAGE = storage
+    timings = {}
+
+    async with session_maker() as db:
+        db.add(Post(id=post_id, title=storage, content=storage, user_id=1))
+        await db.commit()
+
+        comment_ids = []
+        started = time.perf_counter()
+        for _ in range(comments):
+            if comment_ids and random.random() < 0.8:
+                new_comment = await comment_children_create(
+                    db, post_id, random.choice(comment_ids), "Reply", 1, False
+                )
+            else:
+                new_comment = await comment_root_create(db, post_id, "Root", 1, False)
+            db.add(new_comment)
+            await db.commit()
+            comment_ids.append(new_comment.id)
+        timings["insert"] = comments / (time.perf_counter() - started)
+
+        started = time.perf_counter()
+        for _ in range(10):
+            await get_comments_tree(db, post_id)
+        timings["read"] = 10 / (time.perf_counter() - started)
+
+        deletes = 0
+        started = time.perf_counter()
+        for comment_id in random.sample(comment_ids, comments // 10):
+            comment = await db.scalar(select(Comment).where(Comment.id == comment_id))
+            if comment is None:
+                continue
+            await comment_subtree_delete(db, comment)
+            await db.commit()
+            deletes += 1
+        timings["delete"] = deletes / (time.perf_counter() - started)
+
+    return timings
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--comments", type=int, default=2000)
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    engine = create_async_engine(url)
+    session_maker = sessionmaker(
+        bind=engine, class_=AsyncSession, expire_on_commit=False
+    )
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        await db.commit()
+
+    print(f"{'storage':>18} {'inserts/s':>10} {'reads/s':>10} {'deletes/s':>10}")
+    for post_id, storage in enumerate(TREE_STORAGES, start=1):
+        timings = await run(session_maker, storage, post_id, args.comments)
+        print(
+            f"{storage:>18} {timings['insert']:>10.1f} "
+            f"{timings['read']:>10.1f} {timings['delete']:>10.1f}"
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,71 @@
+"""
+Auto-replies generated per second by the rule engine, against the regular
+expressions it replaced, for comments of growing length and for many
+distinct post authors.
+
+Usage:
+    python -m benchmarks.generate_response [--lengths 100 10000 100000]
+        [--authors 1 1000 100000] [--messages 2000]
+"""
+
+import argparse
+import random
+import re
+import time
+
+from src.services.generate_response import generate_response
+
+WORDS = "the a post comment this that really nice idea thanks about think".split()
+
+
+def legacy_generate_response(message, author_name):
+    """The reply as computed before the rule engine."""
+    if (
+        re.search(r"\?", message)
+        or re.search(r"\b(what|when|how|why|who|where)\b", message, re.IGNORECASE)
+    ) and re.search(rf"\b{re.escape(author_name)}\b", message, re.IGNORECASE):
+        return "I saw your question and will get back to you as soon as I can."
+    return "Thank you for your comment!"
+
+
+def comment(length: int, author_name: str) -> str:
+    words = []
+    while sum(map(len, words)) + len(words) < length:
+        words.append(random.choice(WORDS))
+    words.insert(random.randrange(len(words) + 1), author_name)
+    return " ".join(words) + random.choice(".?")
+
+
+def rate(function, messages) -> float:
+    started = time.perf_counter()
+    for message, author_name in messages:
+        function(message, author_name)
+    return len(messages) / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--authors", type=int, nargs="+", default=[1, 1000, 100000])
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'length':>7} {'authors':>8} {'legacy/s':>9} {'rules/s':>9}")
+    for length in args.lengths:
+        for authors in args.authors:
+            # Long comments are slow to generate and score, keep their count down.
+            count = max(20, min(args.messages, args.messages * 100 // length))
+            names = [f"user{index}@example.com" for index in range(authors)]
+            messages = []
+            for _ in range(count):
+                author_name = random.choice(names)
+                messages.append((comment(length, author_name), author_name))
+            print(
+                f"{length:>7} {authors:>8} "
+                f"{rate(legacy_generate_response, messages):>9.0f} "
+                f"{rate(generate_response, messages):>9.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
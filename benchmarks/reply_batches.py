@@ -0,0 +1,124 @@
+"""
+Auto-replies written per second to one busy post, one transaction per
+reply as the former reply_comment task did, against the batches of
+flush_due_replies.
+
+Usage:
+    python -m benchmarks.reply_batches [--replies 2000] [--comments 2000]
+        [--batch-sizes 1 10 100 500] [--url URL]
+
+Every run replies to random comments of a post that already has
+`--comments` comments, so that each pass over the tree has rows to
+shift. Without --url a throwaway SQLite database is used.
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from config import settings
+from database.database import Base
+from src.post.comment.schemas import CommentImport
+from src.post.comment.utils import (
+    comment_children_create,
+    comment_replies_create,
+    comment_tree_import,
+)
+from src.post.models import Post
+from src.user.models import User
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replies", type=int, default=2000)
+    parser.add_argument("--comments", type=int, default=2000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 100, 500])
+    parser.add_argument("--url")
+    args = parser.parse_args()
+
+    settings.COMMENT_TREE_STORAGE = "nested_set"
+    settings.COMMENT_TREE_GAP = 0
+    url = args.url or (
+        f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'benchmark.db')}"
+    )
+    engine = create_async_engine(url)
+    session_maker = sessionmaker(bind=engine, class_=AsyncSession)
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+    async with session_maker() as db:
+        db.add(User(id=1, email="bench@example.com", hashed_password="x"))
+        await db.commit()
+
+    async def create_post(post_id: int) -> list[int]:
+        async with session_maker() as db:
+            db.add(Post(id=post_id, title="Busy", content="Busy", user_id=1))
+            await db.flush()
+            ids = await comment_tree_import(
+                db,
+                post_id,
+                [
+                    CommentImport(id=index, content=f"Comment {index}")
+                    for index in range(args.comments)
+                ],
+                1,
+            )
+            await db.commit()
+        return list(ids.values())
+
+    print(f"{'writer':>18} {'replies':>8} {'seconds':>8} {'replies/s':>10}")
+    post_id = 1
+    parents = await create_post(post_id)
+    started = time.perf_counter()
+    for _ in range(args.replies):
+        async with session_maker() as db:
+            db.add(
+                await comment_children_create(
+                    db, post_id, random.choice(parents), "Reply", 1, False
+                )
+            )
+            await db.commit()
+    elapsed = time.perf_counter() - started
+    print(
+        f"{'per reply':>18} {args.replies:>8} {elapsed:>8.2f} {args.replies / elapsed:>10.0f}"
+    )
+
+    for batch_size in args.batch_sizes:
+        post_id += 1
+        parents = await create_post(post_id)
+        started = time.perf_counter()
+        for offset in range(0, args.replies, batch_size):
+            count = min(batch_size, args.replies - offset)
+            async with session_maker() as db:
+                await comment_replies_create(
+                    db,
+                    post_id,
+                    [
+                        {
+                            "parent_id": random.choice(parents),
+                            "content": "Reply",
+                            "user_id": 1,
+                            "is_blocked": False,
+                        }
+                        for _ in range(count)
+                    ],
+                )
+                await db.commit()
+        elapsed = time.perf_counter() - started
+        name = f"batches of {batch_size}"
+        print(
+            f"{name:>18} {args.replies:>8} {elapsed:>8.2f} {args.replies / elapsed:>10.0f}"
+        )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
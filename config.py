@@ -8,6 +8,26 @@ class Settings(BaseSettings):
     app_name: str = "PostCommentAPI"
     USER_SECRET_KEY: str
     PERSPECTIVE_API_KEY: str
+    PERSPECTIVE_API_URL: str = (
+        "https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze"
+    )
+    PERSPECTIVE_TIMEOUT: float = 5.0
+    PERSPECTIVE_MAX_CONNECTIONS: int = 20
+    PERSPECTIVE_COALESCE_WINDOW: float = 0.005
+    TOXICITY_BACKEND: str = "perspective"
+    TOXICITY_FALLBACK_BACKEND: str = "lexicon"
+    TOXICITY_BREAKER_TIMEOUT: float = 3.0
+    TOXICITY_BREAKER_FAILURES: int = 5
+    TOXICITY_BREAKER_RESET: float = 30.0
+    TOXICITY_CACHE_SIZE: int = 10000
+    TOXICITY_CACHE_TTL: int = 86400
+    TOXICITY_CACHE_REDIS_URL: str = ""
+    TOXICITY_THRESHOLD: float = 0.5
+    BREAKDOWN_CACHE_SIZE: int = 10000
+    BREAKDOWN_CACHE_MEMORY_TTL: int = 60
+    BREAKDOWN_CACHE_REDIS_URL: str = ""
+    MODERATION_MODE: str = "sync"
+    HIDE_UNMODERATED: bool = False
 
     POSTGRES_USER: str
     POSTGRES_PASSWORD: str
@@ -16,6 +36,17 @@ class Settings(BaseSettings):
 
     CELERY_BROKER_URL: str
     CELERY_BACKEND_URL: str
+    WORKER_DB_POOL_SIZE: int = 5
+    WORKER_METRICS_DIR: str = "/tmp/celery-metrics"
+    WORKER_METRICS_PORT: int = 9808
+    REPLY_QUEUE_REDIS_URL: str = ""
+    REPLY_BATCH_SIZE: int = 500
+    REPLY_FLUSH_INTERVAL: float = 1.0
+    REPLY_OUTBOX_REDELIVERY: float = 300.0
+    AUTO_REPLY_RULES_FILE: str = ""
+
+    COMMENT_TREE_STORAGE: str = "nested_set"
+    COMMENT_TREE_GAP: int = 0
 
     @property
     def SQLALCHEMY_DATABASE_URL(self):
@@ -1,10 +1,24 @@
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 
+from src.services import metrics
+from src.services.breakdown_cache import cache as breakdown_cache
+from src.services.text_toxicity_analysis import close_client
 from src.user.routers import router as user_routers
 from src.post.routers import router as post_routers
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await close_client()
+    await breakdown_cache.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.include_router(user_routers)
 app.include_router(post_routers)
@@ -15,5 +29,10 @@ async def root():
     return {"message": "Hello World"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def read_metrics():
+    return metrics.render()
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
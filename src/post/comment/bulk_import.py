@@ -0,0 +1,93 @@
+"""
+Reading comment imports, either a JSON list or NDJSON with one comment per
+line. Files can be imported without going through the API with:
+
+    python -m src.post.comment.bulk_import POST_ID FILE [--user-id USER_ID]
+
+Comments without a user_id are attributed to --user-id, by default the
+author of the post.
+"""
+
+import argparse
+import asyncio
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import select
+
+from database.database import SessionLocal
+from src.post.models import Post
+from .schemas import CommentImport
+from .utils import comment_tree_import
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+comment_import_list = TypeAdapter(list[CommentImport])
+
+
+def parse_comment_import(body: bytes, ndjson: bool) -> list[CommentImport]:
+    """Validate the comments of an import, collecting the errors of all of them."""
+    if not ndjson:
+        try:
+            return comment_import_list.validate_json(body)
+        except ValidationError as error:
+            raise RequestValidationError(
+                [
+                    {**detail, "loc": ("body", *detail["loc"])}
+                    for detail in error.errors()
+                ]
+            )
+
+    comments = []
+    errors = []
+    for index, line in enumerate(body.splitlines()):
+        if not line.strip():
+            continue
+        try:
+            comments.append(CommentImport.model_validate_json(line))
+        except ValidationError as error:
+            errors.extend(
+                {**detail, "loc": ("body", index, *detail["loc"])}
+                for detail in error.errors()
+            )
+    if errors:
+        raise RequestValidationError(errors)
+    return comments
+
+
+async def read_comment_import(request: Request) -> list[CommentImport]:
+    """The comments of an import request, by its content type."""
+    content_type = request.headers.get("content-type", "")
+    return parse_comment_import(
+        await request.body(), content_type.startswith(NDJSON_MEDIA_TYPE)
+    )
+
+
+async def import_file(post_id: int, path: str, user_id: int | None):
+    with open(path, "rb") as file:
+        try:
+            comments = parse_comment_import(file.read(), not path.endswith(".json"))
+        except RequestValidationError as error:
+            raise SystemExit(f"Invalid comments in {path}: {error.errors()}")
+
+    async with SessionLocal() as db:
+        if user_id is None:
+            user_id = await db.scalar(select(Post.user_id).where(Post.id == post_id))
+            if user_id is None:
+                raise SystemExit(f"The post with id {post_id} does not exist")
+        try:
+            ids = await comment_tree_import(db, post_id, comments, user_id)
+        except HTTPException as error:
+            raise SystemExit(error.detail)
+        await db.commit()
+    print(f"Imported {len(ids)} comments into post {post_id}.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("post_id", type=int)
+    parser.add_argument("file", help="a .json list or NDJSON file of comments")
+    parser.add_argument("--user-id", type=int)
+    args = parser.parse_args()
+    asyncio.run(import_file(args.post_id, args.file, args.user_id))
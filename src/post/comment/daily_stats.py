@@ -0,0 +1,249 @@
+"""
+Comments per day, total and blocked, in the comment_daily_stats rollup
+read by /comments-daily-breakdown: a range of days then costs a row per
+day rather than a row per comment.
+
+Comments added, deleted or (un)blocked through the ORM are counted when
+the session flushes. Statements bypassing the ORM report their changes
+themselves, with `count_comments` when they know the rows, or with
+`refresh_comment_daily_stats`, which recounts days from the comments.
+
+The days a transaction changes are dropped from the result cache of
+src.services.breakdown_cache when it commits.
+
+The rollup is rebuilt from the comments with:
+
+    python -m src.post.comment.daily_stats
+"""
+
+import asyncio
+from collections import Counter
+from datetime import date, datetime, time, timedelta, timezone
+
+from sqlalchemy import (
+    Date,
+    delete,
+    event,
+    func,
+    insert,
+    inspect,
+    literal_column,
+    select,
+    true,
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database.database import SessionLocal
+from src.services.breakdown_cache import cache
+from .models import Comment, CommentDailyStats
+from .storage import get_comment_tree_storage
+
+# A change of the rollup: the day, and what to add to its totals.
+Change = tuple[date, int, int]
+
+# Session.info key of the days changed by the transaction, None for all.
+CHANGED_DAYS_KEY = "changed_comment_days"
+
+
+def day_of(created_at: datetime | None) -> date:
+    # New comments without created_at get now() from the database.
+    if created_at is None:
+        created_at = datetime.now(timezone.utc)
+    elif created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date()
+
+
+def comment_day(dialect: str):
+    """The UTC day of a comment, whatever the TimeZone of the session."""
+    created_at = Comment.created_at
+    # SQLite stores the UTC time. The zone is inlined, a bound parameter
+    # would keep Postgres from matching the day in GROUP BY.
+    if dialect == "postgresql":
+        created_at = func.timezone(literal_column("'UTC'"), created_at)
+    return func.date(created_at, type_=Date)
+
+
+def record_changed_days(session: Session | AsyncSession, days: set[date] | None):
+    changed = session.info.get(CHANGED_DAYS_KEY, set())
+    if changed is not None:
+        session.info[CHANGED_DAYS_KEY] = None if days is None else changed | days
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_changed_days(session: Session):
+    """Drop the past days the transaction changed from the result cache."""
+    if CHANGED_DAYS_KEY not in session.info:
+        return
+    days = session.info.pop(CHANGED_DAYS_KEY)
+    # Days are filtered as of the commit, a day that ended while the
+    # transaction ran may have been cached since.
+    today = day_of(None)
+    cache.invalidate(None if days is None else {day for day in days if day < today})
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_changed_days(session: Session):
+    session.info.pop(CHANGED_DAYS_KEY, None)
+
+
+def upsert_daily_counts(dialect: str, changes: list[Change]):
+    """The statement adding the changes to their days, None if they cancel out."""
+    totals: Counter[date] = Counter()
+    blocked: Counter[date] = Counter()
+    for day, total_change, blocked_change in changes:
+        totals[day] += total_change
+        blocked[day] += blocked_change
+    rows = [
+        {"day": day, "total_comments": totals[day], "blocked_comments": blocked[day]}
+        for day in totals
+        if totals[day] or blocked[day]
+    ]
+    if not rows:
+        return None
+
+    dialect_insert = postgresql.insert if dialect == "postgresql" else sqlite.insert
+    statement = dialect_insert(CommentDailyStats).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[CommentDailyStats.day],
+        set_={
+            "total_comments": CommentDailyStats.total_comments
+            + statement.excluded.total_comments,
+            "blocked_comments": CommentDailyStats.blocked_comments
+            + statement.excluded.blocked_comments,
+        },
+    )
+
+
+async def count_comments(db: AsyncSession, changes: list[Change]):
+    statement = upsert_daily_counts(db.get_bind().dialect.name, changes)
+    if statement is not None:
+        record_changed_days(db, {day for day, _, _ in changes})
+        await db.execute(statement)
+
+
+@event.listens_for(Session, "before_flush")
+def count_flushed_comments(session: Session, flush_context, instances):
+    """Count the comments the flush inserts, deletes or (un)blocks."""
+    changes = []
+    # Expired attributes are loaded here, without flushing again.
+    with session.no_autoflush:
+        for comment in session.new:
+            if isinstance(comment, Comment):
+                blocked = int(bool(comment.is_blocked))
+                changes.append((day_of(comment.created_at), 1, blocked))
+        for comment in session.deleted:
+            if isinstance(comment, Comment):
+                blocked = int(bool(comment.is_blocked))
+                changes.append((day_of(comment.created_at), -1, -blocked))
+        for comment in session.dirty:
+            if not isinstance(comment, Comment) or comment in session.deleted:
+                continue
+            history = inspect(comment).attrs.is_blocked.load_history()
+            was_blocked = bool(history.deleted and history.deleted[0])
+            if history.has_changes() and bool(comment.is_blocked) != was_blocked:
+                change = 1 if comment.is_blocked else -1
+                changes.append((day_of(comment.created_at), 0, change))
+
+    statement = upsert_daily_counts(session.get_bind().dialect.name, changes)
+    if statement is not None:
+        record_changed_days(session, {day for day, _, _ in changes})
+        session.connection().execute(statement)
+
+
+async def uncount_subtrees(db: AsyncSession, comment_ids: list[int]):
+    """Take comments and all of their replies off the rollup, before deleting them."""
+    roots = (
+        select(
+            Comment.id,
+            Comment.post_id,
+            Comment.lft,
+            Comment.rgt,
+            Comment.path,
+            Comment.level,
+        )
+        .where(Comment.id.in_(comment_ids))
+        .subquery()
+    )
+    # Subtrees may hold each other, their comments are taken off once.
+    subtrees = (
+        get_comment_tree_storage()
+        .select_subtrees(roots)
+        .with_only_columns(Comment.id)
+        .distinct()
+    )
+    day = comment_day(db.get_bind().dialect.name)
+    result = await db.execute(
+        select(
+            day,
+            func.count(Comment.id),
+            func.count(Comment.id).filter(Comment.is_blocked == true()),
+        )
+        .where(Comment.id.in_(subtrees))
+        .group_by(day)
+    )
+    await count_comments(
+        db, [(day, -total, -blocked) for day, total, blocked in result.all()]
+    )
+
+
+async def refresh_comment_daily_stats(
+    db: AsyncSession, comment_ids: list[int] | None = None
+):
+    """Recount the days of the comments, or every day without comment_ids."""
+    rollup = delete(CommentDailyStats)
+    day = comment_day(db.get_bind().dialect.name)
+    counts = select(
+        day,
+        func.count(Comment.id),
+        func.count(Comment.id).filter(Comment.is_blocked == true()),
+    ).group_by(day)
+
+    if comment_ids is not None:
+        result = await db.execute(
+            select(func.min(Comment.created_at), func.max(Comment.created_at)).where(
+                Comment.id.in_(comment_ids)
+            )
+        )
+        first, last = result.one()
+        if first is None:
+            return
+        first_day, last_day = day_of(first), day_of(last)
+        record_changed_days(
+            db,
+            {
+                first_day + timedelta(days=offset)
+                for offset in range((last_day - first_day).days + 1)
+            },
+        )
+        rollup = rollup.where(CommentDailyStats.day.between(first_day, last_day))
+        midnight = time(tzinfo=timezone.utc)
+        counts = counts.where(
+            Comment.created_at >= datetime.combine(first_day, midnight),
+            Comment.created_at
+            < datetime.combine(last_day + timedelta(days=1), midnight),
+        )
+    else:
+        record_changed_days(db, None)
+
+    await db.execute(rollup)
+    await db.execute(
+        insert(CommentDailyStats).from_select(
+            ["day", "total_comments", "blocked_comments"], counts
+        )
+    )
+
+
+async def rebuild():
+    async with SessionLocal() as db:
+        await refresh_comment_daily_stats(db)
+        await db.commit()
+        days = await db.scalar(select(func.count()).select_from(CommentDailyStats))
+    await cache.close()
+    print(f"Rebuilt the comment statistics of {days} days.")
+
+
+if __name__ == "__main__":
+    asyncio.run(rebuild())
@@ -1,4 +1,18 @@
-from sqlalchemy import Integer, Column, Text, func, ForeignKey, Boolean, DateTime
+from sqlalchemy import (
+    Float,
+    false,
+    Integer,
+    Column,
+    Text,
+    func,
+    ForeignKey,
+    Boolean,
+    Date,
+    DateTime,
+    String,
+    Index,
+    text,
+)
 from sqlalchemy.orm import relationship
 
 from database.database import Base
@@ -17,15 +31,87 @@ class Comment(Base):
     user_id = Column(Integer, ForeignKey("user.id"))
 
     is_blocked = Column(Boolean, default=False)
+    toxicity_score = Column(Float, nullable=True)
+    pending_moderation = Column(
+        Boolean, nullable=False, default=False, server_default=false()
+    )
     parent_id = Column(
         Integer, ForeignKey("comments.id", ondelete="CASCADE"), nullable=True
     )
-    lft = Column(Integer, nullable=False)
-    rgt = Column(Integer, nullable=False)
+    lft = Column(Integer, nullable=True)
+    rgt = Column(Integer, nullable=True)
     level = Column(Integer, nullable=False, default=0)
+    path = Column(String, nullable=True)
 
     parent = relationship(
         "Comment", remote_side=[id], backref="children", cascade="all"
     )
     user = relationship(User, back_populates="comments")
     post = relationship("Post", back_populates="comments")
+
+    __table_args__ = (
+        Index(
+            "ix_comments_path", "path", postgresql_ops={"path": "varchar_pattern_ops"}
+        ),
+        Index("ix_comments_post_id_lft", "post_id", "lft"),
+        Index("ix_comments_post_id_rgt", "post_id", "rgt"),
+        Index("ix_comments_parent_id_rgt", "parent_id", "rgt"),
+        Index(
+            "ix_comments_post_id_roots",
+            "post_id",
+            "id",
+            postgresql_where=text("parent_id IS NULL"),
+            sqlite_where=text("parent_id IS NULL"),
+        ),
+        Index("ix_comments_created_at_is_blocked", "created_at", "is_blocked"),
+    )
+
+
+class CommentClosure(Base):
+    __tablename__ = "comment_closure"
+
+    ancestor_id = Column(
+        Integer, ForeignKey("comments.id", ondelete="CASCADE"), primary_key=True
+    )
+    descendant_id = Column(
+        Integer,
+        ForeignKey("comments.id", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    depth = Column(Integer, nullable=False)
+
+
+class AutoReplyOutbox(Base):
+    """
+    Auto-replies owed to comments, written in the transaction of the comment
+    and relayed to the reply queue by src.services.reply_queue.relay_outbox.
+    """
+
+    __tablename__ = "auto_reply_outbox"
+
+    id = Column(Integer, primary_key=True)
+    post_id = Column(
+        Integer, ForeignKey("posts.id", ondelete="CASCADE"), nullable=False
+    )
+    parent_id = Column(
+        Integer, ForeignKey("comments.id", ondelete="CASCADE"), nullable=False
+    )
+    author_id = Column(Integer, ForeignKey("user.id"), nullable=False)
+    due_at = Column(DateTime(timezone=True), nullable=False)
+    relayed_at = Column(DateTime(timezone=True), nullable=True, index=True)
+
+    parent = relationship(Comment)
+
+
+class CommentDailyStats(Base):
+    """
+    Comments per day of created_at, kept up to date by
+    src.post.comment.daily_stats.
+    """
+
+    __tablename__ = "comment_daily_stats"
+
+    day = Column(Date, primary_key=True)
+    total_comments = Column(Integer, nullable=False, default=0)
+    blocked_comments = Column(Integer, nullable=False, default=0)
@@ -13,6 +13,7 @@ class CommentsRead(CommentBase):
     created_at: datetime
     user_id: int
     is_blocked: bool
+    pending_moderation: bool = False
 
     class Config:
         from_attributes = True
@@ -23,9 +24,11 @@ class CommentTree(BaseModel):
     created_at: datetime
     user_id: int
     content: str
-    lft: int
-    rgt: int
+    lft: int | None
+    rgt: int | None
     children: list["CommentTree"] = []
+    children_count: int = 0
+    has_more: bool = False
 
     class Config:
         from_attributes = True
@@ -38,6 +41,40 @@ class CommentCreate(CommentBase):
         from_attributes = True
 
 
+class CommentImport(CommentBase):
+    id: int | str
+    parent_id: int | str | None = None
+    user_id: int | None = None
+    created_at: datetime | None = None
+    is_blocked: bool = False
+
+
+class CommentExport(BaseModel):
+    id: int
+    parent_id: int | None
+    level: int
+    content: str
+    user_id: int
+    created_at: datetime
+    is_blocked: bool
+
+    class Config:
+        from_attributes = True
+
+
+class CommentImportResult(BaseModel):
+    imported: int
+    ids: dict[str, int]
+
+
+class CommentsDelete(BaseModel):
+    ids: list[int]
+
+
+class CommentsDeleteResult(BaseModel):
+    deleted: list[int]
+
+
 class ReplyComment(BaseModel):
     post_id: int
     parent_id: int
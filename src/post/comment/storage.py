@@ -0,0 +1,558 @@
+"""
+Layouts for keeping a post's comments in tree order.
+
+`parent_id` and `level` are maintained by every layout, so any of them can
+be rebuilt from the others with:
+
+    python -m src.post.comment.storage
+"""
+
+import asyncio
+from collections import defaultdict
+
+from sqlalchemy import select, update, delete, insert, func, literal, and_, or_, case
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database.database import SessionLocal
+from src.post.models import Post
+from .models import Comment, CommentClosure
+
+EXHAUSTED_TREES_KEY = "exhausted_comment_trees"
+PATH_STEP_WIDTH = 10
+
+
+def walk_comment_tree(comments):
+    """Depth-first walk over (id, parent_id) rows given in sibling order.
+
+    Yields (comment_id, ancestor_ids, leaving) once on the way down and
+    once on the way back up.
+    """
+    ids = {comment.id for comment in comments}
+    children = defaultdict(list)
+    for comment in comments:
+        parent_id = comment.parent_id if comment.parent_id in ids else None
+        children[parent_id].append(comment.id)
+
+    ancestors = []
+    stack = [(comment_id, False) for comment_id in reversed(children[None])]
+    while stack:
+        comment_id, leaving = stack.pop()
+        if leaving:
+            ancestors.pop()
+            yield comment_id, ancestors, True
+        else:
+            yield comment_id, ancestors, False
+            ancestors.append(comment_id)
+            stack.append((comment_id, True))
+            stack.extend(
+                (child_id, False) for child_id in reversed(children[comment_id])
+            )
+
+
+async def lock_comment_tree(db: AsyncSession, post_id: int):
+    """Serialize writes to the post's comment tree until the transaction ends.
+
+    Only the post's row is locked, so other posts are written in parallel.
+    SQLite has no row locks; there the row is touched instead, which takes
+    the database write lock.
+    """
+    if db.get_bind().dialect.name == "sqlite":
+        await db.execute(
+            update(Post).where(Post.id == post_id).values(is_blocked=Post.is_blocked)
+        )
+    else:
+        await db.execute(select(Post.id).where(Post.id == post_id).with_for_update())
+
+
+class CommentTreeStorage:
+    """Keeps the position of comments inside their post's tree."""
+
+    name: str
+
+    async def insert(self, db: AsyncSession, comment: Comment, parent: Comment | None):
+        """Place a new comment after the last reply of `parent`."""
+        raise NotImplementedError
+
+    async def insert_many(
+        self, db: AsyncSession, post_id: int, replies: list[tuple[Comment, Comment]]
+    ):
+        """Place new (comment, parent) replies of one post, as `insert` would."""
+        for comment, parent in replies:
+            await self.insert(db, comment, parent)
+            # The next reply may go to the same parent.
+            await db.flush()
+
+    async def delete(self, db: AsyncSession, comment: Comment):
+        """Delete a comment together with all of its replies."""
+        await self.delete_many(db, comment.post_id, [comment])
+
+    async def delete_many(
+        self, db: AsyncSession, post_id: int, comments: list[Comment]
+    ):
+        """Delete comments of one post with all of their replies at once."""
+        raise NotImplementedError
+
+    def order_by(self) -> tuple:
+        """Columns that list a post's comments in tree order."""
+        raise NotImplementedError
+
+    async def rebuild(self, db: AsyncSession, post_id: int):
+        """Recompute the layout of a post from parent_id."""
+        raise NotImplementedError
+
+    def select_subtrees(self, roots):
+        """Select the comments under (and including) the rows of `roots`.
+
+        `roots` is a subquery with the id, post_id, lft, rgt, path and level
+        columns of the comments to start from.
+        """
+        raise NotImplementedError
+
+    async def import_layout(
+        self, db: AsyncSession, post_id: int, comments, ids: dict
+    ) -> dict[int, dict]:
+        """Layout columns of freshly imported comments, by their new id.
+
+        `comments` reference each other by their import ids, `ids` maps
+        those to the inserted rows.
+        """
+        raise NotImplementedError
+
+    async def import_tree(
+        self, db: AsyncSession, post_id: int, comments, moderation: dict | None = None
+    ) -> dict:
+        """Insert a whole tree of new comments after the post's last one.
+
+        `comments` have an import `id`, a `parent_id` among those ids and the
+        content, user_id, created_at and is_blocked of the new rows, whose
+        other moderation columns may be given by import id in `moderation`.
+        They are written with a fixed number of batched statements, however
+        large the tree is.
+        Returns the new id of every import id.
+        """
+        by_id = {comment.id: comment for comment in comments}
+        order = [
+            (comment_id, len(ancestors))
+            for comment_id, ancestors, leaving in walk_comment_tree(comments)
+            if not leaving
+        ]
+        result = await db.execute(
+            insert(Comment).returning(Comment.id, sort_by_parameter_order=True),
+            [
+                {
+                    "post_id": post_id,
+                    "content": by_id[comment_id].content,
+                    "user_id": by_id[comment_id].user_id,
+                    "created_at": by_id[comment_id].created_at,
+                    "is_blocked": by_id[comment_id].is_blocked,
+                    "level": level,
+                    **(moderation or {}).get(comment_id, {}),
+                }
+                for comment_id, level in order
+            ],
+        )
+        ids = dict(zip((comment_id for comment_id, _ in order), result.scalars()))
+
+        layout = await self.import_layout(db, post_id, comments, ids)
+        await db.execute(
+            update(Comment),
+            [
+                {
+                    "id": ids[comment_id],
+                    "parent_id": ids.get(by_id[comment_id].parent_id),
+                    **layout.get(ids[comment_id], {}),
+                }
+                for comment_id, _ in order
+            ],
+        )
+        return ids
+
+    async def get_comments(self, db: AsyncSession, post_id: int):
+        result = await db.execute(
+            select(Comment.id, Comment.parent_id)
+            .where(Comment.post_id == post_id)
+            .order_by(*self.order_by())
+        )
+        return result.all()
+
+
+class NestedSetStorage(CommentTreeStorage):
+    """lft/rgt intervals, optionally with COMMENT_TREE_GAP free values."""
+
+    name = "nested_set"
+
+    def order_by(self) -> tuple:
+        return (Comment.lft,)
+
+    def select_subtrees(self, roots):
+        return select(Comment).join(
+            roots,
+            and_(
+                Comment.post_id == roots.c.post_id,
+                Comment.lft.between(roots.c.lft, roots.c.rgt),
+            ),
+        )
+
+    @staticmethod
+    def comment_width(gap: int) -> int:
+        """Number of lft/rgt values a new comment takes, room for replies included."""
+        return gap + 2
+
+    async def get_max_rgt(self, db: AsyncSession, post_id: int):
+        """We get the maximum rgt within the post's comment tree."""
+        max_rgt_for_post = await db.execute(
+            select(func.max(Comment.rgt)).filter(Comment.post_id == post_id)
+        )
+        return max_rgt_for_post.scalar() or 0
+
+    async def get_max_rgt_for_children(self, db: AsyncSession, parent_id: int):
+        """We get the maximum rgt for child comments."""
+        max_rgt_result = await db.execute(
+            select(func.max(Comment.rgt)).filter(Comment.parent_id == parent_id)
+        )
+        return max_rgt_result.scalar_one_or_none()
+
+    async def shift(self, db: AsyncSession, post_id: int, rgt: int, width: int):
+        """We move the post's comments right of `rgt` to free `width` values."""
+        await db.execute(
+            update(Comment)
+            .where(Comment.post_id == post_id, Comment.lft > rgt)
+            .values(lft=Comment.lft + width)
+        )
+        await db.execute(
+            update(Comment)
+            .where(Comment.post_id == post_id, Comment.rgt >= rgt)
+            .values(rgt=Comment.rgt + width)
+        )
+
+    async def insert(self, db: AsyncSession, comment: Comment, parent: Comment | None):
+        """A reply takes half of the free values after its last sibling.
+
+        Only when none is left is the tree shifted, and with
+        COMMENT_TREE_GAP > 0 the post is then marked for a rebalance.
+        """
+        gap = settings.COMMENT_TREE_GAP
+        width = self.comment_width(gap)
+
+        if parent is None:
+            comment.lft = await self.get_max_rgt(db, comment.post_id) + 1
+            comment.rgt = comment.lft + width - 1
+            db.add(comment)
+            return
+
+        start = parent.rgt - 1
+        if gap:
+            max_rgt = await self.get_max_rgt_for_children(db, parent.id)
+            start = max_rgt if max_rgt is not None else parent.lft
+
+        free = parent.rgt - start - 1
+        if free < 2:
+            await self.shift(db, comment.post_id, parent.rgt, width)
+            free += width
+            if gap:
+                db.info.setdefault(EXHAUSTED_TREES_KEY, set()).add(comment.post_id)
+
+        comment.lft = start + 1
+        comment.rgt = start + min(width, max(2, free // 2))
+        db.add(comment)
+
+    async def insert_many(
+        self, db: AsyncSession, post_id: int, replies: list[tuple[Comment, Comment]]
+    ):
+        """Dense trees make room for all replies with a single UPDATE.
+
+        Every value from a parent's rgt on moves right by the width of the
+        replies inserted at or before it. Gapped trees mostly have free
+        values at hand and insert one by one.
+        """
+        if settings.COMMENT_TREE_GAP:
+            return await super().insert_many(db, post_id, replies)
+
+        by_rgt = defaultdict(list)
+        for comment, parent in replies:
+            by_rgt[parent.rgt].append(comment)
+
+        shifts = []
+        inserted_width = 0
+        for rgt in sorted(by_rgt):
+            for comment in by_rgt[rgt]:
+                comment.lft = rgt + inserted_width
+                comment.rgt = comment.lft + 1
+                inserted_width += 2
+            shifts.append((rgt, inserted_width))
+
+        def shifted(column):
+            return column + case(
+                *((column >= rgt, shift) for rgt, shift in reversed(shifts)), else_=0
+            )
+
+        await db.execute(
+            update(Comment)
+            .where(Comment.post_id == post_id, Comment.rgt >= shifts[0][0])
+            .values(lft=shifted(Comment.lft), rgt=shifted(Comment.rgt))
+        )
+        db.add_all(comment for comment, _ in replies)
+
+    async def delete_many(
+        self, db: AsyncSession, post_id: int, comments: list[Comment]
+    ):
+        """One DELETE for all subtrees, gapped trees keep the holes.
+
+        Dense trees are closed up by a single UPDATE which moves every value
+        left by the width of the subtrees deleted before it.
+        """
+        intervals = []
+        for comment in sorted(comments, key=lambda comment: comment.lft):
+            if intervals and comment.rgt <= intervals[-1][1]:
+                continue
+            intervals.append((comment.lft, comment.rgt))
+
+        await db.execute(
+            delete(Comment).where(
+                Comment.post_id == post_id,
+                or_(*(Comment.lft.between(lft, rgt) for lft, rgt in intervals)),
+            )
+        )
+        if settings.COMMENT_TREE_GAP:
+            return
+
+        shifts = []
+        deleted_width = 0
+        for lft, rgt in intervals:
+            deleted_width += rgt - lft + 1
+            shifts.append((rgt, deleted_width))
+
+        def closed_up(column):
+            return column - case(
+                *((column > rgt, shift) for rgt, shift in reversed(shifts)), else_=0
+            )
+
+        await db.execute(
+            update(Comment)
+            .where(Comment.post_id == post_id, Comment.rgt > intervals[0][1])
+            .values(lft=closed_up(Comment.lft), rgt=closed_up(Comment.rgt))
+        )
+
+    @staticmethod
+    def number_comment_tree(comments, gap: int = 0, start: int = 1) -> list[dict]:
+        """Every comment keeps `gap` free values after its last reply."""
+        numbering = {}
+        counter = start
+        for comment_id, ancestors, leaving in walk_comment_tree(comments):
+            if leaving:
+                counter += gap
+                numbering[comment_id]["rgt"] = counter
+            else:
+                numbering[comment_id] = {
+                    "id": comment_id,
+                    "lft": counter,
+                    "level": len(ancestors),
+                }
+            counter += 1
+        return list(numbering.values())
+
+    async def rebuild(self, db: AsyncSession, post_id: int):
+        comments = await self.get_comments(db, post_id)
+        numbering = self.number_comment_tree(comments, settings.COMMENT_TREE_GAP)
+        if numbering:
+            await db.execute(update(Comment), numbering)
+
+    async def import_layout(
+        self, db: AsyncSession, post_id: int, comments, ids: dict
+    ) -> dict[int, dict]:
+        start = await self.get_max_rgt(db, post_id) + 1
+        numbering = self.number_comment_tree(comments, settings.COMMENT_TREE_GAP, start)
+        return {
+            ids[number["id"]]: {"lft": number["lft"], "rgt": number["rgt"]}
+            for number in numbering
+        }
+
+
+class MaterializedPathStorage(CommentTreeStorage):
+    """Zero-padded ancestor ids in `path`; inserts never touch other rows."""
+
+    name = "materialized_path"
+
+    @staticmethod
+    def path_step(comment_id: int) -> str:
+        return f"{comment_id:0{PATH_STEP_WIDTH}d}/"
+
+    def order_by(self) -> tuple:
+        return (Comment.path,)
+
+    def select_subtrees(self, roots):
+        return select(Comment).join(roots, Comment.path.startswith(roots.c.path))
+
+    async def insert(self, db: AsyncSession, comment: Comment, parent: Comment | None):
+        db.add(comment)
+        await db.flush()
+        comment.path = (parent.path if parent else "") + self.path_step(comment.id)
+
+    async def delete_many(
+        self, db: AsyncSession, post_id: int, comments: list[Comment]
+    ):
+        await db.execute(
+            delete(Comment).where(
+                Comment.post_id == post_id,
+                or_(
+                    *(
+                        Comment.path.startswith(comment.path, autoescape=True)
+                        for comment in comments
+                    )
+                ),
+            )
+        )
+
+    async def rebuild(self, db: AsyncSession, post_id: int):
+        comments = await self.get_comments(db, post_id)
+        paths = [
+            {
+                "id": comment_id,
+                "path": "".join(map(self.path_step, [*ancestors, comment_id])),
+                "level": len(ancestors),
+            }
+            for comment_id, ancestors, leaving in walk_comment_tree(comments)
+            if not leaving
+        ]
+        if paths:
+            await db.execute(update(Comment), paths)
+
+    async def import_layout(
+        self, db: AsyncSession, post_id: int, comments, ids: dict
+    ) -> dict[int, dict]:
+        paths = {}
+        for comment_id, ancestors, leaving in walk_comment_tree(comments):
+            if not leaving:
+                parent_path = paths[ids[ancestors[-1]]] if ancestors else ""
+                paths[ids[comment_id]] = parent_path + self.path_step(ids[comment_id])
+        return {comment_id: {"path": path} for comment_id, path in paths.items()}
+
+
+class ClosureTableStorage(CommentTreeStorage):
+    """Every (ancestor, descendant) pair in `comment_closure`."""
+
+    name = "closure_table"
+
+    def order_by(self) -> tuple:
+        return (Comment.id,)
+
+    def select_subtrees(self, roots):
+        return (
+            select(Comment)
+            .join(CommentClosure, CommentClosure.descendant_id == Comment.id)
+            .join(roots, CommentClosure.ancestor_id == roots.c.id)
+        )
+
+    async def insert(self, db: AsyncSession, comment: Comment, parent: Comment | None):
+        db.add(comment)
+        await db.flush()
+
+        ancestors = select(
+            CommentClosure.ancestor_id,
+            literal(comment.id),
+            CommentClosure.depth + 1,
+        ).where(CommentClosure.descendant_id == comment.parent_id)
+        await db.execute(
+            insert(CommentClosure).from_select(
+                ["ancestor_id", "descendant_id", "depth"], ancestors
+            )
+        )
+        await db.execute(
+            insert(CommentClosure).values(
+                ancestor_id=comment.id, descendant_id=comment.id, depth=0
+            )
+        )
+
+    async def delete_many(
+        self, db: AsyncSession, post_id: int, comments: list[Comment]
+    ):
+        subtree = (
+            select(CommentClosure.descendant_id)
+            .where(CommentClosure.ancestor_id.in_([comment.id for comment in comments]))
+            .scalar_subquery()
+        )
+        await db.execute(delete(Comment).where(Comment.id.in_(subtree)))
+        await db.execute(
+            delete(CommentClosure).where(CommentClosure.descendant_id.in_(subtree))
+        )
+
+    async def rebuild(self, db: AsyncSession, post_id: int):
+        comments = await self.get_comments(db, post_id)
+        await db.execute(
+            delete(CommentClosure).where(
+                CommentClosure.descendant_id.in_([comment.id for comment in comments])
+            )
+        )
+
+        pairs = []
+        levels = []
+        for comment_id, ancestors, leaving in walk_comment_tree(comments):
+            if leaving:
+                continue
+            levels.append({"id": comment_id, "level": len(ancestors)})
+            pairs.extend(self.closure_pairs([*ancestors, comment_id]))
+        if pairs:
+            await db.execute(insert(CommentClosure), pairs)
+            await db.execute(update(Comment), levels)
+
+    @staticmethod
+    def closure_pairs(steps: list[int]) -> list[dict]:
+        """Rows linking the last comment of `steps` to itself and its ancestors."""
+        return [
+            {
+                "ancestor_id": ancestor_id,
+                "descendant_id": steps[-1],
+                "depth": len(steps) - 1 - index,
+            }
+            for index, ancestor_id in enumerate(steps)
+        ]
+
+    async def import_layout(
+        self, db: AsyncSession, post_id: int, comments, ids: dict
+    ) -> dict[int, dict]:
+        pairs = []
+        for comment_id, ancestors, leaving in walk_comment_tree(comments):
+            if not leaving:
+                steps = [ids[step] for step in [*ancestors, comment_id]]
+                pairs.extend(self.closure_pairs(steps))
+        if pairs:
+            await db.execute(insert(CommentClosure), pairs)
+        return {}
+
+
+TREE_STORAGES = {
+    storage.name: storage
+    for storage in (
+        NestedSetStorage(),
+        MaterializedPathStorage(),
+        ClosureTableStorage(),
+    )
+}
+
+
+def get_comment_tree_storage() -> CommentTreeStorage:
+    """The layout selected with COMMENT_TREE_STORAGE."""
+    try:
+        return TREE_STORAGES[settings.COMMENT_TREE_STORAGE]
+    except KeyError:
+        raise ValueError(
+            f"Unknown COMMENT_TREE_STORAGE {settings.COMMENT_TREE_STORAGE!r}, "
+            f"expected one of {', '.join(TREE_STORAGES)}."
+        )
+
+
+async def rebuild_all_comment_trees():
+    """Lay out every post with the configured storage, e.g. after switching it."""
+    storage = get_comment_tree_storage()
+    async with SessionLocal() as db:
+        post_ids = (await db.execute(select(Post.id).order_by(Post.id))).scalars()
+        for post_id in post_ids.all():
+            await lock_comment_tree(db, post_id)
+            await storage.rebuild(db, post_id)
+            await db.commit()
+            print(f"Rebuilt comments of post {post_id} as {storage.name}.")
+
+
+if __name__ == "__main__":
+    asyncio.run(rebuild_all_comment_trees())
@@ -1,15 +1,27 @@
+from collections import defaultdict
+from datetime import datetime, timezone
+
 from fastapi import HTTPException
 from sqlalchemy import select
-from sqlalchemy import update, func
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from .daily_stats import count_comments, day_of, uncount_subtrees
 from .models import Comment
+from .schemas import CommentImport
+from .storage import (
+    EXHAUSTED_TREES_KEY,
+    get_comment_tree_storage,
+    lock_comment_tree,
+    walk_comment_tree,
+)
 
 
 async def get_parent_comment(db: AsyncSession, parent_id: int, post_id: int):
     """Get a parent's comment."""
     parent_result = await db.execute(
-        select(Comment).filter(Comment.id == parent_id, Comment.post_id == post_id)
+        select(Comment)
+        .filter(Comment.id == parent_id, Comment.post_id == post_id)
+        .execution_options(populate_existing=True)
     )
     parent_comment = parent_result.scalar_one_or_none()
     if parent_comment is None:
@@ -20,66 +32,190 @@ async def get_parent_comment(db: AsyncSession, parent_id: int, post_id: int):
     return parent_comment
 
 
-async def get_max_rgt(db: AsyncSession, post_id: int):
-    max_rgt_for_post = await db.execute(
-        select(func.max(Comment.rgt))
-        .filter(Comment.post_id == post_id)
-    )
-    max_rgt_for_post_value = max_rgt_for_post.scalar()
-
-    if max_rgt_for_post_value is None:
-        max_rgt_all_comments = await db.execute(
-            select(func.max(Comment.rgt))
-        )
-        max_rgt = max_rgt_all_comments.scalar() or 0
-    else:
-        max_rgt = max_rgt_for_post_value
-
-    return max_rgt
-
-
-async def get_max_rgt_for_children(db: AsyncSession, parent_id: int):
-    """We get the maximum rgt for child comments."""
-    max_rgt_result = await db.execute(
-        select(func.max(Comment.rgt)).filter(Comment.parent_id == parent_id)
-    )
-    return max_rgt_result.scalar_one_or_none()
+def pop_exhausted_comment_trees(db: AsyncSession) -> set[int]:
+    """Posts whose gaps ran out in this session and need a rebalance."""
+    return db.info.pop(EXHAUSTED_TREES_KEY, set())
 
 
-async def shift_comment_tree(db: AsyncSession, max_rgt: int):
-    """We move all comments with rgt > max_rgt to insert a new comment."""
-    await db.execute(
-        update(Comment)
-        .where(Comment.lft > max_rgt)
-        .values(lft=Comment.lft + 2, rgt=Comment.rgt + 2)
+async def comment_root_create(db: AsyncSession, post_id, content, user_id, is_blocked):
+    """Creating a root comment after the last one of the post."""
+    new_comment = Comment(
+        post_id=post_id,
+        parent_id=None,
+        content=content,
+        user_id=user_id,
+        is_blocked=is_blocked,
+        level=0,
     )
+    await lock_comment_tree(db, post_id)
+    await get_comment_tree_storage().insert(db, new_comment, None)
+    return new_comment
 
 
 async def comment_children_create(
     db: AsyncSession, post_id, parent_id, content, user_id, is_blocked
 ):
     """Creating a child comment."""
+    await lock_comment_tree(db, post_id)
     parent_comment = await get_parent_comment(db, parent_id, post_id)
 
-    max_rgt = await get_max_rgt_for_children(db, parent_comment.id)
-    rgt_to_use = max_rgt if max_rgt is not None else parent_comment.rgt
-
     new_comment = Comment(
         post_id=post_id,
         parent_id=parent_id,
         content=content,
         user_id=user_id,
         is_blocked=is_blocked,
-        lft=rgt_to_use,
-        rgt=rgt_to_use + 1,
         level=parent_comment.level + 1,
     )
+    await get_comment_tree_storage().insert(db, new_comment, parent_comment)
+    return new_comment
 
-    await db.execute(
-        update(Comment).where(Comment.lft > rgt_to_use).values(lft=Comment.lft + 2)
+
+async def comment_replies_create(
+    db: AsyncSession, post_id: int, replies: list[dict]
+) -> list[Comment]:
+    """Creating many replies in one post with one pass over its tree.
+
+    `replies` hold the parent_id, content, user_id and is_blocked of each
+    reply. Replies to comments that are gone are skipped.
+    """
+    await lock_comment_tree(db, post_id)
+    result = await db.execute(
+        select(Comment)
+        .where(
+            Comment.id.in_({reply["parent_id"] for reply in replies}),
+            Comment.post_id == post_id,
+        )
+        .execution_options(populate_existing=True)
     )
-    await db.execute(
-        update(Comment).where(Comment.rgt >= rgt_to_use).values(rgt=Comment.rgt + 2)
+    parents = {comment.id: comment for comment in result.scalars()}
+
+    new_replies = [
+        (
+            Comment(
+                post_id=post_id,
+                level=parents[reply["parent_id"]].level + 1,
+                **reply,
+            ),
+            parents[reply["parent_id"]],
+        )
+        for reply in replies
+        if reply["parent_id"] in parents
+    ]
+    if new_replies:
+        await get_comment_tree_storage().insert_many(db, post_id, new_replies)
+    return [comment for comment, _ in new_replies]
+
+
+async def comment_subtree_delete(db: AsyncSession, comment: Comment):
+    """Deleting a comment with all of its replies."""
+    await lock_comment_tree(db, comment.post_id)
+    # The position may have moved since the comment was loaded.
+    await db.refresh(comment)
+    await uncount_subtrees(db, [comment.id])
+    await get_comment_tree_storage().delete(db, comment)
+
+
+async def comments_delete(db: AsyncSession, comments: list[Comment]) -> list[int]:
+    """Deleting many comments with all of their replies, one pass per post.
+
+    Returns the ids of the comments that were still there to delete.
+    """
+    post_ids = sorted({comment.post_id for comment in comments})
+    for post_id in post_ids:
+        await lock_comment_tree(db, post_id)
+
+    # The positions may have moved, or the comments gone, since they were loaded.
+    result = await db.execute(
+        select(Comment)
+        .where(Comment.id.in_([comment.id for comment in comments]))
+        .execution_options(populate_existing=True)
     )
-
-    return new_comment
+    by_post = defaultdict(list)
+    for comment in result.scalars():
+        by_post[comment.post_id].append(comment)
+
+    storage = get_comment_tree_storage()
+    if by_post:
+        await uncount_subtrees(
+            db,
+            [
+                comment.id
+                for post_comments in by_post.values()
+                for comment in post_comments
+            ],
+        )
+    for post_id, post_comments in by_post.items():
+        await storage.delete_many(db, post_id, post_comments)
+    return [
+        comment.id for post_comments in by_post.values() for comment in post_comments
+    ]
+
+
+async def rebuild_comment_tree(db: AsyncSession, post_id: int):
+    """Recomputing the layout of the post's comments, e.g. to spread out gaps."""
+    await lock_comment_tree(db, post_id)
+    await get_comment_tree_storage().rebuild(db, post_id)
+
+
+async def comment_tree_import(
+    db: AsyncSession,
+    post_id: int,
+    comments: list[CommentImport],
+    user_id: int,
+    moderation: dict | None = None,
+) -> dict:
+    """Importing a whole tree of comments after the post's last one.
+
+    Comments without a user_id are attributed to `user_id`. `moderation`
+    maps import ids to the moderation columns of the comments, replacing
+    their imported is_blocked. Returns the new id of every import id.
+    """
+    ids = {comment.id for comment in comments}
+    if len(ids) != len(comments):
+        raise HTTPException(
+            status_code=400, detail="Comment ids in the import must be unique."
+        )
+    unknown = {comment.parent_id for comment in comments} - ids - {None}
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Parent comments {sorted(map(str, unknown))} are not imported.",
+        )
+    reachable = sum(not leaving for _, _, leaving in walk_comment_tree(comments))
+    if reachable != len(comments):
+        raise HTTPException(
+            status_code=400, detail="Replies in the import form a cycle."
+        )
+    if not comments:
+        return {}
+
+    now = datetime.now(timezone.utc)
+    comments = [
+        comment.model_copy(
+            update={
+                "user_id": comment.user_id or user_id,
+                "created_at": comment.created_at or now,
+            }
+        )
+        for comment in comments
+    ]
+    if moderation is not None:
+        comments = [
+            comment.model_copy(
+                update={"is_blocked": moderation[comment.id]["is_blocked"]}
+            )
+            for comment in comments
+        ]
+    await lock_comment_tree(db, post_id)
+    ids = await get_comment_tree_storage().import_tree(
+        db, post_id, comments, moderation
+    )
+    await count_comments(
+        db,
+        [
+            (day_of(comment.created_at), 1, int(comment.is_blocked))
+            for comment in comments
+        ],
+    )
+    return ids
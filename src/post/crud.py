@@ -1,42 +1,96 @@
 import asyncio
-from datetime import datetime, timedelta
+import time
+from collections.abc import AsyncIterator
+from datetime import datetime, timedelta, timezone
 
 from fastapi import HTTPException
-from sqlalchemy import insert, select, delete, update, func
+from sqlalchemy import and_, insert, not_, select, func, true
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, aliased
 
+from config import settings
 from src.post import models, schemas
-from src.post.comment.models import Comment
+from src.post.comment.models import Comment, CommentDailyStats
 from src.post.comment.schemas import (
     CommentCreate,
     CommentTree,
     DailyCommentBreakdown,
     CommentBase,
+    CommentExport,
+    CommentImport,
+    CommentImportResult,
+    CommentsDeleteResult,
 )
 from src.post.comment.utils import (
     comment_children_create,
-    get_max_rgt,
-    shift_comment_tree,
+    comment_root_create,
+    comment_subtree_delete,
+    comment_tree_import,
+    comments_delete,
+    pop_exhausted_comment_trees,
 )
+from src.post.comment.storage import get_comment_tree_storage
 from src.post.models import Post
-from src.services.celery_app import reply_comment
-from src.services.text_toxicity_analysis import analyze_text_toxicity
+from src.services.celery_app import (
+    moderate_comment,
+    moderate_post,
+    rebalance_comment_tree,
+)
+from src.services.breakdown_cache import cache as breakdown_cache
+from src.services.reply_queue import schedule_reply
+from src.services.text_toxicity_analysis import is_toxic, toxicity_of
 from src.user.models import User
 
+EXPORT_BATCH_SIZE = 1000
+
+
+async def moderate(*texts: str) -> dict:
+    """
+    The moderation columns of a row written with these texts: scored now,
+    or with MODERATION_MODE=deferred left pending for a Celery task.
+    """
+    if settings.MODERATION_MODE == "deferred":
+        return {"toxicity_score": None, "is_blocked": False, "pending_moderation": True}
+
+    toxicity_score = await toxicity_of(*texts)
+    return {
+        "toxicity_score": toxicity_score,
+        "is_blocked": is_toxic(toxicity_score),
+        "pending_moderation": False,
+    }
+
+
+def visible(model):
+    """
+    The rows of `model` readers may see: all of them, or with
+    HIDE_UNMODERATED only those neither blocked nor pending moderation.
+    """
+    if not settings.HIDE_UNMODERATED:
+        return true()
+    return and_(model.is_blocked.is_not(True), model.pending_moderation.is_not(True))
+
+
+def is_visible(row) -> bool:
+    """The same check as `visible` for a loaded post or comment."""
+    return not settings.HIDE_UNMODERATED or not (
+        row.is_blocked or row.pending_moderation
+    )
+
 
 async def get_posts(db: AsyncSession):
-    query = select(models.Post)
+    query = select(models.Post).where(visible(models.Post))
     result = await db.execute(query)
     return result.scalars().all()
 
 
-async def get_post_by_id(db: AsyncSession, post_id: int):
+async def get_post_by_id(db: AsyncSession, post_id: int, visible_only: bool = False):
     query = (
         select(models.Post)
         .options(selectinload(models.Post.comments))
         .where(models.Post.id == post_id)
     )
+    if visible_only:
+        query = query.where(visible(models.Post))
     result = await db.execute(query)
     post = result.unique().scalar_one_or_none()
     if not post:
@@ -47,22 +101,23 @@ async def get_post_by_id(db: AsyncSession, post_id: int):
 
 
 async def post_create(db: AsyncSession, post_data: schemas.PostCreate, user):
-    title_toxicity_score = await analyze_text_toxicity(post_data.title)
-    content_toxicity_score = await analyze_text_toxicity(post_data.content)
-    is_blocked = any([title_toxicity_score > 0.5, content_toxicity_score > 0.5])
+    moderation = await moderate(post_data.title, post_data.content)
 
     query = insert(models.Post).values(
         title=post_data.title,
         content=post_data.content,
         user_id=user.id,
-        is_blocked=is_blocked,
+        **moderation,
     )
 
     result = await db.execute(query.returning(models.Post.id))
     new_post_id = result.scalar()
     await db.commit()
 
-    return {**post_data.model_dump(), "id": new_post_id, "is_blocked": is_blocked}
+    if moderation["pending_moderation"]:
+        moderate_post.delay(new_post_id)
+
+    return {**post_data.model_dump(), **moderation, "id": new_post_id}
 
 
 async def post_update(
@@ -74,16 +129,16 @@ async def post_update(
             status_code=403, detail="Not authorized to perform this action"
         )
 
-    title_toxicity_score = await analyze_text_toxicity(post_data.title)
-    content_toxicity_score = await analyze_text_toxicity(post_data.content)
-    is_blocked = any([title_toxicity_score > 0.5, content_toxicity_score > 0.5])
+    moderation = await moderate(post_data.title, post_data.content)
 
-    for attr, value in post_data.dict().items():
+    for attr, value in {**post_data.dict(), **moderation}.items():
         setattr(db_post, attr, value)
 
-    db_post.is_blocked = is_blocked
     await db.commit()
     await db.refresh(db_post)
+
+    if db_post.pending_moderation:
+        moderate_post.delay(post_id)
     return db_post
 
 
@@ -103,14 +158,16 @@ async def post_delete(db: AsyncSession, post_id: int, user):
 
 async def get_comments_by_post(post_id: int, db: AsyncSession):
     await get_post_by_id(db, post_id)
-    query = select(Comment).where(Comment.post_id == post_id)
+    query = select(Comment).where(Comment.post_id == post_id, visible(Comment))
     result = await db.execute(query)
     return result.scalars().all()
 
 
-async def get_comment_by_comment_id(db: AsyncSession, comment_id: int):
+async def get_comment_by_comment_id(
+    db: AsyncSession, comment_id: int, visible_only: bool = False
+):
     comment = await db.get(Comment, comment_id)
-    if not comment:
+    if not comment or visible_only and not is_visible(comment):
         raise HTTPException(
             status_code=404, detail=f"Comment with id {comment_id} not found."
         )
@@ -118,97 +175,290 @@ async def get_comment_by_comment_id(db: AsyncSession, comment_id: int):
 
 
 async def get_children_comments(db: AsyncSession, parent_id: int) -> list[Comment]:
-    children_query = select(Comment).where(Comment.parent_id == parent_id)
+    children_query = select(Comment).where(
+        Comment.parent_id == parent_id, visible(Comment)
+    )
     children_result = await db.execute(children_query)
     return children_result.scalars().all()
 
 
-async def build_comment_tree(db: AsyncSession, comment: Comment) -> CommentTree:
-    comment_tree = CommentTree(
-        id=comment.id,
-        content=comment.content,
-        created_at=comment.created_at,
-        user_id=comment.user_id,
-        lft=comment.lft,
-        rgt=comment.rgt,
+def build_comment_tree(
+    comments: list[Comment],
+    children_counts: dict[int, int] | None = None,
+    parent_id: int | None = None,
+) -> list[CommentTree]:
+    """Assemble a flat list of comments into nested trees in O(n).
+
+    The replies of `parent_id` become the roots. `children_counts` holds the
+    number of replies of every comment when some of them may have been left
+    out of `comments`; replies whose parent was left out are dropped.
+    """
+    nodes = {
+        comment.id: CommentTree(
+            id=comment.id,
+            content=comment.content,
+            created_at=comment.created_at,
+            user_id=comment.user_id,
+            lft=comment.lft,
+            rgt=comment.rgt,
+        )
+        for comment in comments
+    }
+
+    roots = []
+    for comment in comments:
+        parent = nodes.get(comment.parent_id)
+        if comment.parent_id == parent_id:
+            roots.append(nodes[comment.id])
+        elif parent is not None:
+            parent.children.append(nodes[comment.id])
+
+    for comment_id, node in nodes.items():
+        node.children_count = len(node.children)
+        if children_counts is not None:
+            node.children_count = children_counts[comment_id]
+            node.has_more = node.children_count > len(node.children)
+    return roots
+
+
+async def get_comments_tree(
+    db: AsyncSession,
+    post_id: int,
+    parent_id: int | None = None,
+    max_depth: int | None = None,
+    limit: int | None = None,
+    cursor: int | None = None,
+) -> list[CommentTree]:
+    """
+    Fetch the replies of `parent_id` (root comments of the post by default)
+    together with their replies in a single query.
+
+    Args:
+        max_depth (int | None): How many levels of replies to include below
+            each thread. Cut branches are marked with `has_more`.
+        limit (int | None): The number of threads to return.
+        cursor (int | None): The id of the last thread of the previous page.
+    """
+    # Hidden posts hide their comments, as everywhere else.
+    if settings.HIDE_UNMODERATED:
+        await get_post_by_id(db, post_id, visible_only=True)
+    storage = get_comment_tree_storage()
+
+    if parent_id is None and max_depth is None and limit is None and cursor is None:
+        query = select(Comment).where(Comment.post_id == post_id, visible(Comment))
+        result = await db.execute(query.order_by(*storage.order_by()))
+        return build_comment_tree(result.scalars().all())
+
+    roots = select(
+        Comment.id,
+        Comment.post_id,
+        Comment.lft,
+        Comment.rgt,
+        Comment.path,
+        Comment.level,
+    ).where(
+        Comment.post_id == post_id, Comment.parent_id == parent_id, visible(Comment)
+    )
+    if cursor is not None:
+        roots = roots.where(Comment.id > cursor)
+    roots = roots.order_by(Comment.id).limit(limit).subquery()
+
+    replies = aliased(Comment)
+    children_count = (
+        select(func.count(replies.id))
+        .where(replies.parent_id == Comment.id, visible(replies))
+        .scalar_subquery()
+    )
+    query = (
+        storage.select_subtrees(roots)
+        .add_columns(children_count)
+        .where(visible(Comment))
+    )
+    if max_depth is not None:
+        query = query.where(Comment.level <= roots.c.level + max_depth)
+
+    result = await db.execute(query.order_by(roots.c.id, *storage.order_by()))
+    rows = result.all()
+    return build_comment_tree(
+        [comment for comment, _ in rows],
+        {comment.id: count for comment, count in rows},
+        parent_id,
     )
-    children = await get_children_comments(db, comment.id)
-    comment_tree.children = [await build_comment_tree(db, child) for child in children]
-    return comment_tree
 
 
-async def get_comments_tree(db: AsyncSession, post_id: int) -> list[CommentTree]:
-    root_comments_query = select(Comment).where(
-        Comment.post_id == post_id, Comment.parent_id.is_(None)
+async def get_comments_export(db: AsyncSession, post_id: int) -> AsyncIterator[str]:
+    """
+    Stream every comment of the post as NDJSON lines, in the order of the
+    tree storage: depth-first for nested_set and materialized_path, by id
+    for closure_table. Either way parents come before their replies.
+
+    Rows are fetched from a server-side cursor in batches of
+    EXPORT_BATCH_SIZE, so memory use does not grow with the thread. The
+    returned iterator owns `db` and closes it when done.
+    """
+    await get_post_by_id(db, post_id, visible_only=True)
+    return stream_comments_export(db, post_id)
+
+
+async def stream_comments_export(db: AsyncSession, post_id: int):
+    storage = get_comment_tree_storage()
+    query = (
+        select(
+            Comment.id,
+            Comment.parent_id,
+            Comment.level,
+            Comment.content,
+            Comment.user_id,
+            Comment.created_at,
+            Comment.is_blocked,
+        )
+        .where(Comment.post_id == post_id, visible(Comment))
+        .order_by(*storage.order_by())
+        .execution_options(yield_per=EXPORT_BATCH_SIZE)
     )
-    result = await db.execute(root_comments_query)
-    root_comments = result.scalars().all()
+    if settings.HIDE_UNMODERATED:
+        # Replies of hidden comments are left out with them.
+        hidden = (
+            select(
+                Comment.id,
+                Comment.post_id,
+                Comment.lft,
+                Comment.rgt,
+                Comment.path,
+                Comment.level,
+            )
+            .where(Comment.post_id == post_id, not_(visible(Comment)))
+            .subquery()
+        )
+        query = query.where(
+            Comment.id.not_in(
+                storage.select_subtrees(hidden).with_only_columns(Comment.id)
+            )
+        )
+    try:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            yield "".join(
+                CommentExport.model_validate(row).model_dump_json() + "\n"
+                for row in rows
+            )
+    finally:
+        await db.close()
+
 
-    return await asyncio.gather(
-        *(build_comment_tree(db, comment) for comment in root_comments)
+async def get_post_author_auto_reply(db: AsyncSession, post_id: int):
+    """
+    The auto-reply settings of the post's author, checking in the same
+    query that the post exists. They are all None for posts without an
+    author.
+    """
+    result = await db.execute(
+        select(
+            User.id,
+            User.email,
+            User.auto_reply_enabled,
+            User.auto_reply_delay,
+        )
+        .select_from(models.Post)
+        .outerjoin(User, models.Post.user_id == User.id)
+        .where(models.Post.id == post_id)
     )
+    author = result.one_or_none()
+    if author is None:
+        raise HTTPException(
+            status_code=404, detail=f"The post with id {post_id} does not exist"
+        )
+    return author
 
 
 async def create_comment(
     db: AsyncSession, post_id: int, comment_data: CommentCreate, user
 ):
-    await get_post_by_id(db, post_id)
-
-    toxicity_score = await analyze_text_toxicity(comment_data.content)
-    is_blocked = toxicity_score > 0.5
-
-    result = await db.execute(select(func.count(Comment.id)))
-    comments_count = result.scalar()
-    if comments_count == 0:
-        new_comment = Comment(
-            post_id=post_id,
-            parent_id=comment_data.parent_id,
-            content=comment_data.content,
-            user_id=user.id,
-            is_blocked=is_blocked,
-            lft=1,
-            rgt=2,
-            level=0,
+    author = await get_post_author_auto_reply(db, post_id)
+
+    moderation = await moderate(comment_data.content)
+
+    if comment_data.parent_id is not None:
+        new_comment = await comment_children_create(
+            db,
+            post_id,
+            comment_data.parent_id,
+            comment_data.content,
+            user.id,
+            moderation["is_blocked"],
         )
     else:
-        if comment_data.parent_id is not None:
-            new_comment = await comment_children_create(
-                db,
-                post_id,
-                comment_data.parent_id,
-                comment_data.content,
-                user.id,
-                is_blocked,
-            )
-        else:
-            max_rgt = await get_max_rgt(db, post_id)
-            await shift_comment_tree(db, max_rgt)
-            new_comment = Comment(
-                post_id=post_id,
-                parent_id=comment_data.parent_id,
-                content=comment_data.content,
-                user_id=user.id,
-                is_blocked=is_blocked,
-                lft=max_rgt + 1,
-                rgt=max_rgt + 2,
-                level=0,
-            )
+        new_comment = await comment_root_create(
+            db, post_id, comment_data.content, user.id, moderation["is_blocked"]
+        )
+    new_comment.toxicity_score = moderation["toxicity_score"]
+    new_comment.pending_moderation = moderation["pending_moderation"]
 
     db.add(new_comment)
+    if author.id is not None and author.auto_reply_enabled:
+        delay = author.auto_reply_delay
+        schedule_reply(
+            db,
+            new_comment,
+            author.id,
+            delay=delay.total_seconds() if delay is not None else 0,
+        )
     await db.commit()
     await db.refresh(new_comment)
 
-    user_db = await db.execute(select(User).join(Post).where(Post.id == post_id))
-    author = user_db.scalar_one_or_none()
-    if user.auto_reply_enabled:
-        reply_comment.apply_async(
-            args=[post_id, new_comment.id, author.id, new_comment.content, author.email],
-            countdown=user.auto_reply_delay.total_seconds(),
-        )
+    for exhausted_post_id in pop_exhausted_comment_trees(db):
+        rebalance_comment_tree.delay(exhausted_post_id)
+    if new_comment.pending_moderation:
+        moderate_comment.delay(new_comment.id)
 
     return new_comment
 
 
+async def import_comments(
+    db: AsyncSession, post_id: int, comments: list[CommentImport], user
+) -> CommentImportResult:
+    """
+    Import a tree of comments into the post in one transaction.
+
+    Comments of superusers are taken as they are, the imported `is_blocked`
+    is kept. Those of other users are moderated like created comments: scored
+    PERSPECTIVE_MAX_CONNECTIONS at a time, or with MODERATION_MODE=deferred
+    written pending and queued for moderation. Only superusers may attribute comments to other users.
+    """
+    db_post = await get_post_by_id(db, post_id)
+    if db_post.user_id != user.id and not user.is_superuser:
+        raise HTTPException(
+            status_code=403, detail="Not authorized to perform this action"
+        )
+    moderation = None
+    if not user.is_superuser:
+        comments = [
+            comment.model_copy(update={"user_id": None}) for comment in comments
+        ]
+        # No more texts in flight than Perspective connections, so that none
+        # times out waiting for one and opens the circuit breaker.
+        semaphore = asyncio.Semaphore(settings.PERSPECTIVE_MAX_CONNECTIONS)
+
+        async def moderate_import(comment):
+            async with semaphore:
+                return await moderate(comment.content)
+
+        results = await asyncio.gather(*map(moderate_import, comments))
+        moderation = {comment.id: result for comment, result in zip(comments, results)}
+
+    ids = await comment_tree_import(db, post_id, comments, user.id, moderation)
+    await db.commit()
+
+    for import_id, comment_id in ids.items():
+        if moderation and moderation[import_id]["pending_moderation"]:
+            moderate_comment.delay(comment_id)
+
+    return CommentImportResult(
+        imported=len(ids),
+        ids={str(import_id): comment_id for import_id, comment_id in ids.items()},
+    )
+
+
 async def comment_update(
     db: AsyncSession, comment_data: CommentBase, comment_id: int, user
 ):
@@ -218,14 +468,17 @@ async def comment_update(
             status_code=403, detail="Not authorized to perform this action"
         )
 
-    toxicity_score = await analyze_text_toxicity(comment_data.content)
-    is_blocked = toxicity_score > 0.5
+    moderation = await moderate(comment_data.content)
 
     db_comment.content = comment_data.content
-    db_comment.is_blocked = is_blocked
+    for attr, value in moderation.items():
+        setattr(db_comment, attr, value)
 
     await db.commit()
     await db.refresh(db_comment)
+
+    if db_comment.pending_moderation:
+        moderate_comment.delay(comment_id)
     return db_comment
 
 
@@ -237,29 +490,42 @@ async def delete_comment(db: AsyncSession, comment_id: int, user):
             status_code=403, detail="Not authorized to perform this action"
         )
 
-    min_lft = comment.lft
-    max_rgt = comment.rgt
-    width = max_rgt - min_lft + 1
-
-    await db.execute(
-        delete(Comment).where(Comment.lft >= min_lft, Comment.rgt <= max_rgt)
-    )
-    await db.execute(
-        update(Comment).where(Comment.lft > max_rgt).values(lft=Comment.lft - width)
-    )
-    await db.execute(
-        update(Comment).where(Comment.rgt > max_rgt).values(rgt=Comment.rgt - width)
-    )
+    await comment_subtree_delete(db, comment)
     await db.commit()
 
     return
 
 
+async def delete_comments(
+    db: AsyncSession, comment_ids: list[int], user
+) -> CommentsDeleteResult:
+    """
+    Delete many comments with their replies in one transaction, e.g. for a
+    moderation sweep. Ids that no longer exist are skipped.
+    """
+    result = await db.execute(select(Comment).where(Comment.id.in_(comment_ids)))
+    comments = result.scalars().all()
+
+    if not user.is_superuser and any(
+        comment.user_id != user.id for comment in comments
+    ):
+        raise HTTPException(
+            status_code=403, detail="Not authorized to perform this action"
+        )
+
+    deleted = await comments_delete(db, comments)
+    await db.commit()
+
+    return CommentsDeleteResult(deleted=deleted)
+
+
 async def get_comments_daily_breakdown(
     db: AsyncSession, date_from: str, date_to: str
 ) -> list[DailyCommentBreakdown]:
     """
-    Fetch the daily breakdown of comments, including total and blocked comments.
+    Fetch the daily breakdown of comments, including total and blocked comments,
+    from the comment_daily_stats rollup. Past days come from the result cache
+    when they are in it, ranges longer than the cache bypass it.
 
     Args:
         db (AsyncSession): The database session for executing queries.
@@ -269,35 +535,56 @@ async def get_comments_daily_breakdown(
     Returns:
         List[DailyCommentBreakdown]: A list of daily comment breakdowns.
     """
-    # Convert strings to datetime objects
-    date_from = datetime.strptime(date_from, "%Y-%m-%d")
-    date_to = datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)
-
-    print(f"Fetching comments from {date_from} to {date_to}")
+    date_from = datetime.strptime(date_from, "%Y-%m-%d").date()
+    date_to = datetime.strptime(date_to, "%Y-%m-%d").date()
 
-    query = (
-        select(
-            func.date(Comment.created_at).label("date"),
-            func.count(Comment.id).label("total_comments"),
-            func.count(Comment.is_blocked)
-            .filter(Comment.is_blocked == True)
-            .label("blocked_comments"),
+    today = datetime.now(timezone.utc).date()
+    past = (min(date_to, today - timedelta(days=1)) - date_from).days + 1
+    if past > settings.BREAKDOWN_CACHE_SIZE:
+        past_days, first_day = [], date_from
+    else:
+        past_days = [date_from + timedelta(days=offset) for offset in range(past)]
+        first_day = max(date_from, today)
+    counts, generation = await breakdown_cache.get_many(past_days)
+
+    missing = [day for day in past_days if day not in counts]
+    if missing:
+        first_day = missing[0]
+    if first_day <= date_to:
+        started = time.perf_counter()
+        result = await db.execute(
+            select(
+                CommentDailyStats.day,
+                CommentDailyStats.total_comments,
+                CommentDailyStats.blocked_comments,
+            ).where(
+                CommentDailyStats.day.between(first_day, date_to),
+                CommentDailyStats.total_comments > 0,
+            )
+        )
+        computed = {day: (total, blocked) for day, total, blocked in result.all()}
+        breakdown_cache.record_compute(
+            (min(date_to, today) - first_day).days + 1,
+            time.perf_counter() - started,
+        )
+        # Days without comments are cached too.
+        await breakdown_cache.set_many(
+            {day: computed.get(day, (0, 0)) for day in missing}, generation
+        )
+        counts.update(
+            (day, day_counts)
+            for day, day_counts in computed.items()
+            if day not in counts
         )
-        .where(Comment.created_at >= date_from, Comment.created_at < date_to)
-        .group_by(func.date(Comment.created_at))
-        .order_by(func.date(Comment.created_at))
-    )
-
-    result = await db.execute(query)
-    daily_stats = result.all()
 
     comments = [
         DailyCommentBreakdown(
-            date=str(stat.date),
-            total_comments=stat.total_comments,
-            blocked_comments=stat.blocked_comments,
+            date=str(day),
+            total_comments=total,
+            blocked_comments=blocked,
         )
-        for stat in daily_stats
+        for day, (total, blocked) in sorted(counts.items())
+        if total > 0
     ]
 
     return comments
@@ -1,4 +1,6 @@
 from sqlalchemy import (
+    Float,
+    false,
     Integer,
     Column,
     Text,
@@ -20,10 +22,26 @@ class Post(Base):
     title = Column(String(255), nullable=False)
     content = Column(Text, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    user_id = Column(Integer, ForeignKey("user.id"))
+    user_id = Column(Integer, ForeignKey("user.id"), index=True)
     is_blocked = Column(Boolean, default=False)
+    toxicity_score = Column(Float, nullable=True)
+    pending_moderation = Column(
+        Boolean, nullable=False, default=False, server_default=false()
+    )
 
     user = relationship("User", back_populates="posts")
     comments = relationship(
         "Comment", cascade="all, delete-orphan", back_populates="post"
     )
+
+
+class ModerationCheckpoint(Base):
+    """How far a rescan of a table has got, see src.services.remoderation."""
+
+    __tablename__ = "moderation_checkpoints"
+
+    table_name = Column(String(64), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(
+        DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
+    )
@@ -1,15 +1,21 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Query, Request
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 from database.dependencies import get_db
 from src.post import crud, schemas
+from src.post.comment.bulk_import import NDJSON_MEDIA_TYPE, read_comment_import
 from src.post.comment.schemas import (
     CommentCreate,
     CommentsRead,
     CommentTree,
     DailyCommentBreakdown,
     CommentBase,
+    CommentImport,
+    CommentImportResult,
+    CommentsDelete,
+    CommentsDeleteResult,
 )
 from src.post.crud import get_comments_daily_breakdown
 from src.user import auth
@@ -33,7 +39,7 @@ async def read_posts(db: AsyncSession = Depends(get_db)):
     tags=["Post"],
 )
 async def post_read_by_id(post_id: int, db: AsyncSession = Depends(get_db)):
-    return await crud.get_post_by_id(db, post_id)
+    return await crud.get_post_by_id(db, post_id, visible_only=True)
 
 
 @router.post(
@@ -85,8 +91,66 @@ async def delete_post(
     response_model=list[CommentTree],
     tags=["Comment"],
 )
-async def get_comments_by_post_id(post_id: int, db: AsyncSession = Depends(get_db)):
-    return await crud.get_comments_tree(db, post_id)
+async def get_comments_by_post_id(
+    post_id: int,
+    max_depth: int | None = Query(default=None, ge=0),
+    limit: int | None = Query(default=None, ge=1),
+    cursor: int | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Retrieve the comment threads of a post.
+
+    Args:
+        max_depth (int, optional): Levels of replies to include per thread.
+        limit (int, optional): The number of threads per page.
+        cursor (int, optional): The id of the last thread of the previous page.
+    """
+    return await crud.get_comments_tree(
+        db, post_id, max_depth=max_depth, limit=limit, cursor=cursor
+    )
+
+
+@router.get(
+    "/post/{post_id}/comments/export",
+    response_class=StreamingResponse,
+    tags=["Comment"],
+)
+async def export_comments(post_id: int, db: AsyncSession = Depends(get_db)):
+    """
+    Stream all comments of a post, parents before their replies, one JSON
+    object per line with its `level` and `parent_id`. The lines can be imported again with
+    POST /posts/{post_id}/comments/import.
+    """
+    lines = await crud.get_comments_export(db, post_id)
+    return StreamingResponse(lines, media_type=NDJSON_MEDIA_TYPE)
+
+
+@router.get(
+    "/comments/{comment_id}/tree",
+    response_model=list[CommentTree],
+    tags=["Comment"],
+)
+async def get_comment_replies_tree(
+    comment_id: int,
+    max_depth: int | None = Query(default=None, ge=0),
+    limit: int | None = Query(default=None, ge=1),
+    cursor: int | None = None,
+    db: AsyncSession = Depends(get_db),
+):
+    """
+    Retrieve the replies of a comment as threads, e.g. to load a branch
+    marked with `has_more`. Takes the same parameters as the post's comments.
+    """
+    comment = await crud.get_comment_by_comment_id(db, comment_id, visible_only=True)
+    return await crud.get_comments_tree(
+        db,
+        comment.post_id,
+        parent_id=comment.id,
+        max_depth=max_depth,
+        limit=limit,
+        cursor=cursor,
+    )
 
 
 @router.get(
@@ -97,7 +161,7 @@ async def get_comments_by_post_id(post_id: int, db: AsyncSession = Depends(get_d
 async def get_children_comments_by_parent_id(
     comment_id: int, db: AsyncSession = Depends(get_db)
 ):
-    return await crud.get_comment_by_comment_id(db, comment_id)
+    return await crud.get_comment_by_comment_id(db, comment_id, visible_only=True)
 
 
 @router.get(
@@ -128,6 +192,44 @@ async def comment_create(
     )
 
 
+@router.post(
+    "/posts/{post_id}/comments/import",
+    response_model=CommentImportResult,
+    tags=["Comment"],
+    status_code=status.HTTP_201_CREATED,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "application/json": {
+                    "schema": {
+                        "type": "array",
+                        "items": CommentImport.model_json_schema(),
+                    }
+                },
+                NDJSON_MEDIA_TYPE: {"schema": CommentImport.model_json_schema()},
+            },
+            "required": True,
+        }
+    },
+)
+async def comments_import(
+    post_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(auth.current_user),
+):
+    """
+    Import a whole comment tree, e.g. threads from a legacy system, in one
+    transaction.
+
+    The body is a JSON list of comments, or one comment per line with
+    `Content-Type: application/x-ndjson`. Replies point at their parent by
+    its `id` in the import; the response maps those ids to the new ones.
+    """
+    comments = await read_comment_import(request)
+    return await crud.import_comments(db, post_id, comments, user)
+
+
 @router.patch(
     "/comments/{comment_id}",
     response_model=CommentsRead,
@@ -155,6 +257,23 @@ async def delete_comment(
     return await crud.delete_comment(db=db, comment_id=comment_id, user=user)
 
 
+@router.post(
+    "/comments/bulk-delete",
+    response_model=CommentsDeleteResult,
+    tags=["Comment"],
+)
+async def delete_comments(
+    comments_data: CommentsDelete,
+    db: AsyncSession = Depends(get_db),
+    user: User = Depends(auth.current_user),
+):
+    """
+    Delete many comments with all of their replies in one transaction,
+    renumbering every affected post once.
+    """
+    return await crud.delete_comments(db=db, comment_ids=comments_data.ids, user=user)
+
+
 @router.get(
     "/comments-daily-breakdown",
     response_model=list[DailyCommentBreakdown],
@@ -13,6 +13,7 @@ class PostReadDetail(PostBase):
     created_at: datetime
     user_id: int
     is_blocked: bool
+    pending_moderation: bool = False
 
     class Config:
         from_attributes = True
@@ -26,6 +27,7 @@ class PostCreate(PostBase):
 class PostCreateResponse(PostCreate):
     id: int
     is_blocked: bool
+    pending_moderation: bool = False
 
 
 class PostUpdate(PostBase):
@@ -0,0 +1,171 @@
+"""
+Comment counts of past days for /comments-daily-breakdown, kept until the
+day changes: an in-process LRU in front of an optional Redis hash shared
+by all processes. Today and later days are never cached.
+
+A past day only changes when its comments are deleted, imported or
+re-moderated, src.post.comment.daily_stats then invalidates it once the
+change is committed. Counts read before an invalidation are not stored
+after it, both tiers keep a generation for that. Other processes may
+serve their in-memory copy for up to BREAKDOWN_CACHE_MEMORY_TTL seconds.
+
+Redis errors are logged and treated as misses.
+"""
+
+import asyncio
+import json
+import logging
+from dataclasses import dataclass
+from datetime import date
+
+import redis.asyncio as redis
+from cachetools import TTLCache
+
+from config import settings
+from src.services import metrics
+
+logger = logging.getLogger(__name__)
+
+COUNTS_KEY = "daily_breakdown"
+GENERATION_KEY = "daily_breakdown:generation"
+
+# Stores the day counts only if no invalidation happened since they were read.
+STORE_IF_CURRENT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+# A day's comment counts: total and blocked.
+Counts = tuple[int, int]
+
+
+@dataclass
+class Generation:
+    """The invalidations seen by a read, in memory and in Redis."""
+
+    memory: int
+    redis: int | None = None
+
+
+class DailyBreakdownCache:
+    def __init__(self):
+        self.memory = TTLCache(
+            maxsize=settings.BREAKDOWN_CACHE_SIZE,
+            ttl=settings.BREAKDOWN_CACHE_MEMORY_TTL,
+        )
+        self.redis = None
+        if settings.BREAKDOWN_CACHE_REDIS_URL:
+            self.redis = redis.from_url(settings.BREAKDOWN_CACHE_REDIS_URL)
+            self.store_if_current = self.redis.register_script(STORE_IF_CURRENT)
+        self.generation = 0
+        # Redis invalidations still running, see `invalidate`.
+        self.pending: set[asyncio.Task] = set()
+        # Time spent computing days, to estimate the time saved by hits.
+        self.compute_seconds = 0.0
+        self.computed_days = 0
+
+    async def get_many(self, days: list[date]) -> tuple[dict[date, Counts], Generation]:
+        """
+        The cached counts of the days, and the generation to store the
+        counts of the missing days with.
+        """
+        generation = Generation(self.generation)
+        cached = {day: self.memory[day] for day in days if day in self.memory}
+        metrics.increment("daily_breakdown_cache_memory_hits_total", len(cached))
+
+        missing = [day for day in days if day not in cached]
+        if self.redis is not None and missing:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipeline:
+                    pipeline.get(GENERATION_KEY)
+                    pipeline.hmget(COUNTS_KEY, [day.isoformat() for day in missing])
+                    redis_generation, values = await pipeline.execute()
+                generation.redis = int(redis_generation or 0)
+            except redis.RedisError as error:
+                logger.warning(f"Daily breakdown cache unavailable: {error}")
+                values = []
+            shared = {
+                day: tuple(json.loads(value))
+                for day, value in zip(missing, values)
+                if value is not None
+            }
+            metrics.increment("daily_breakdown_cache_redis_hits_total", len(shared))
+            self.memory.update(shared)
+            cached.update(shared)
+
+        metrics.increment("daily_breakdown_cache_misses_total", len(days) - len(cached))
+        if cached and self.computed_days:
+            metrics.increment(
+                "daily_breakdown_cache_seconds_saved_total",
+                len(cached) * self.compute_seconds / self.computed_days,
+            )
+        return cached, generation
+
+    def record_compute(self, days: int, seconds: float):
+        """Account for `seconds` spent computing `days` days."""
+        self.compute_seconds += seconds
+        self.computed_days += days
+
+    async def set_many(self, counts: dict[date, Counts], generation: Generation):
+        if not counts or generation.memory != self.generation:
+            return
+        self.memory.update(counts)
+        if self.redis is None or generation.redis is None:
+            return
+        args = [generation.redis]
+        for day, day_counts in counts.items():
+            args += [day.isoformat(), json.dumps(day_counts)]
+        try:
+            await self.store_if_current(keys=[COUNTS_KEY, GENERATION_KEY], args=args)
+        except redis.RedisError as error:
+            logger.warning(f"Daily breakdown cache unavailable: {error}")
+
+    def invalidate(self, days: set[date] | None):
+        """
+        Forget the days, or every day for None. Redis forgets them in the
+        background, on the running event loop.
+        """
+        if days is not None and not days:
+            return
+        self.generation += 1
+        if days is None:
+            self.memory.clear()
+        else:
+            for day in days:
+                self.memory.pop(day, None)
+        if self.redis is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            logger.warning("Daily breakdown cache not invalidated in Redis")
+            return
+        task = loop.create_task(self.invalidate_shared(days))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def invalidate_shared(self, days: set[date] | None):
+        try:
+            async with self.redis.pipeline(transaction=True) as pipeline:
+                pipeline.incr(GENERATION_KEY)
+                if days is None:
+                    pipeline.delete(COUNTS_KEY)
+                else:
+                    pipeline.hdel(COUNTS_KEY, *(day.isoformat() for day in days))
+                await pipeline.execute()
+        except redis.RedisError as error:
+            logger.warning(f"Daily breakdown cache unavailable: {error}")
+
+    async def close(self):
+        if self.pending:
+            await asyncio.gather(*self.pending)
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+cache = DailyBreakdownCache()
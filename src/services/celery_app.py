@@ -1,10 +1,39 @@
-from asgiref.sync import async_to_sync
+import time
+
+import httpx
 from celery import Celery, shared_task
+from celery.concurrency import get_implementation
+from celery.concurrency.prefork import TaskPool as PreforkPool
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+    worker_shutdown,
+)
+from sqlalchemy import update
 
 from config import settings
 from database.database import SessionLocal
-from src.post.comment.utils import comment_children_create
-from .generate_response import generate_response
+from src.post.comment.daily_stats import count_comments, day_of
+from src.post.comment.models import Comment
+from src.post.comment.utils import rebuild_comment_tree
+from src.post.models import Post
+from . import reply_queue
+from .remoderation import RESCANNED, rescan
+from .text_toxicity_analysis import is_toxic, score_texts
+from .worker import (
+    serve_metrics,
+    setup_worker_process,
+    shutdown_worker_process,
+    task_timer,
+    worker_loop,
+)
+
+REPLY_QUEUE = "replies"
+MODERATION_QUEUE = "moderation"
 
 celery = Celery(
     "src.services.celery_app",
@@ -13,32 +42,190 @@ celery = Celery(
 )
 
 celery.conf.update(
-    result_expires=3600,
+    # Every task is fire-and-forget, nothing reads their results.
+    task_ignore_result=True,
     task_serializer="json",
     accept_content=["json"],
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
     broker_connection_retry_on_startup=True,
+    # Moderation backlogs must not hold up replies, and the reverse.
+    task_routes={
+        "src.services.celery_app.relay_reply_outbox": {"queue": REPLY_QUEUE},
+        "src.services.celery_app.flush_due_replies": {"queue": REPLY_QUEUE},
+        "src.services.celery_app.rebalance_comment_tree": {"queue": REPLY_QUEUE},
+        "src.services.celery_app.moderate_post": {"queue": MODERATION_QUEUE},
+        "src.services.celery_app.moderate_comment": {"queue": MODERATION_QUEUE},
+        "src.services.celery_app.remoderate": {"queue": MODERATION_QUEUE},
+    },
+    beat_schedule={
+        "relay-reply-outbox": {
+            "task": "src.services.celery_app.relay_reply_outbox",
+            "schedule": settings.REPLY_FLUSH_INTERVAL,
+        },
+        "flush-due-replies": {
+            "task": "src.services.celery_app.flush_due_replies",
+            "schedule": settings.REPLY_FLUSH_INTERVAL,
+        },
+    },
 )
 
 
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    setup_worker_process()
+
+
+@worker_process_shutdown.connect
+def close_worker_process(**kwargs):
+    shutdown_worker_process()
+
+
+def forks_processes(worker) -> bool:
+    """
+    Whether the worker's pool runs tasks in child processes, which set
+    themselves up on worker_process_init. Other pools (solo, threads, ...)
+    run them in the worker process.
+    """
+    return issubclass(get_implementation(worker.pool_cls), PreforkPool)
+
+
+@worker_init.connect
+def init_worker(sender=None, **kwargs):
+    serve_metrics()
+    if not forks_processes(sender):
+        setup_worker_process()
+
+
+@worker_shutdown.connect
+def close_worker(sender=None, **kwargs):
+    if not forks_processes(sender):
+        shutdown_worker_process()
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    """Let the worker measure how long the task waited in its queue."""
+    headers["published_at"] = time.time()
+
+
+@task_prerun.connect
+def start_task_timer(task=None, **kwargs):
+    task_timer.start(task)
+
+
+@task_postrun.connect
+def finish_task_timer(task=None, **kwargs):
+    task_timer.finish(task)
+
+
+@shared_task
+def relay_reply_outbox():
+    """Publish owed auto-replies to the reply queue, see src.services.reply_queue."""
+    worker_loop.run(reply_queue.relay_outbox())
+
+
 @shared_task
-def reply_comment(post_id, parent_id, author_id, content, author_username):
-    async_to_sync(reply_comment_async)(post_id, parent_id, author_id, content, author_username)
+def flush_due_replies():
+    """Write the auto-replies that are due, see src.services.reply_queue."""
+    for post_id in worker_loop.run(reply_queue.flush_due_replies()):
+        rebalance_comment_tree.delay(post_id)
+
 
+@shared_task
+def rebalance_comment_tree(post_id):
+    worker_loop.run(rebalance_comment_tree_async(post_id))
 
-async def reply_comment_async(post_id, parent_id, author_id, content, author_username):
+
+async def rebalance_comment_tree_async(post_id):
+    async with SessionLocal() as db:
+        await rebuild_comment_tree(db, post_id)
+        await db.commit()
+
+
+class FallbackScore(Exception):
+    """Only the fallback backend could score the texts, moderation is retried."""
+
+
+# Retried 30s, 1m, 2m, 4m and 8m later, the last try settles the row even
+# with a fallback score.
+MODERATION_RETRY = dict(
+    bind=True,
+    autoretry_for=(httpx.HTTPError, FallbackScore),
+    retry_backoff=30,
+    retry_jitter=False,
+    max_retries=5,
+)
+
+
+async def moderation_score(*texts: str, final: bool) -> float:
+    toxicity_score, from_backend = await score_texts(*texts)
+    if not from_backend and not final:
+        raise FallbackScore()
+    return toxicity_score
+
+
+@shared_task(**MODERATION_RETRY)
+def moderate_post(self, post_id):
+    final = self.request.retries >= self.max_retries
+    worker_loop.run(moderate_post_async(post_id, final=final))
+
+
+async def moderate_post_async(post_id, final=True):
+    async with SessionLocal() as db:
+        post = await db.get(Post, post_id)
+        if post is None:
+            return
+        toxicity_score = await moderation_score(post.title, post.content, final=final)
+        # Left pending if the post was edited meanwhile, its own task follows.
+        await db.execute(
+            update(Post)
+            .where(
+                Post.id == post_id,
+                Post.title == post.title,
+                Post.content == post.content,
+            )
+            .values(
+                toxicity_score=toxicity_score,
+                is_blocked=is_toxic(toxicity_score),
+                pending_moderation=False,
+            )
+        )
+        await db.commit()
+
+
+@shared_task(**MODERATION_RETRY)
+def moderate_comment(self, comment_id):
+    final = self.request.retries >= self.max_retries
+    worker_loop.run(moderate_comment_async(comment_id, final=final))
+
+
+async def moderate_comment_async(comment_id, final=True):
     async with SessionLocal() as db:
-        content_response = generate_response(content, author_username)
-        new_reply = await comment_children_create(
-            db,
-            post_id,
-            parent_id,
-            content_response,
-            author_id,
-            is_blocked=False,
+        comment = await db.get(Comment, comment_id)
+        if comment is None:
+            return
+        was_blocked = bool(comment.is_blocked)
+        toxicity_score = await moderation_score(comment.content, final=final)
+        is_blocked = is_toxic(toxicity_score)
+        result = await db.execute(
+            update(Comment)
+            .where(Comment.id == comment_id, Comment.content == comment.content)
+            .values(
+                toxicity_score=toxicity_score,
+                is_blocked=is_blocked,
+                pending_moderation=False,
+            )
         )
-        db.add(new_reply)
+        if result.rowcount and is_blocked != was_blocked:
+            await count_comments(
+                db, [(day_of(comment.created_at), 0, 1 if is_blocked else -1)]
+            )
         await db.commit()
-        await db.refresh(new_reply)
+
+
+@shared_task
+def remoderate(tables=None, restart=False):
+    """Rescore existing posts and comments, see src.services.remoderation."""
+    worker_loop.run(rescan(tables or tuple(RESCANNED), restart=restart))
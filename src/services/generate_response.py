@@ -1,13 +1,172 @@
+"""
+Auto-replies chosen by a table of rules, by default:
+
+- a question that mentions the post author gets a promise of an answer,
+- anything else gets a thank-you.
+
+Other rules can be read from the JSON list in AUTO_REPLY_RULES_FILE, see
+`ReplyRule`. Every keyword of every rule is found in a single pass over
+the comment, and the pattern matching an author is compiled once per
+author.
+"""
+
 import re
+from functools import lru_cache
+
+from pydantic import BaseModel, TypeAdapter
+
+from config import settings
+
+QUESTION_WORDS = frozenset({"what", "when", "how", "why", "who", "where"})
+
+QUESTION_PATTERN = re.compile(
+    rf"\b(?:{'|'.join(sorted(QUESTION_WORDS))})\b", re.IGNORECASE
+)
+
+AUTHOR_PATTERN_CACHE_SIZE = 16384
+
+
+class ReplyRule(BaseModel):
+    """
+    A reply and when to send it. Unset conditions match any comment; the
+    first rule whose conditions all hold is used.
+
+    `template` may contain `{author_name}`.
+    """
+
+    keywords: list[str] = []
+    question: bool | None = None
+    addressed_to_author: bool | None = None
+    template: str
+
+
+DEFAULT_RULES = [
+    ReplyRule(
+        question=True,
+        addressed_to_author=True,
+        template="I saw your question and will get back to you as soon as I can.",
+    ),
+    ReplyRule(template="Thank you for your comment!"),
+]
+
+
+def is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def whole_word(keyword: str) -> str:
+    """
+    The pattern of the keyword where it is not part of a longer word. A
+    keyword edge that is not a word character, as in "+1", may touch anything.
+    """
+    # Next to a word character \b is a lookaround for a non-word one, and
+    # unlike lookbehinds keeps the regular expression engine's fast scan.
+    pattern = re.escape(keyword)
+    if is_word_char(keyword[0]):
+        pattern = rf"\b{pattern}"
+    if is_word_char(keyword[-1]):
+        pattern = rf"{pattern}\b"
+    return pattern
+
+
+class KeywordMatcher:
+    """
+    Finds which of many keywords occur as whole words of a text,
+    case-insensitively, in one pass over it.
+
+    The keywords are compiled into a single alternation, longest first,
+    inside a lookahead, so the scan runs in the regular expression engine
+    rather than in Python and tries every position of the text: keywords
+    overlapping each other are all found. Of the keywords starting at the
+    same position the alternation reports the longest, the shorter ones it
+    starts with are looked up in `prefixes`.
+    """
+
+    def __init__(self, keywords):
+        keywords = sorted(
+            {keyword.casefold() for keyword in keywords if keyword},
+            key=len,
+            reverse=True,
+        )
+        # The shorter keywords each keyword starts with as a whole word.
+        known = set(keywords)
+        self.prefixes = {
+            keyword: [
+                keyword[:end]
+                for end in range(1, len(keyword))
+                if keyword[:end] in known
+                and not (is_word_char(keyword[end - 1]) and is_word_char(keyword[end]))
+            ]
+            for keyword in keywords
+        }
+        self.pattern = None
+        if keywords:
+            alternation = "|".join(map(whole_word, keywords))
+            self.pattern = re.compile(rf"(?=({alternation}))", re.IGNORECASE)
+
+    def find(self, text: str) -> set[str]:
+        found = set()
+        if self.pattern is None:
+            return found
+        for match in self.pattern.findall(text):
+            keyword = match.casefold()
+            found.add(keyword)
+            found.update(self.prefixes.get(keyword, ()))
+        return found
+
+
+@lru_cache(maxsize=AUTHOR_PATTERN_CACHE_SIZE)
+def author_pattern(author_name: str) -> re.Pattern:
+    return re.compile(rf"\b{re.escape(author_name)}\b", re.IGNORECASE)
+
+
+class ReplyRules:
+    def __init__(self, rules: list[ReplyRule]):
+        self.rules = rules
+        self.keywords = [
+            frozenset(keyword.casefold() for keyword in rule.keywords) for rule in rules
+        ]
+        # Only the keywords of rules are scanned for, question words have a
+        # pattern of their own which stops at the first one.
+        self.matcher = KeywordMatcher(set().union(*(rule.keywords for rule in rules)))
+
+    def respond(self, message: str, author_name: str) -> str | None:
+        """
+        The reply of the first matching rule. Each condition is only
+        evaluated once a rule needs it, and at most once per message.
+        """
+        found = question = addressed = None
+
+        for rule, keywords in zip(self.rules, self.keywords):
+            if rule.question is not None:
+                if question is None:
+                    question = "?" in message or bool(QUESTION_PATTERN.search(message))
+                if rule.question != question:
+                    continue
+            if keywords:
+                if found is None:
+                    found = self.matcher.find(message)
+                if found.isdisjoint(keywords):
+                    continue
+            if rule.addressed_to_author is not None:
+                if addressed is None:
+                    addressed = bool(author_pattern(author_name).search(message))
+                if rule.addressed_to_author != addressed:
+                    continue
+            return rule.template.replace("{author_name}", author_name)
+        return None
+
 
-def is_question(message):
-    return re.search(r'\?', message) or re.search(r'\b(what|when|how|why|who|where)\b', message, re.IGNORECASE)
+@lru_cache(maxsize=None)
+def get_reply_rules() -> ReplyRules:
+    """The rules of AUTO_REPLY_RULES_FILE, or DEFAULT_RULES."""
+    if not settings.AUTO_REPLY_RULES_FILE:
+        return ReplyRules(DEFAULT_RULES)
+    with open(settings.AUTO_REPLY_RULES_FILE, "rb") as file:
+        rules = TypeAdapter(list[ReplyRule]).validate_json(file.read())
+    return ReplyRules(rules)
 
-def is_addressed_to_author(message, author_name):
-    return re.search(fr'\b{author_name}\b', message, re.IGNORECASE)
 
 def generate_response(message, author_name):
-    if is_question(message) and is_addressed_to_author(message, author_name):
-        return "I saw your question and will get back to you as soon as I can."
-    else:
-        return "Thank you for your comment!"
+    response = get_reply_rules().respond(message, author_name)
+    return response if response is not None else DEFAULT_RULES[-1].template
@@ -0,0 +1,56 @@
+"""
+Counters of this process, served by GET /metrics in the Prometheus text
+format. Every worker process counts on its own.
+
+Celery worker processes dump their counters to files of
+WORKER_METRICS_DIR, which the main worker process adds up and serves on
+WORKER_METRICS_PORT, see src.services.worker.
+"""
+
+import json
+import os
+import threading
+from collections import Counter
+
+counters: Counter[str] = Counter()
+
+
+def key(name: str, **labels) -> str:
+    if not labels:
+        return name
+    pairs = ",".join(f'{label}="{value}"' for label, value in sorted(labels.items()))
+    return f"{name}{{{pairs}}}"
+
+
+def increment(name: str, amount: int = 1, **labels):
+    counters[key(name, **labels)] += amount
+
+
+def observe(name: str, value: float, **labels):
+    """Add a measurement to the `_sum` and `_count` of a summary."""
+    counters[key(f"{name}_sum", **labels)] += value
+    counters[key(f"{name}_count", **labels)] += 1
+
+
+def render(values: Counter[str] | None = None) -> str:
+    values = counters if values is None else values
+    return "".join(f"{name} {value}\n" for name, value in sorted(values.items()))
+
+
+def dump(path: str):
+    """Write the counters to `path`, replacing it at once."""
+    # Tasks of a threads pool dump at the same time, and keep counting.
+    temporary = f"{path}.{threading.get_ident()}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(dict(counters), file)
+    os.replace(temporary, path)
+
+
+def load(directory: str) -> Counter[str]:
+    """The sum of the counters dumped to the directory."""
+    total: Counter[str] = Counter()
+    for name in os.listdir(directory):
+        if name.endswith(".json"):
+            with open(os.path.join(directory, name)) as file:
+                total.update(json.load(file))
+    return total
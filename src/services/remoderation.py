@@ -0,0 +1,203 @@
+"""
+Re-moderating existing posts and comments, e.g. after switching the
+toxicity backend:
+
+    python -m src.services.remoderation [--table posts|comments] [--restart]
+        [--batch-size 500] [--concurrency 10] [--rate 10]
+
+Rows are read in id order, `--batch-size` at a time, and scored by
+TOXICITY_BACKEND with at most `--concurrency` texts in flight and `--rate`
+a second. Every batch writes its scores with one UPDATE and records its
+last id, so an interrupted run continues where it stopped unless started
+with `--restart`. The score cache and the fallback backend are bypassed, a
+failing backend stops the run.
+
+Changing only TOXICITY_THRESHOLD needs no rescoring:
+
+    python -m src.services.remoderation --rethreshold
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from database.database import SessionLocal
+from src.post.comment.daily_stats import refresh_comment_daily_stats
+from src.post.comment.models import Comment
+from src.post.models import ModerationCheckpoint, Post
+from src.services import metrics
+from src.services.text_toxicity_analysis import is_toxic
+from src.services.toxicity_backends import get_toxicity_backend
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+CONCURRENCY = 10
+RATE = 10.0
+
+# The texts scored for every row of a table.
+RESCANNED = {
+    "posts": (Post, ("title", "content")),
+    "comments": (Comment, ("content",)),
+}
+
+
+class RateLimiter:
+    """Spaces calls out to at most `rate` a second, no limit for 0."""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        at = max(now, self.next_at)
+        self.next_at = at + self.interval
+        await asyncio.sleep(at - now)
+
+
+def write_scores(model, columns: tuple[str, ...]):
+    """
+    UPDATE of many rows by id, executed with one parameter set per row.
+    Rows whose texts were edited since they were read are left to the
+    moderation of that edit.
+    """
+    table = model.__table__
+    return (
+        update(table)
+        .where(
+            table.c.id == bindparam("row_id"),
+            *(table.c[column] == bindparam(f"scored_{column}") for column in columns),
+        )
+        .values(
+            toxicity_score=bindparam("score"),
+            is_blocked=bindparam("blocked"),
+            pending_moderation=False,
+        )
+    )
+
+
+async def rescan_table(
+    db: AsyncSession,
+    table: str,
+    batch_size: int = BATCH_SIZE,
+    concurrency: int = CONCURRENCY,
+    rate: float = RATE,
+    restart: bool = False,
+) -> int:
+    """Score every row of the table from its checkpoint on. Returns the rows scored."""
+    model, columns = RESCANNED[table]
+    backend = get_toxicity_backend(settings.TOXICITY_BACKEND)
+    semaphore = asyncio.Semaphore(concurrency)
+    limiter = RateLimiter(rate)
+
+    async def score(text: str) -> float:
+        async with semaphore:
+            await limiter.wait()
+            return await backend.score(text)
+
+    async def score_row(row) -> float:
+        return max(await asyncio.gather(*(score(text) for text in row[1:])))
+
+    checkpoint = await db.get(ModerationCheckpoint, table)
+    if checkpoint is None:
+        checkpoint = ModerationCheckpoint(table_name=table, last_id=0)
+        db.add(checkpoint)
+    if restart:
+        checkpoint.last_id = 0
+    last_id = checkpoint.last_id
+
+    query = select(model.id, *(getattr(model, column) for column in columns))
+    statement = write_scores(model, columns)
+    rescanned = 0
+    while True:
+        result = await db.execute(
+            query.where(model.id > last_id)
+            .order_by(model.id)
+            .limit(batch_size)
+        )
+        rows = result.all()
+        if not rows:
+            break
+
+        scores = await asyncio.gather(*(score_row(row) for row in rows))
+        await db.execute(
+            statement,
+            [
+                {
+                    "row_id": row[0],
+                    **{
+                        f"scored_{column}": text
+                        for column, text in zip(columns, row[1:])
+                    },
+                    "score": toxicity_score,
+                    "blocked": is_toxic(toxicity_score),
+                }
+                for row, toxicity_score in zip(rows, scores)
+            ],
+        )
+        if model is Comment:
+            await refresh_comment_daily_stats(db, [row[0] for row in rows])
+        last_id = checkpoint.last_id = rows[-1][0]
+        await db.commit()
+
+        rescanned += len(rows)
+        metrics.increment(f"remoderated_{table}_total", len(rows))
+        logger.info(f"Rescanned {table} up to id {last_id}")
+
+    await db.delete(checkpoint)
+    await db.commit()
+    return rescanned
+
+
+async def apply_threshold(db: AsyncSession):
+    """Recompute is_blocked from the stored scores with TOXICITY_THRESHOLD."""
+    for model, _ in RESCANNED.values():
+        await db.execute(
+            update(model)
+            .where(model.toxicity_score.is_not(None))
+            .values(is_blocked=model.toxicity_score > settings.TOXICITY_THRESHOLD)
+        )
+    await refresh_comment_daily_stats(db)
+    await db.commit()
+
+
+async def rescan(tables=tuple(RESCANNED), restart: bool = False, **options):
+    async with SessionLocal() as db:
+        for table in tables:
+            rescanned = await rescan_table(db, table, restart=restart, **options)
+            logger.info(f"Rescanned {rescanned} {table}")
+
+
+async def rethreshold():
+    async with SessionLocal() as db:
+        await apply_threshold(db)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", choices=RESCANNED, action="append")
+    parser.add_argument("--restart", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=RATE)
+    parser.add_argument("--rethreshold", action="store_true")
+    args = parser.parse_args()
+
+    if args.rethreshold:
+        asyncio.run(rethreshold())
+    else:
+        asyncio.run(
+            rescan(
+                args.table or tuple(RESCANNED),
+                restart=args.restart,
+                batch_size=args.batch_size,
+                concurrency=args.concurrency,
+                rate=args.rate,
+            )
+        )
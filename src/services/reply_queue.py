@@ -0,0 +1,218 @@
+"""
+Auto-replies waiting for their delay, in a Redis sorted set scored by the
+time they are due.
+
+Replies are first written to the auto_reply_outbox table in the
+transaction of the comment they answer, so a request never waits on Redis
+and a crash cannot lose a reply. The relay_reply_outbox Celery task
+publishes pending rows to the sorted set in batches. It may publish a row
+more than once, so the queue holds outbox ids, whose reply is loaded when
+it is due and written only by the transaction that deletes the row.
+
+The flush_due_replies Celery task, run by beat every REPLY_FLUSH_INTERVAL
+seconds, claims due replies REPLY_BATCH_SIZE at a time and writes those
+of each post in one transaction with one pass over its tree. A busy post
+then costs a transaction per batch rather than one per reply.
+"""
+
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import redis.asyncio as redis
+from sqlalchemy import and_, delete, or_, select, update
+
+from config import settings
+from database.database import SessionLocal
+from src.post.comment.models import AutoReplyOutbox, Comment
+from src.post.comment.utils import comment_replies_create, pop_exhausted_comment_trees
+from src.services import metrics
+from src.services.generate_response import generate_response
+from src.user.models import User
+
+logger = logging.getLogger(__name__)
+
+DUE_REPLIES_KEY = "auto_replies:due"
+
+client: redis.Redis | None = None
+
+
+def get_redis() -> redis.Redis:
+    global client
+    if client is None:
+        client = redis.from_url(
+            settings.REPLY_QUEUE_REDIS_URL or settings.CELERY_BROKER_URL
+        )
+    return client
+
+
+def schedule_reply(db, comment: Comment, author_id: int, delay: float):
+    """
+    Owe the author's auto-reply to `comment`, committed together with the
+    session's transaction.
+    """
+    db.add(
+        AutoReplyOutbox(
+            post_id=comment.post_id,
+            parent=comment,
+            author_id=author_id,
+            due_at=datetime.now(timezone.utc) + timedelta(seconds=delay),
+        )
+    )
+
+
+def timestamp(moment: datetime) -> float:
+    # SQLite hands back naive datetimes, stored in UTC.
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+async def relay_outbox() -> int:
+    """
+    Publish the outbox rows not relayed yet, or due and relayed more than
+    REPLY_OUTBOX_REDELIVERY seconds ago and still not written, in case the
+    queue lost them. Returns the number of rows published.
+    """
+    relayed = 0
+    now = datetime.now(timezone.utc)
+    redeliver_before = now - timedelta(seconds=settings.REPLY_OUTBOX_REDELIVERY)
+    async with SessionLocal() as db:
+        while True:
+            result = await db.execute(
+                select(AutoReplyOutbox.id, AutoReplyOutbox.due_at)
+                .where(
+                    or_(
+                        AutoReplyOutbox.relayed_at.is_(None),
+                        and_(
+                            AutoReplyOutbox.relayed_at < redeliver_before,
+                            AutoReplyOutbox.due_at < redeliver_before,
+                        ),
+                    )
+                )
+                .order_by(AutoReplyOutbox.id)
+                .limit(settings.REPLY_BATCH_SIZE)
+            )
+            rows = result.all()
+            if not rows:
+                break
+
+            # Members are outbox ids, which Redis keeps once however often
+            # they are published.
+            await get_redis().zadd(
+                DUE_REPLIES_KEY, {str(row.id): timestamp(row.due_at) for row in rows}
+            )
+            await db.execute(
+                update(AutoReplyOutbox)
+                .where(AutoReplyOutbox.id.in_([row.id for row in rows]))
+                .values(relayed_at=now)
+            )
+            await db.commit()
+            relayed += len(rows)
+            if len(rows) < settings.REPLY_BATCH_SIZE:
+                break
+
+    metrics.increment("auto_replies_relayed_total", relayed)
+    return relayed
+
+
+async def claim_due_replies(limit: int) -> list[str]:
+    """
+    Take up to `limit` due replies off the queue. Of concurrent callers only
+    the one removing a reply gets it.
+    """
+    queue = get_redis()
+    members = await queue.zrangebyscore(
+        DUE_REPLIES_KEY, "-inf", time.time(), start=0, num=limit
+    )
+    if not members:
+        return []
+    async with queue.pipeline(transaction=False) as pipe:
+        for member in members:
+            pipe.zrem(DUE_REPLIES_KEY, member)
+        removed = await pipe.execute()
+    return [member for member, claimed in zip(members, removed) if claimed]
+
+
+async def load_replies(members: list[str]):
+    """The replies still owed of claimed members, with what they answer."""
+    async with SessionLocal() as db:
+        result = await db.execute(
+            select(
+                AutoReplyOutbox.id,
+                AutoReplyOutbox.post_id,
+                AutoReplyOutbox.parent_id,
+                AutoReplyOutbox.author_id,
+                Comment.content,
+                User.email,
+            )
+            .join(Comment, Comment.id == AutoReplyOutbox.parent_id)
+            .join(User, User.id == AutoReplyOutbox.author_id)
+            .where(AutoReplyOutbox.id.in_([int(member) for member in members]))
+        )
+        return result.all()
+
+
+async def write_replies(members: list[str]) -> set[int]:
+    """
+    Write claimed replies still owed, one transaction per post. The replies
+    of a post that fails are put back on the queue. Returns the posts whose
+    gaps ran out.
+    """
+    by_post = defaultdict(list)
+    for reply in await load_replies(members):
+        by_post[reply.post_id].append(reply)
+
+    exhausted = set()
+    for post_id, post_replies in by_post.items():
+        try:
+            async with SessionLocal() as db:
+                # Replies delivered twice are written by whoever deletes their row.
+                owed = set(
+                    await db.scalars(
+                        delete(AutoReplyOutbox)
+                        .where(
+                            AutoReplyOutbox.id.in_([reply.id for reply in post_replies])
+                        )
+                        .returning(AutoReplyOutbox.id)
+                    )
+                )
+                replies = [reply for reply in post_replies if reply.id in owed]
+                if replies:
+                    await comment_replies_create(
+                        db,
+                        post_id,
+                        [
+                            {
+                                "parent_id": reply.parent_id,
+                                "content": generate_response(
+                                    reply.content, reply.email
+                                ),
+                                "user_id": reply.author_id,
+                                "is_blocked": False,
+                            }
+                            for reply in replies
+                        ],
+                    )
+                await db.commit()
+                exhausted |= pop_exhausted_comment_trees(db)
+        except Exception:
+            logger.exception(f"Failed to write auto-replies to post {post_id}")
+            await get_redis().zadd(
+                DUE_REPLIES_KEY,
+                {str(reply.id): time.time() for reply in post_replies},
+            )
+        else:
+            metrics.increment("auto_replies_written_total", len(replies))
+    return exhausted
+
+
+async def flush_due_replies() -> set[int]:
+    """Write every due reply, batch by batch. Returns the posts to rebalance."""
+    exhausted = set()
+    while members := await claim_due_replies(settings.REPLY_BATCH_SIZE):
+        exhausted |= await write_replies(members)
+        if len(members) < settings.REPLY_BATCH_SIZE:
+            break
+    return exhausted
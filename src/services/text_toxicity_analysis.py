@@ -1,29 +1,89 @@
+import asyncio
+import hashlib
 import logging
+import unicodedata
 
-from googleapiclient import discovery
+import redis.asyncio as redis
+from cachetools import TTLCache
 
 from config import settings
+from src.services import metrics
+from src.services.toxicity_backends import CircuitBreaker, close_perspective_client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-client = discovery.build(
-    "commentanalyzer",
-    "v1alpha1",
-    developerKey=settings.PERSPECTIVE_API_KEY,
-    discoveryServiceUrl="https://commentanalyzer.googleapis.com/$discovery/rest?version=v1alpha1",
-    static_discovery=False,
-)
 
+class ToxicityCache:
+    """
+    Scores by the hash of the normalized text: an in-process LRU with a TTL
+    in front of an optional Redis tier shared by all processes.
 
-async def analyze_text_toxicity(text: str) -> bool:
-    analyze_request = {
-        "comment": {"text": text},
-        "requestedAttributes": {"TOXICITY": {}},
-    }
+    Redis errors are logged and treated as misses.
+    """
 
-    response = client.comments().analyze(body=analyze_request).execute()
-    toxicity_score = response["attributeScores"]["TOXICITY"]["summaryScore"]["value"]
+    def __init__(self):
+        self.memory = TTLCache(
+            maxsize=settings.TOXICITY_CACHE_SIZE, ttl=settings.TOXICITY_CACHE_TTL
+        )
+        self.redis = None
+        if settings.TOXICITY_CACHE_REDIS_URL:
+            self.redis = redis.from_url(settings.TOXICITY_CACHE_REDIS_URL)
+
+    @staticmethod
+    def key(text: str) -> str:
+        """Texts differing only in case, whitespace or Unicode form share a key."""
+        normalized = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+        return "toxicity:" + hashlib.sha256(normalized.encode()).hexdigest()
+
+    async def get(self, text: str) -> float | None:
+        key = self.key(text)
+        if key in self.memory:
+            metrics.increment("toxicity_cache_memory_hits_total")
+            return self.memory[key]
+
+        if self.redis is not None:
+            try:
+                cached = await self.redis.get(key)
+            except redis.RedisError as error:
+                logger.warning(f"Toxicity cache unavailable: {error}")
+                cached = None
+            if cached is not None:
+                metrics.increment("toxicity_cache_redis_hits_total")
+                self.memory[key] = float(cached)
+                return self.memory[key]
+
+        metrics.increment("toxicity_cache_misses_total")
+        return None
+
+    async def set(self, text: str, toxicity_score: float):
+        key = self.key(text)
+        self.memory[key] = toxicity_score
+        if self.redis is not None:
+            try:
+                await self.redis.set(
+                    key, toxicity_score, ex=settings.TOXICITY_CACHE_TTL
+                )
+            except redis.RedisError as error:
+                logger.warning(f"Toxicity cache unavailable: {error}")
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+
+cache = ToxicityCache()
+breaker = CircuitBreaker()
+
+
+async def score_text(text: str) -> tuple[float, bool]:
+    """The score of the text and whether the backend, not the fallback, gave it."""
+    toxicity_score, from_backend = await cache.get(text), True
+    if toxicity_score is None:
+        toxicity_score, from_backend = await breaker.score(text)
+        # Fallback scores are rough, the backend should get to score the text.
+        if from_backend:
+            await cache.set(text, toxicity_score)
 
     if toxicity_score < 0.2:
         logger.info(f"Text toxicity level: Low ({toxicity_score:.2f})")
@@ -32,4 +92,36 @@ async def analyze_text_toxicity(text: str) -> bool:
     else:
         logger.info(f"Text toxicity level: High ({toxicity_score:.2f})")
 
+    return toxicity_score, from_backend
+
+
+async def analyze_text_toxicity(text: str) -> float:
+    toxicity_score, _ = await score_text(text)
+    return toxicity_score
+
+
+async def score_texts(*texts: str) -> tuple[float, bool]:
+    """
+    The highest score of the texts, scored concurrently, and whether the
+    backend scored all of them.
+    """
+    scores = await asyncio.gather(*(score_text(text) for text in texts))
+    return max(score for score, _ in scores), all(
+        from_backend for _, from_backend in scores
+    )
+
+
+async def toxicity_of(*texts: str) -> float:
+    """The highest score of the texts, scored concurrently."""
+    toxicity_score, _ = await score_texts(*texts)
     return toxicity_score
+
+
+def is_toxic(toxicity_score: float) -> bool:
+    return toxicity_score > settings.TOXICITY_THRESHOLD
+
+
+async def close_client():
+    """Close the pooled connections, on application shutdown."""
+    await close_perspective_client()
+    await cache.close()
@@ -0,0 +1,280 @@
+"""
+Backends scoring the toxicity of a text from 0 (harmless) to 1, selected
+with TOXICITY_BACKEND, and the circuit breaker that sends texts to
+TOXICITY_FALLBACK_BACKEND while the selected one fails or is slow.
+"""
+
+import asyncio
+import logging
+import re
+import time
+import unicodedata
+
+import httpx
+
+from config import settings
+from src.services import metrics
+
+logger = logging.getLogger(__name__)
+
+# One pool of keep-alive connections shared by all requests, so scoring a
+# text neither blocks the event loop nor pays for a new TLS handshake. It is
+# created on first use, importing the app needs neither network nor setup.
+client: httpx.AsyncClient | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global client
+    if client is None:
+        client = httpx.AsyncClient(
+            timeout=httpx.Timeout(settings.PERSPECTIVE_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=settings.PERSPECTIVE_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.PERSPECTIVE_MAX_CONNECTIONS,
+            ),
+        )
+    return client
+
+
+async def close_perspective_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+async def request_toxicity_score(text: str) -> float:
+    """One Perspective API call."""
+    analyze_request = {
+        "comment": {"text": text},
+        "requestedAttributes": {"TOXICITY": {}},
+    }
+
+    response = await get_client().post(
+        settings.PERSPECTIVE_API_URL,
+        params={"key": settings.PERSPECTIVE_API_KEY},
+        json=analyze_request,
+    )
+    response.raise_for_status()
+    return response.json()["attributeScores"]["TOXICITY"]["summaryScore"]["value"]
+
+
+class ToxicityScorer:
+    """
+    Coalesces the texts of concurrent requests.
+
+    Texts asked for within PERSPECTIVE_COALESCE_WINDOW seconds are sent
+    together, an identical text only once, with at most
+    PERSPECTIVE_MAX_CONNECTIONS calls in flight. Every caller gets the
+    score of its own text.
+    """
+
+    def __init__(self):
+        self.pending: dict[str, list[asyncio.Future]] = {}
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.semaphore: asyncio.Semaphore | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+    async def score(self, text: str) -> float:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(text, []).append(future)
+        if self.flush_handle is None:
+            self.flush_handle = loop.call_later(
+                settings.PERSPECTIVE_COALESCE_WINDOW, self.flush
+            )
+        return await future
+
+    def flush(self):
+        pending, self.pending = self.pending, {}
+        self.flush_handle = None
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(settings.PERSPECTIVE_MAX_CONNECTIONS)
+
+        for text, futures in pending.items():
+            task = asyncio.create_task(self.send(text, futures))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def send(self, text: str, futures: list[asyncio.Future]):
+        async with self.semaphore:
+            try:
+                toxicity_score = await request_toxicity_score(text)
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                return
+
+        for future in futures:
+            if not future.done():
+                future.set_result(toxicity_score)
+
+
+scorer = ToxicityScorer()
+
+
+class ToxicityBackend:
+    """Scores the toxicity of texts."""
+
+    name: str
+
+    async def score(self, text: str) -> float:
+        raise NotImplementedError
+
+
+class PerspectiveBackend(ToxicityBackend):
+    """Google's Perspective API, with the calls of concurrent requests coalesced."""
+
+    name = "perspective"
+
+    async def score(self, text: str) -> float:
+        return await scorer.score(text)
+
+
+# Regular expressions matched at the start of a word, by the score of a
+# text containing one of them.
+LEXICON = {
+    0.9: (
+        r"fuck",
+        r"f\*{2,}",
+        r"shit",
+        r"bitch",
+        r"bastard",
+        r"asshole",
+        r"idiot",
+        r"moron",
+        r"stupid",
+        r"dumbass",
+        r"scum",
+        r"kill yourself",
+        r"kys\b",
+    ),
+    0.6: (
+        r"dumb\b",
+        r"loser",
+        r"pathetic",
+        r"worthless",
+        r"shut up",
+        r"hate you",
+        r"crap",
+        r"trash\b",
+        r"garbage\b",
+        r"ugly",
+    ),
+}
+
+
+class LexiconBackend(ToxicityBackend):
+    """
+    Offline scorer: the score of the worst LEXICON entry found once common
+    letter substitutions are undone, or 0.05. Coarse, but it needs no
+    network and answers in microseconds.
+    """
+
+    name = "lexicon"
+    substitutions = str.maketrans("013457@$", "oieastas")
+    baseline = 0.05
+
+    def __init__(self, lexicon: dict[float, tuple[str, ...]] = LEXICON):
+        self.patterns = [
+            (toxicity_score, re.compile(r"\b(?:" + "|".join(terms) + ")"))
+            for toxicity_score, terms in sorted(lexicon.items(), reverse=True)
+        ]
+
+    async def score(self, text: str) -> float:
+        normalized = " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+        normalized = normalized.translate(self.substitutions)
+        for toxicity_score, pattern in self.patterns:
+            if pattern.search(normalized):
+                return toxicity_score
+        return self.baseline
+
+
+TOXICITY_BACKENDS = {
+    backend.name: backend for backend in (PerspectiveBackend(), LexiconBackend())
+}
+
+
+def get_toxicity_backend(name: str) -> ToxicityBackend:
+    try:
+        return TOXICITY_BACKENDS[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown toxicity backend {name!r}, "
+            f"expected one of {', '.join(TOXICITY_BACKENDS)}."
+        )
+
+
+class CircuitBreaker:
+    """
+    Scores with TOXICITY_BACKEND and falls back to TOXICITY_FALLBACK_BACKEND
+    while it is unhealthy.
+
+    A call that fails or takes longer than TOXICITY_BREAKER_TIMEOUT seconds
+    is answered by the fallback and counts as a failure. After
+    TOXICITY_BREAKER_FAILURES failures in a row the breaker opens: for
+    TOXICITY_BREAKER_RESET seconds every text goes to the fallback, then a
+    single trial call decides whether it closes again.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial else "open"
+
+    def allow(self) -> bool:
+        """Whether the next call may go to the backend."""
+        if self.opened_at is None:
+            return True
+        elapsed = time.monotonic() - self.opened_at
+        if self.trial or elapsed < settings.TOXICITY_BREAKER_RESET:
+            return False
+        self.trial = True
+        return True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Toxicity backend recovered, closing the circuit")
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial or self.failures >= settings.TOXICITY_BREAKER_FAILURES:
+            logger.warning(
+                f"Toxicity backend failing, using {settings.TOXICITY_FALLBACK_BACKEND}"
+                f" for {settings.TOXICITY_BREAKER_RESET}s"
+            )
+            metrics.increment("toxicity_breaker_opened_total")
+            self.opened_at = time.monotonic()
+            self.trial = False
+
+    async def score(self, text: str) -> tuple[float, bool]:
+        """The score of the text and whether the backend, not the fallback, gave it."""
+        backend = get_toxicity_backend(settings.TOXICITY_BACKEND)
+        if not settings.TOXICITY_FALLBACK_BACKEND:
+            return await backend.score(text), True
+        fallback = get_toxicity_backend(settings.TOXICITY_FALLBACK_BACKEND)
+
+        if self.allow():
+            try:
+                toxicity_score = await asyncio.wait_for(
+                    backend.score(text), settings.TOXICITY_BREAKER_TIMEOUT
+                )
+            except Exception as error:
+                logger.warning(f"Toxicity backend error: {error!r}")
+                self.record_failure()
+            else:
+                self.record_success()
+                return toxicity_score, True
+
+        metrics.increment("toxicity_fallback_total")
+        return await fallback.score(text), False
@@ -0,0 +1,186 @@
+"""
+Event loop and database engine of a Celery worker process.
+
+The coroutines of a process's tasks all run on one long-lived event loop,
+on a thread of its own, and SessionLocal is bound to an engine created in
+the process after the fork. Database connections, the Perspective client
+and the toxicity scorer then last as long as the process instead of being
+set up again for every task.
+
+Each task's wait in the queue, run time and time spent in the database
+are added to the metrics of its process. With WORKER_METRICS_DIR set they
+are dumped there after every task, and the main worker process serves
+their sum on WORKER_METRICS_PORT.
+"""
+
+import asyncio
+import os
+import shutil
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import settings
+from database.database import SessionLocal
+from src.services import metrics
+from src.services.breakdown_cache import cache as breakdown_cache
+from src.services.text_toxicity_analysis import close_client
+
+
+class WorkerLoop:
+    """An event loop running on its own thread, started on first use."""
+
+    def __init__(self):
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.lock = threading.Lock()
+
+    def run(self, coroutine):
+        """Run the coroutine on the loop and wait for its result."""
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self.loop.run_forever, name="worker-loop", daemon=True
+                ).start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def stop(self):
+        with self.lock:
+            if self.loop is not None:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.loop = None
+
+
+worker_loop = WorkerLoop()
+
+
+@dataclass
+class TaskTiming:
+    started: float
+    db_seconds: float = 0.0
+
+
+class TaskTimer:
+    """
+    Times the tasks running in this process, which overlap under the
+    threads, gevent and eventlet pools. Each task's timing is kept in its
+    context, which the coroutines it runs on worker_loop inherit, so a
+    statement is counted towards the task that ran it.
+    """
+
+    def __init__(self):
+        self.current: ContextVar[TaskTiming | None] = ContextVar(
+            "task_timing", default=None
+        )
+
+    def before_cursor_execute(self, conn, *args):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, *args):
+        seconds = time.perf_counter() - conn.info["query_started"].pop()
+        timing = self.current.get()
+        if timing is not None:
+            timing.db_seconds += seconds
+
+    def time_queries(self, engine):
+        """Count the time the engine's statements take towards their task."""
+        event.listen(
+            engine.sync_engine, "before_cursor_execute", self.before_cursor_execute
+        )
+        event.listen(
+            engine.sync_engine, "after_cursor_execute", self.after_cursor_execute
+        )
+
+    def start(self, task):
+        # Stamped by the publisher, see src.services.celery_app.
+        published_at = getattr(task.request, "published_at", None)
+        if published_at is not None:
+            metrics.observe(
+                "celery_task_queue_wait_seconds",
+                max(time.time() - published_at, 0.0),
+                task=task.name,
+            )
+        self.current.set(TaskTiming(time.perf_counter()))
+
+    def finish(self, task):
+        timing = self.current.get()
+        if timing is None:
+            return
+        metrics.observe(
+            "celery_task_run_seconds",
+            time.perf_counter() - timing.started,
+            task=task.name,
+        )
+        metrics.observe("celery_task_db_seconds", timing.db_seconds, task=task.name)
+        self.current.set(None)
+        if settings.WORKER_METRICS_DIR:
+            metrics.dump(
+                os.path.join(settings.WORKER_METRICS_DIR, f"{os.getpid()}.json")
+            )
+
+
+task_timer = TaskTimer()
+
+
+def setup_worker_process(url: str | None = None):
+    """Bind SessionLocal to a connection pool of this process."""
+    url = url or settings.SQLALCHEMY_DATABASE_URL
+    options = {}
+    if not url.startswith("sqlite"):
+        options = {"pool_size": settings.WORKER_DB_POOL_SIZE, "pool_pre_ping": True}
+    engine = create_async_engine(url, **options)
+    task_timer.time_queries(engine)
+    SessionLocal.configure(bind=engine)
+    # A loop inherited through fork has no thread running it.
+    worker_loop.loop = None
+
+
+async def close_worker_process():
+    await SessionLocal.kw["bind"].dispose()
+    await close_client()
+    await breakdown_cache.close()
+
+
+def shutdown_worker_process():
+    worker_loop.run(close_worker_process())
+    worker_loop.stop()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render(metrics.load(settings.WORKER_METRICS_DIR)).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics() -> ThreadingHTTPServer | None:
+    """
+    Serve the metrics of all processes of this worker on
+    WORKER_METRICS_PORT, from the main process before it forks.
+    """
+    if not settings.WORKER_METRICS_DIR:
+        return None
+    # Files of an earlier run would be added to this one's.
+    shutil.rmtree(settings.WORKER_METRICS_DIR, ignore_errors=True)
+    os.makedirs(settings.WORKER_METRICS_DIR)
+    if not settings.WORKER_METRICS_PORT:
+        return None
+    server = ThreadingHTTPServer(("", settings.WORKER_METRICS_PORT), MetricsHandler)
+    threading.Thread(
+        target=server.serve_forever, name="worker-metrics", daemon=True
+    ).start()
+    return server
@@ -1,9 +1,12 @@
 import asyncio
+import contextlib
+import json
 
 import pytest_asyncio
 from fastapi import Depends
 from fastapi_users_db_sqlalchemy import SQLAlchemyUserDatabase
 from httpx import AsyncClient
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 
@@ -11,10 +14,24 @@ from config import settings
 from database.database import get_async_session, Base
 from database.dependencies import get_db
 from src.main import app
+from src.services import text_toxicity_analysis
+from src.services.text_toxicity_analysis import cache
+from src.services.toxicity_backends import CircuitBreaker
 from src.user.models import User
 from src.user.utils import get_user_db
 
-engine_test = create_async_engine(settings.TEST_DATABASE_URL)
+# Concurrent writers queue on SQLite's database lock, give them time to.
+engine_test = create_async_engine(
+    settings.TEST_DATABASE_URL, connect_args={"timeout": 30}
+)
+
+
+@event.listens_for(engine_test.sync_engine, "connect")
+def enable_foreign_keys(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
 
 async_session_market = sessionmaker(
     autocommit=False, autoflush=False, bind=engine_test, class_=AsyncSession
@@ -40,6 +57,23 @@ async def override_get_db():
         await db.close()
 
 
+@contextlib.contextmanager
+def count_queries():
+    """Collect every SQL statement executed against the test engine."""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine_test.sync_engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(
+            engine_test.sync_engine, "before_cursor_execute", before_cursor_execute
+        )
+
+
 app.dependency_overrides[get_async_session] = override_get_async_session
 app.dependency_overrides[get_user_db] = override_user_get_db
 app.dependency_overrides[get_db] = override_get_db
@@ -104,3 +138,62 @@ async def created_post(auth_client):
     response = await auth_client.post("/posts", json=data)
     assert response.status_code == 201
     return response.json()
+
+
+class FakePerspective:
+    """Minimal HTTP/1.1 Perspective server answering after `delay` seconds."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.texts = []
+        self.connections = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle(self, reader, writer):
+        self.connections.append(writer)
+        while headers := await reader.readuntil(b"\r\n\r\n"):
+            length = next(
+                int(line.split(b":")[1])
+                for line in headers.split(b"\r\n")
+                if line.lower().startswith(b"content-length:")
+            )
+            body = json.loads(await reader.readexactly(length))
+            self.texts.append(body["comment"]["text"])
+
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(self.delay)
+            self.in_flight -= 1
+
+            body = json.dumps(
+                {"attributeScores": {"TOXICITY": {"summaryScore": {"value": 0.1}}}}
+            ).encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+            )
+            await writer.drain()
+
+
+@pytest_asyncio.fixture
+async def fake_perspective(monkeypatch):
+    fake = FakePerspective(delay=0.2)
+    cache.memory.clear()
+    # Failures of earlier tests must not leave the fallback answering.
+    monkeypatch.setattr(text_toxicity_analysis, "breaker", CircuitBreaker())
+
+    async def handle(reader, writer):
+        with contextlib.suppress(asyncio.IncompleteReadError, ConnectionError):
+            await fake.handle(reader, writer)
+        writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    monkeypatch.setattr(
+        settings, "PERSPECTIVE_API_URL", f"http://127.0.0.1:{port}/comments:analyze"
+    )
+    yield fake
+    server.close()
+    for writer in fake.connections:
+        writer.close()
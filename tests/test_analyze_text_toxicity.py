@@ -1,4 +1,16 @@
-from src.services.text_toxicity_analysis import analyze_text_toxicity
+import asyncio
+import time
+
+from config import settings
+from src.services import metrics, text_toxicity_analysis
+from src.services.text_toxicity_analysis import analyze_text_toxicity, cache
+from src.services.toxicity_backends import (
+    CircuitBreaker,
+    LexiconBackend,
+    TOXICITY_BACKENDS,
+    ToxicityBackend,
+    scorer,
+)
 
 
 async def test_very_positive_text():
@@ -53,3 +65,115 @@ async def test_racist_text():
     text = "You people are the worst!"
     result = await analyze_text_toxicity(text)
     assert result >= 0.5
+
+
+async def test_concurrent_requests_overlap(fake_perspective):
+    started = time.perf_counter()
+    scores = await asyncio.gather(
+        *(analyze_text_toxicity(f"Comment {index}") for index in range(10))
+    )
+    elapsed = time.perf_counter() - started
+
+    assert scores == [0.1] * 10
+    assert fake_perspective.max_in_flight == 10, "Requests should overlap"
+    assert elapsed < 1, "Ten requests should take about one round trip"
+
+
+async def test_connections_are_kept_alive(fake_perspective):
+    for index in range(3):
+        await analyze_text_toxicity(f"Comment {index}")
+
+    assert len(fake_perspective.connections) == 1, "The connection should be reused"
+
+
+async def test_concurrent_texts_are_coalesced(fake_perspective, monkeypatch):
+    monkeypatch.setattr(settings, "PERSPECTIVE_MAX_CONNECTIONS", 2)
+    monkeypatch.setattr(scorer, "semaphore", None)
+    texts = [f"Comment {index % 4}" for index in range(12)]
+
+    scores = await asyncio.gather(*(analyze_text_toxicity(text) for text in texts))
+
+    assert scores == [0.1] * 12
+    assert sorted(fake_perspective.texts) == sorted(set(texts)), "One call per text"
+    assert fake_perspective.max_in_flight == 2, "Calls in flight should be bounded"
+
+
+async def test_repeated_texts_are_cached(fake_perspective, monkeypatch):
+    monkeypatch.setattr(metrics, "counters", metrics.Counter())
+
+    for text in ["Thanks!", "thanks!", "  THANKS!\n", "\uff34hanks!"]:
+        assert await analyze_text_toxicity(text) == 0.1
+
+    assert fake_perspective.texts == ["Thanks!"], "Normalized texts share a score"
+    assert metrics.counters["toxicity_cache_misses_total"] == 1
+    assert metrics.counters["toxicity_cache_memory_hits_total"] == 3
+
+
+async def test_scores_are_shared_through_redis(fake_perspective, monkeypatch):
+    class FakeRedis(dict):
+        async def get(self, key):
+            return super().get(key)
+
+        async def set(self, key, value, ex):
+            self[key] = str(value).encode()
+
+    monkeypatch.setattr(cache, "redis", FakeRedis())
+    monkeypatch.setattr(metrics, "counters", metrics.Counter())
+
+    await analyze_text_toxicity("+1")
+    cache.memory.clear()  # as seen by another worker
+    assert await analyze_text_toxicity("+1") == 0.1
+
+    assert fake_perspective.texts == ["+1"]
+    assert metrics.counters["toxicity_cache_redis_hits_total"] == 1
+
+
+async def test_lexicon_backend():
+    backend = LexiconBackend()
+
+    assert await backend.score("Have a nice day") < 0.2
+    assert await backend.score("You are an 1D10T") > 0.5
+    assert await backend.score("What a  f*** show") > 0.5
+    assert 0.5 < await backend.score("Shut   up, loser") < 0.9
+
+
+async def test_circuit_breaker_falls_back(monkeypatch):
+    class FlakyBackend(ToxicityBackend):
+        name = "flaky"
+        calls = 0
+        delay = 0
+        error = None
+
+        async def score(self, text):
+            self.calls += 1
+            await asyncio.sleep(self.delay)
+            if self.error:
+                raise self.error
+            return 0.3
+
+    flaky = FlakyBackend()
+    monkeypatch.setitem(TOXICITY_BACKENDS, "flaky", flaky)
+    monkeypatch.setattr(settings, "TOXICITY_BACKEND", "flaky")
+    monkeypatch.setattr(settings, "TOXICITY_FALLBACK_BACKEND", "lexicon")
+    monkeypatch.setattr(settings, "TOXICITY_BREAKER_FAILURES", 2)
+    monkeypatch.setattr(settings, "TOXICITY_BREAKER_TIMEOUT", 0.05)
+    monkeypatch.setattr(settings, "TOXICITY_BREAKER_RESET", 60)
+    monkeypatch.setattr(text_toxicity_analysis, "breaker", CircuitBreaker())
+    cache.memory.clear()
+    breaker = text_toxicity_analysis.breaker
+
+    flaky.error = ConnectionError("down")
+    assert await analyze_text_toxicity("Hello") == 0.05, "Errors use the fallback"
+    flaky.error, flaky.delay = None, 0.2
+    assert await analyze_text_toxicity("You idiot") == 0.9, "Slow calls too"
+    assert breaker.state == "open"
+
+    flaky.delay = 0
+    assert await analyze_text_toxicity("Hello") == 0.05
+    assert flaky.calls == 2, "An open circuit should skip the backend"
+
+    monkeypatch.setattr(settings, "TOXICITY_BREAKER_RESET", 0)
+    assert await analyze_text_toxicity("Hello") == 0.3, "A trial call should go through"
+    assert breaker.state == "closed"
+    assert await analyze_text_toxicity("Hello") == 0.3, "Backend scores are cached"
+    assert flaky.calls == 3
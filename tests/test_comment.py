@@ -1,3 +1,25 @@
+import asyncio
+import json
+import time
+from collections import Counter
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import delete, select
+
+from config import settings
+from src.post import crud
+from src.post.comment.models import AutoReplyOutbox, Comment
+from src.post.comment.utils import rebuild_comment_tree
+from src.post.models import ModerationCheckpoint, Post
+from src.services import celery_app, reply_queue
+from src.services.generate_response import generate_response
+from src.services.remoderation import apply_threshold, rescan_table
+from src.services.toxicity_backends import TOXICITY_BACKENDS, ToxicityBackend
+from src.user.models import User
+from tests.conftest import async_session_market, count_queries
+
 comment_fields = [
     "id",
     "created_at",
@@ -8,6 +30,9 @@ comment_fields = [
     "rgt",
     "post_id",
     "is_blocked",
+    "pending_moderation",
+    "children_count",
+    "has_more",
 ]
 
 
@@ -161,3 +186,866 @@ class TestCommentAPI:
         assert len(response_data) == 1, "Child comment not found"
 
         assert response_data[0]["id"] == child_id, "Child comment ID mismatch"
+
+    async def test_comments_tree_query_count_is_constant(self, auth_client):
+        data = {"title": "Thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        query_counts = []
+        parent_id = None
+        for _ in range(3):
+            for _ in range(3):
+                data = {"content": "Nested comment", "parent_id": parent_id}
+                response = await auth_client.post(
+                    f"/posts/{post_id}/comment", json=data
+                )
+                assert response.status_code == 201, "Failed to create comment"
+                parent_id = response.json()["id"]
+
+            with count_queries() as statements:
+                response = await auth_client.get(f"/post/{post_id}/comments")
+            assert response.status_code == 200, "Failed to get comments for post"
+            query_counts.append(len(statements))
+
+        depth = 0
+        nodes = response.json()
+        while nodes:
+            assert len(nodes) == 1, "Each level should hold a single reply"
+            depth += 1
+            nodes = nodes[0]["children"]
+        assert depth == 9, "Comment tree depth mismatch"
+
+        assert (
+            len(set(query_counts)) == 1
+        ), f"Query count should not grow with the tree: {query_counts}"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_comment_tree_is_numbered_per_post(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", "nested_set")
+        monkeypatch.setattr(settings, "COMMENT_TREE_GAP", 0)
+        data = {"title": "Scoped thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comment", json={"content": "Root comment"}
+        )
+        root_id = response.json()["id"]
+        for content in ("First reply", "Second reply"):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": root_id},
+            )
+            assert response.status_code == 201, "Failed to create reply"
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        (root,) = response.json()
+        assert (root["lft"], root["rgt"]) == (1, 6), "Root should start at lft=1"
+        assert [(child["lft"], child["rgt"]) for child in root["children"]] == [
+            (2, 3),
+            (4, 5),
+        ], "Replies should be numbered in order inside the root"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_gapped_comment_tree_rebalances(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", "nested_set")
+        monkeypatch.setattr(settings, "COMMENT_TREE_GAP", 4)
+        rebalanced = []
+        monkeypatch.setattr(
+            crud, "rebalance_comment_tree", SimpleNamespace(delay=rebalanced.append)
+        )
+
+        data = {"title": "Gapped thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+        response = await auth_client.post(
+            f"/posts/{post_id}/comment", json={"content": "Root comment"}
+        )
+        root_id = response.json()["id"]
+
+        for expected_rgt in (6, 6, 12):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": "Reply", "parent_id": root_id},
+            )
+            assert response.status_code == 201, "Failed to create reply"
+            response = await auth_client.get(f"/post/{post_id}/comments")
+            (root,) = response.json()
+            assert root["rgt"] == expected_rgt, "Root should grow only when full"
+        assert rebalanced == [post_id], "Exhausted post should be rebalanced"
+
+        async with async_session_market() as session:
+            await rebuild_comment_tree(session, post_id)
+            await session.commit()
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        (root,) = response.json()
+        assert (root["lft"], root["rgt"]) == (1, 24), "Root should be renumbered"
+        assert [(child["lft"], child["rgt"]) for child in root["children"]] == [
+            (2, 7),
+            (8, 13),
+            (14, 19),
+        ], "Replies should be spread out with gaps"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    @pytest.mark.parametrize(
+        "storage", ["nested_set", "materialized_path", "closure_table"]
+    )
+    async def test_comment_tree_storage(self, auth_client, monkeypatch, storage):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", storage)
+
+        data = {"title": f"{storage} thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            assert response.status_code == 201, "Failed to create comment"
+            return response.json()["id"]
+
+        first = await comment("First")
+        reply = await comment("Reply", first)
+        await comment("Nested reply", reply)
+        await comment("Second reply", first)
+        await comment("Second")
+
+        def shape(nodes):
+            return [(node["content"], shape(node["children"])) for node in nodes]
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert shape(response.json()) == [
+            ("First", [("Reply", [("Nested reply", [])]), ("Second reply", [])]),
+            ("Second", []),
+        ], "Comment tree shape mismatch"
+
+        response = await auth_client.delete(f"/comments/{reply}")
+        assert response.status_code == 204, "Failed to delete comment"
+        await comment("Third reply", first)
+
+        expected = [
+            ("First", [("Second reply", []), ("Third reply", [])]),
+            ("Second", []),
+        ]
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert shape(response.json()) == expected, "Replies should be deleted"
+
+        async with async_session_market() as session:
+            await rebuild_comment_tree(session, post_id)
+            await session.commit()
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert shape(response.json()) == expected, "Rebuild should keep the tree"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_get_comments_page(self, auth_client):
+        data = {"title": "Paged thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            return response.json()["id"]
+
+        roots = [await comment(f"Thread {index}") for index in range(3)]
+        reply = await comment("Reply", roots[0])
+        await comment("Nested reply", reply)
+
+        params = {"max_depth": 1, "limit": 2}
+        with count_queries() as statements:
+            response = await auth_client.get(f"/post/{post_id}/comments", params=params)
+        assert response.status_code == 200, "Failed to get comments page"
+        assert len(statements) == 1, "A page should be a single query"
+
+        page = response.json()
+        assert [thread["id"] for thread in page] == roots[:2], "Page mismatch"
+        assert page[0]["children_count"] == 1, "Thread should count its reply"
+        (first_reply,) = page[0]["children"]
+        assert first_reply["children"] == [], "Replies below max_depth are cut"
+        assert first_reply["children_count"] == 1, "Cut reply should be counted"
+        assert first_reply["has_more"] is True, "Cut branch should be marked"
+
+        params["cursor"] = page[-1]["id"]
+        response = await auth_client.get(f"/post/{post_id}/comments", params=params)
+        assert [thread["id"] for thread in response.json()] == roots[2:]
+
+        response = await auth_client.get(f"/comments/{reply}/tree")
+        assert response.status_code == 200, "Failed to get replies tree"
+        assert [node["content"] for node in response.json()] == ["Nested reply"]
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_concurrent_replies_keep_tree_intact(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", "nested_set")
+        monkeypatch.setattr(settings, "COMMENT_TREE_GAP", 0)
+        data = {"title": "Busy thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            assert response.status_code == 201, "Failed to create comment"
+            return response.json()["id"]
+
+        parents = [await comment(f"Thread {index}") for index in range(5)]
+        await asyncio.gather(
+            *(comment(f"Reply {index}", parents[index % 5]) for index in range(200))
+        )
+
+        async with async_session_market() as session:
+            result = await session.execute(
+                select(Comment).where(Comment.post_id == post_id).order_by(Comment.lft)
+            )
+            comments = result.scalars().all()
+        assert len(comments) == 205, "Every reply should be saved"
+        bounds = [value for comment in comments for value in (comment.lft, comment.rgt)]
+        assert sorted(bounds) == list(range(1, 411)), "lft/rgt should not overlap"
+
+        open_comments = []
+        for comment in comments:
+            while open_comments and open_comments[-1].rgt < comment.lft:
+                open_comments.pop()
+            parent = open_comments[-1] if open_comments else None
+            assert comment.parent_id == (parent.id if parent else None)
+            assert comment.rgt < (parent.rgt if parent else 411)
+            open_comments.append(comment)
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    @pytest.mark.parametrize(
+        "storage", ["nested_set", "materialized_path", "closure_table"]
+    )
+    async def test_import_comments(self, auth_client, monkeypatch, storage):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", storage)
+        data = {"title": "Imported thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+        await auth_client.post(
+            f"/posts/{post_id}/comment", json={"content": "Existing"}
+        )
+
+        comments = [
+            {"id": "a", "content": "First"},
+            {"id": "b", "content": "Reply", "parent_id": "a"},
+            {"id": "c", "content": "Second"},
+            {"id": "d", "content": "Nested reply", "parent_id": "b"},
+            {"id": "e", "content": "Second reply", "parent_id": "a"},
+        ]
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            content="\n".join(json.dumps(comment) for comment in comments),
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert response.status_code == 201, "Failed to import comments"
+        assert response.json()["imported"] == 5, "Every comment should be imported"
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            json=[{"id": 1, "content": "Another"}],
+        )
+        assert response.status_code == 201, "Failed to import a JSON list"
+
+        def shape(nodes):
+            return [(node["content"], shape(node["children"])) for node in nodes]
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert shape(response.json()) == [
+            ("Existing", []),
+            ("First", [("Reply", [("Nested reply", [])]), ("Second reply", [])]),
+            ("Second", []),
+            ("Another", []),
+        ], "Imported tree shape mismatch"
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            json=[{"id": 1, "content": "Orphan", "parent_id": 2}],
+        )
+        assert response.status_code == 400, "Unknown parents should be rejected"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_imported_comments_are_moderated(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "HIDE_UNMODERATED", True)
+        queued = []
+        monkeypatch.setattr(
+            crud, "moderate_comment", SimpleNamespace(delay=queued.append)
+        )
+
+        async def toxicity_of(*texts):
+            return 0.9 if any("spam" in text for text in texts) else 0.1
+
+        monkeypatch.setattr(crud, "toxicity_of", toxicity_of)
+        data = {"title": "Moderated import", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            json=[
+                {"id": 1, "content": "Fine"},
+                {"id": 2, "content": "spam", "is_blocked": False},
+            ],
+        )
+        assert response.status_code == 201, "Failed to import comments"
+        spam = response.json()["ids"]["2"]
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert [node["content"] for node in response.json()] == [
+            "Fine"
+        ], "Toxic imported comments should be blocked"
+        response = await auth_client.get(f"/comments/{spam}")
+        assert response.status_code == 404, "Toxic imported comments should be hidden"
+        assert queued == [], "Scored comments should not be queued"
+
+        monkeypatch.setattr(settings, "MODERATION_MODE", "deferred")
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            json=[{"id": 1, "content": "More spam", "is_blocked": False}],
+        )
+        deferred = response.json()["ids"]["1"]
+        response = await auth_client.get(f"/comments/{deferred}")
+        assert response.status_code == 404, "Deferred imports should be pending"
+        assert queued == [deferred], "Deferred imports should be queued"
+
+        monkeypatch.setattr(settings, "HIDE_UNMODERATED", False)
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_imported_comments_are_scored_with_bounded_concurrency(
+        self, auth_client, monkeypatch
+    ):
+        monkeypatch.setattr(settings, "PERSPECTIVE_MAX_CONNECTIONS", 2)
+        in_flight = Counter()
+
+        async def toxicity_of(*texts):
+            in_flight["now"] += 1
+            in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+            await asyncio.sleep(0.01)
+            in_flight["now"] -= 1
+            return 0.1
+
+        monkeypatch.setattr(crud, "toxicity_of", toxicity_of)
+        data = {"title": "Bounded import", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            json=[{"id": index, "content": f"Row {index}"} for index in range(6)],
+        )
+        assert response.status_code == 201, "Failed to import comments"
+        assert in_flight["peak"] == 2, "Scoring should be bounded by the connections"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_export_comments(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", "nested_set")
+        data = {"title": "Exported thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            return response.json()["id"]
+
+        first = await comment("First")
+        reply = await comment("Reply", first)
+        await comment("Second")
+        await comment("Nested reply", reply)
+
+        response = await auth_client.get(f"/post/{post_id}/comments/export")
+        assert response.status_code == 200, "Failed to export comments"
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [
+            (line["content"], line["level"], line["parent_id"]) for line in lines
+        ] == [
+            ("First", 0, None),
+            ("Reply", 1, first),
+            ("Nested reply", 2, reply),
+            ("Second", 0, None),
+        ], "Comments should be exported in tree order"
+
+        response = await auth_client.post(
+            f"/posts/{post_id}/comments/import",
+            content=response.content,
+            headers={"Content-Type": "application/x-ndjson"},
+        )
+        assert response.json()["imported"] == 4, "Export should import again"
+
+        response = await auth_client.get("/post/0/comments/export")
+        assert response.status_code == 404, "Missing post should not be exported"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    @pytest.mark.parametrize(
+        "storage", ["nested_set", "materialized_path", "closure_table"]
+    )
+    async def test_export_leaves_out_hidden_comments(
+        self, auth_client, monkeypatch, storage
+    ):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", storage)
+        data = {"title": "Hidden export", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            return response.json()["id"]
+
+        shown = await comment("Shown")
+        blocked = await comment("Blocked")
+        await comment("Reply to blocked", blocked)
+        pending = await comment("Pending")
+        await comment("Reply", shown)
+        async with async_session_market() as db:
+            (await db.get(Comment, blocked)).is_blocked = True
+            (await db.get(Comment, pending)).pending_moderation = True
+            await db.commit()
+
+        monkeypatch.setattr(settings, "HIDE_UNMODERATED", True)
+        response = await auth_client.get(f"/post/{post_id}/comments/export")
+        assert response.status_code == 200, "Failed to export comments"
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["content"] for line in lines] == [
+            "Shown",
+            "Reply",
+        ], "Blocked and pending comments and their replies should not be exported"
+
+        async with async_session_market() as db:
+            (await db.get(Post, post_id)).pending_moderation = True
+            await db.commit()
+        response = await auth_client.get(f"/post/{post_id}/comments/export")
+        assert response.status_code == 404, "Hidden posts should not be exported"
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert response.status_code == 404, "Hidden posts should hide their threads"
+        response = await auth_client.get(f"/comments/{shown}/tree")
+        assert response.status_code == 404, "Hidden posts should hide their replies"
+
+        monkeypatch.setattr(settings, "HIDE_UNMODERATED", False)
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_delete_comments(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", "nested_set")
+        monkeypatch.setattr(settings, "COMMENT_TREE_GAP", 0)
+        data = {"title": "Moderated thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            return response.json()["id"]
+
+        first = await comment("First")
+        spam = await comment("Spam", first)
+        await comment("Spam reply", spam)
+        await comment("Reply", first)
+        second = await comment("Second")
+        await comment("More spam", second)
+        third = await comment("Third")
+        fourth = await comment("Fourth")
+
+        with count_queries() as statements:
+            response = await auth_client.post(
+                "/comments/bulk-delete", json={"ids": [spam, second, third, 0]}
+            )
+        assert response.status_code == 200, "Failed to delete comments"
+        assert sorted(response.json()["deleted"]) == [
+            spam,
+            second,
+            third,
+        ], "Only existing comments should be reported"
+        assert (
+            len([sql for sql in statements if sql.startswith("UPDATE comments")]) == 1
+        ), "The post should be renumbered in one statement"
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert [
+            (node["content"], node["lft"], node["rgt"]) for node in response.json()
+        ] == [("First", 1, 4), ("Fourth", 5, 6)], "Tree should be closed up"
+        assert [
+            (node["content"], node["lft"], node["rgt"])
+            for node in response.json()[0]["children"]
+        ] == [("Reply", 2, 3)], "Replies should be closed up"
+
+        with count_queries() as statements:
+            response = await auth_client.delete(f"/comments/{fourth}")
+        assert response.status_code == 204, "Failed to delete comment"
+        assert (
+            len([sql for sql in statements if sql.startswith("UPDATE comments")]) == 1
+        ), "Delete should renumber in one statement"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_comment_on_post_without_author(self, auth_client):
+        async with async_session_market() as db:
+            post = Post(title="Orphan", content="Orphan content", user_id=None)
+            db.add(post)
+            await db.flush()
+            post_id = post.id
+            await db.commit()
+
+        try:
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment", json={"content": "Anyone here?"}
+            )
+            assert response.status_code == 201, "Posts without author take comments"
+            async with async_session_market() as db:
+                owed = await db.scalars(
+                    select(AutoReplyOutbox).where(AutoReplyOutbox.post_id == post_id)
+                )
+                assert owed.all() == [], "Nobody should owe an auto-reply"
+        finally:
+            async with async_session_market() as db:
+                await db.delete(await db.get(Post, post_id))
+                await db.commit()
+
+    async def test_auto_reply_uses_post_author_settings(self, auth_client, monkeypatch):
+        def get_redis():
+            raise AssertionError("Creating a comment should not reach Redis")
+
+        monkeypatch.setattr(reply_queue, "get_redis", get_redis)
+
+        async with async_session_market() as db:
+            author = User(
+                email="replier@example.com",
+                hashed_password="x",
+                auto_reply_enabled=True,
+                auto_reply_delay=timedelta(seconds=30),
+            )
+            db.add(author)
+            await db.flush()
+            post = Post(title="Replies", content="Replies", user_id=author.id)
+            db.add(post)
+            await db.flush()
+            author_id, post_id = author.id, post.id
+            await db.commit()
+
+        try:
+            with count_queries() as statements:
+                response = await auth_client.post(
+                    f"/posts/{post_id}/comment", json={"content": "Any news?"}
+                )
+            assert response.status_code == 201, "Failed to create comment"
+            comment_id = response.json()["id"]
+            reads = [
+                sql
+                for sql in statements
+                if sql.startswith("SELECT") and ("posts" in sql or "FROM user" in sql)
+            ]
+            # The current user, then the post together with its author.
+            assert len(reads) == 2, "The post and its author should be one query"
+
+            async with async_session_market() as db:
+                owed = (await db.scalars(select(AutoReplyOutbox))).all()
+            assert [(row.parent_id, row.author_id) for row in owed] == [
+                (comment_id, author_id)
+            ], "The reply should be owed by the post author"
+            delay = reply_queue.timestamp(owed[0].due_at) - time.time()
+            assert 25 < delay <= 30, "The reply should wait the author's delay"
+        finally:
+            async with async_session_market() as db:
+                await db.execute(
+                    delete(AutoReplyOutbox).where(AutoReplyOutbox.post_id == post_id)
+                )
+                await db.delete(await db.get(Post, post_id))
+                await db.flush()
+                await db.execute(delete(User).where(User.id == author_id))
+                await db.commit()
+
+    async def test_deferred_moderation(self, auth_client, monkeypatch):
+        monkeypatch.setattr(settings, "MODERATION_MODE", "deferred")
+        monkeypatch.setattr(settings, "HIDE_UNMODERATED", True)
+        queued = []
+        monkeypatch.setattr(crud, "moderate_post", SimpleNamespace(delay=queued.append))
+        monkeypatch.setattr(
+            crud, "moderate_comment", SimpleNamespace(delay=queued.append)
+        )
+        monkeypatch.setattr(celery_app, "SessionLocal", async_session_market)
+
+        async def score_texts(*texts):
+            return 0.9 if any("spam" in text for text in texts) else 0.1, True
+
+        monkeypatch.setattr(celery_app, "score_texts", score_texts)
+
+        data = {"title": "Deferred", "content": "Deferred content"}
+        response = await auth_client.post("/posts", json=data)
+        assert response.status_code == 201, "Failed to create post"
+        assert response.json()["pending_moderation"] is True
+        post_id = response.json()["id"]
+        assert queued == [post_id], "The post should be queued for moderation"
+        response = await auth_client.get(f"/post/{post_id}")
+        assert response.status_code == 404, "Pending posts should be hidden"
+
+        await celery_app.moderate_post_async(post_id)
+        response = await auth_client.get(f"/post/{post_id}")
+        assert response.status_code == 200, "Moderated posts should be shown"
+        assert response.json()["pending_moderation"] is False
+
+        ids = {}
+        for content, parent in [
+            ("Fine", None),
+            ("spam", None),
+            ("Reply to spam", "spam"),
+            ("Reply", "Fine"),
+        ]:
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": ids.get(parent)},
+            )
+            assert response.status_code == 201, "Failed to create comment"
+            assert response.json()["pending_moderation"] is True
+            assert response.json()["is_blocked"] is False
+            ids[content] = response.json()["id"]
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert response.json() == [], "Pending comments should be hidden"
+
+        for comment_id in ids.values():
+            await celery_app.moderate_comment_async(comment_id)
+        assert queued[1:] == list(ids.values()), "Comments should be queued"
+
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert [
+            (node["content"], [child["content"] for child in node["children"]])
+            for node in response.json()
+        ] == [("Fine", ["Reply"])], "Blocked comments and their replies are hidden"
+        response = await auth_client.get(f"/comments/{ids['spam']}")
+        assert response.status_code == 404, "Blocked comments should be hidden"
+
+        response = await auth_client.patch(
+            f"/comments/{ids['Fine']}", json={"content": "Edited"}
+        )
+        assert response.json()["pending_moderation"] is True
+        assert queued[-1] == ids["Fine"], "Edits should be queued"
+
+        async def fallback_score_texts(*texts):
+            return 0.1, False
+
+        monkeypatch.setattr(celery_app, "score_texts", fallback_score_texts)
+        with pytest.raises(celery_app.FallbackScore):
+            await celery_app.moderate_comment_async(ids["Fine"], final=False)
+        response = await auth_client.get(f"/comments/{ids['Fine']}")
+        assert response.status_code == 404, "Fallback scores should be retried"
+        await celery_app.moderate_comment_async(ids["Fine"], final=True)
+        response = await auth_client.get(f"/comments/{ids['Fine']}")
+        assert response.status_code == 200, "The last try should settle the row"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    async def test_rescan_comments(self, auth_client, monkeypatch):
+        class ListBackend(ToxicityBackend):
+            name = "list"
+            scored = []
+            fail_on = None
+
+            async def score(self, text):
+                if text == self.fail_on:
+                    raise ConnectionError("down")
+                self.scored.append(text)
+                return 0.7 if "spam" in text else 0.2
+
+        backend = ListBackend()
+        monkeypatch.setitem(TOXICITY_BACKENDS, "list", backend)
+        monkeypatch.setattr(settings, "TOXICITY_BACKEND", "list")
+
+        data = {"title": "Rescanned", "content": "Rescanned content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+        ids = []
+        for content in ["One", "spam", "Three", "Four spam", "Five"]:
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment", json={"content": content}
+            )
+            ids.append(response.json()["id"])
+
+        async with async_session_market() as session:
+            # Only this test's comments, which are the newest.
+            session.add(ModerationCheckpoint(table_name="comments", last_id=ids[0] - 1))
+            await session.commit()
+
+            backend.fail_on = "Four spam"
+            with pytest.raises(ConnectionError):
+                await rescan_table(session, "comments", batch_size=2)
+            await session.rollback()
+            last_id = await session.scalar(select(ModerationCheckpoint.last_id))
+            assert last_id == ids[1], "Whole batches should be recorded"
+
+            backend.fail_on = None
+            backend.scored.clear()
+            assert await rescan_table(session, "comments", batch_size=2) == 3
+            assert backend.scored == ["Three", "Four spam", "Five"], "Should resume"
+            assert await session.get(ModerationCheckpoint, "comments") is None
+
+            result = await session.execute(
+                select(Comment.toxicity_score, Comment.is_blocked)
+                .where(Comment.id.in_(ids[2:]))
+                .order_by(Comment.id)
+            )
+            assert result.all() == [(0.2, False), (0.7, True), (0.2, False)]
+
+            monkeypatch.setattr(settings, "TOXICITY_THRESHOLD", 0.8)
+            await apply_threshold(session)
+            blocked = await session.scalar(
+                select(Comment.is_blocked).where(Comment.id == ids[3])
+            )
+            assert blocked is False, "A new threshold should apply without rescoring"
+            monkeypatch.setattr(settings, "TOXICITY_THRESHOLD", 0.5)
+            await apply_threshold(session)
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
+
+    @pytest.mark.parametrize(
+        "storage, gap",
+        [("nested_set", 0), ("nested_set", 2), ("materialized_path", 0)],
+    )
+    async def test_batched_replies(self, auth_client, monkeypatch, storage, gap):
+        monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", storage)
+        monkeypatch.setattr(settings, "COMMENT_TREE_GAP", gap)
+        monkeypatch.setattr(reply_queue, "SessionLocal", async_session_market)
+        monkeypatch.setattr(settings, "REPLY_BATCH_SIZE", 3)
+
+        class FakeRedis:
+            def __init__(self):
+                self.due = {}
+
+            async def zadd(self, key, mapping):
+                self.due.update(mapping)
+
+            async def zrangebyscore(self, key, low, high, start, num):
+                members = sorted(self.due, key=self.due.get)
+                return [m for m in members if self.due[m] <= high][start:num]
+
+            def pipeline(self, transaction):
+                queue = self
+
+                class Pipeline:
+                    removed = []
+
+                    async def __aenter__(self):
+                        return self
+
+                    async def __aexit__(self, *args):
+                        pass
+
+                    def zrem(self, key, member):
+                        self.removed.append(queue.due.pop(member, None) is not None)
+
+                    async def execute(self):
+                        return self.removed
+
+                return Pipeline()
+
+        monkeypatch.setattr(reply_queue, "client", FakeRedis())
+
+        data = {"title": "Busy thread", "content": "Thread content"}
+        response = await auth_client.post("/posts", json=data)
+        post_id = response.json()["id"]
+
+        async def comment(content, parent_id=None):
+            response = await auth_client.post(
+                f"/posts/{post_id}/comment",
+                json={"content": content, "parent_id": parent_id},
+            )
+            return response.json()["id"]
+
+        first = await comment("First")
+        reply = await comment("Reply", first)
+        second = await comment("Second")
+        gone = await comment("Gone")
+
+        async with async_session_market() as db:
+            for parent_id, delay in [
+                (first, 0),
+                (reply, 0),
+                (first, 0),
+                (second, 0),
+                (gone, 0),
+                (second, 60),
+            ]:
+                reply_queue.schedule_reply(
+                    db, await db.get(Comment, parent_id), 1, delay
+                )
+            await db.commit()
+
+        assert await reply_queue.relay_outbox() == 6, "Owed replies should be relayed"
+        assert await reply_queue.relay_outbox() == 0, "Relayed replies should wait"
+        monkeypatch.setattr(settings, "REPLY_OUTBOX_REDELIVERY", 0)
+        response = await auth_client.patch(
+            f"/comments/{second}", json={"content": "Edited"}
+        )
+        assert response.status_code == 200, "Failed to edit comment"
+        assert await reply_queue.relay_outbox() == 5, "Due unwritten replies are resent"
+        assert len(reply_queue.client.due) == 6, "Resent replies should be queued once"
+        delivered = dict(reply_queue.client.due)
+
+        response = await auth_client.delete(f"/comments/{gone}")
+        assert response.status_code == 204, "Failed to delete comment"
+
+        with count_queries() as statements:
+            await reply_queue.flush_due_replies()
+        locks = [sql for sql in statements if sql.startswith("UPDATE posts")]
+        assert len(locks) == 2, "Each batch should lock the post once"
+        if storage == "nested_set" and gap == 0:
+            shifts = [sql for sql in statements if sql.startswith("UPDATE comments")]
+            assert len(shifts) == 2, "Each batch should shift the tree once"
+
+        def shape(nodes):
+            return [(node["content"], shape(node["children"])) for node in nodes]
+
+        answer = generate_response("Question?", "author@example.com")
+        expected = [
+            (
+                "First",
+                [("Reply", [(answer, [])]), (answer, []), (answer, [])],
+            ),
+            ("Edited", [(answer, [])]),
+        ]
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert (
+            shape(response.json()) == expected
+        ), "Due replies should be written under their parents"
+        assert len(reply_queue.client.due) == 1, "Replies not due should wait"
+
+        reply_queue.client.due.update(delivered)
+        await reply_queue.flush_due_replies()
+        response = await auth_client.get(f"/post/{post_id}/comments")
+        assert (
+            shape(response.json()) == expected
+        ), "Replies delivered twice should be written once"
+
+        response = await auth_client.delete(f"/post/{post_id}")
+        assert response.status_code == 204, "Failed to delete post"
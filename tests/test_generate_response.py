@@ -0,0 +1,86 @@
+from config import settings
+from src.services.generate_response import (
+    KeywordMatcher,
+    ReplyRule,
+    ReplyRules,
+    generate_response,
+    get_reply_rules,
+)
+
+
+def test_default_replies():
+    assert (
+        generate_response(
+            "What do you think, Author@example.com?", "author@example.com"
+        )
+        == "I saw your question and will get back to you as soon as I can."
+    )
+    assert (
+        generate_response("What do you think?", "author@example.com")
+        == "Thank you for your comment!"
+    )
+    assert (
+        generate_response("Nice one, author@example.com", "author@example.com")
+        == "Thank you for your comment!"
+    )
+    # The author name is matched literally, not as a pattern.
+    assert (
+        generate_response("Why, authorXexample.com?", "author.example.com")
+        == "Thank you for your comment!"
+    )
+
+
+def test_keyword_matcher_finds_whole_words():
+    matcher = KeywordMatcher(["he", "she", "his", "hers", "how", "new york"])
+    assert matcher.find("Ushers, SHE said his show in New  York, new York") == {
+        "she",
+        "his",
+        "new york",
+    }
+    assert matcher.find("") == set()
+
+
+def test_keyword_matcher_finds_overlapping_keywords():
+    matcher = KeywordMatcher(["thanks", "thanks a lot", "a lot", "how", "how to"])
+    assert matcher.find("Thanks a lot!") == {"thanks", "thanks a lot", "a lot"}
+    assert matcher.find("How to start?") == {"how", "how to"}
+    assert matcher.find("Somehow toast") == set()
+
+
+def test_keyword_matcher_finds_non_word_edges():
+    matcher = KeywordMatcher(["+1", "c++", "me too"])
+    assert matcher.find("+1, I use C++ too") == {"+1", "c++"}
+    assert matcher.find("me too+1") == {"me too", "+1"}
+    assert matcher.find("me tool") == set()
+
+
+def test_custom_keywords_keep_question_words():
+    rules = ReplyRules(
+        [
+            ReplyRule(keywords=["how to"], question=False, template="Guide."),
+            ReplyRule(question=True, template="Question."),
+        ]
+    )
+    assert rules.respond("how to install it", "ann") == "Question."
+
+
+def test_rules_from_file(tmp_path, monkeypatch):
+    rules_file = tmp_path / "rules.json"
+    rules_file.write_text(
+        '[{"keywords": ["bug", "crash"], "template": "Thanks, {author_name} will look."},'
+        ' {"template": "Noted."}]'
+    )
+    monkeypatch.setattr(settings, "AUTO_REPLY_RULES_FILE", str(rules_file))
+    get_reply_rules.cache_clear()
+    try:
+        assert (
+            generate_response("It crashes, a crash!", "ann") == "Thanks, ann will look."
+        )
+        assert generate_response("Debugging is fun", "ann") == "Noted."
+    finally:
+        get_reply_rules.cache_clear()
+
+
+def test_unmatched_rules_fall_back_to_thanks():
+    rules = ReplyRules([ReplyRule(question=False, template="Statement.")])
+    assert rules.respond("Why?", "ann") is None
@@ -1,4 +1,12 @@
-post_fields = ["title", "content", "id", "created_at", "user_id", "is_blocked"]
+post_fields = [
+    "title",
+    "content",
+    "id",
+    "created_at",
+    "user_id",
+    "is_blocked",
+    "pending_moderation",
+]
 
 
 class TestAsyncClient:
@@ -47,6 +55,15 @@ class TestAsyncClient:
         for key in data:
             assert response.json()[key] == data[key]
 
+    async def test_update_post_scores_texts_together(
+        self, auth_client, fake_perspective
+    ):
+        data = {"title": "Rescored Post", "content": "Rescored content"}
+        response = await auth_client.patch("/post/1", json=data)
+        assert response.status_code == 200
+        assert sorted(fake_perspective.texts) == sorted(data.values())
+        assert fake_perspective.max_in_flight == 2, "Title and content in parallel"
+
     async def test_delete_post(self, auth_client):
         response = await auth_client.delete("/post/1")
         assert response.status_code == 204
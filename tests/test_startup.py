@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+IMPORT_BUDGET = 5.0  # seconds
+
+# Fails any network connection, then times importing the app.
+IMPORT_APP = """
+import socket, time
+
+def connect(*args, **kwargs):
+    raise OSError("network used at import time")
+
+socket.socket.connect = socket.socket.connect_ex = connect
+socket.create_connection = connect
+
+started = time.perf_counter()
+import src.main
+print(time.perf_counter() - started)
+"""
+
+
+def test_import_app_is_fast_and_offline():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_APP],
+        cwd=os.path.dirname(os.path.dirname(__file__)),
+        capture_output=True,
+        text=True,
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+
+    # -X importtime lines: "import time: self [us] | cumulative | package"
+    imports = [
+        line.split("|")
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:") and "cumulative" not in line
+    ]
+    slowest = sorted(imports, key=lambda line: -int(line[1]))[:10]
+    elapsed = float(result.stdout.splitlines()[-1])
+    assert elapsed < IMPORT_BUDGET, "Slowest imports:\n" + "\n".join(
+        f"{int(cumulative) / 1e6:.2f}s {name.strip()}"
+        for _, cumulative, name in slowest
+    )
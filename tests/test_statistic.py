@@ -1,6 +1,13 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 
-from src.post.comment.models import Comment
+import pytest
+from sqlalchemy import select
+
+from config import settings
+from src.post.comment.daily_stats import refresh_comment_daily_stats
+from src.post.comment.models import Comment, CommentDailyStats
+from src.services import celery_app, metrics
+from src.services.breakdown_cache import cache as breakdown_cache
 from tests.conftest import async_session_market
 
 
@@ -59,3 +66,113 @@ async def test_comments_daily_breakdown(auth_client, created_post):
         assert (
             stat["blocked_comments"] == 2
         ), f"Blocked comments for {stat['date']} should be 2 (as every second comment is blocked)"
+
+
+@pytest.mark.parametrize(
+    "storage", ["nested_set", "materialized_path", "closure_table"]
+)
+async def test_daily_stats_follow_comments(auth_client, monkeypatch, storage):
+    monkeypatch.setattr(settings, "COMMENT_TREE_STORAGE", storage)
+    monkeypatch.setattr(celery_app, "SessionLocal", async_session_market)
+
+    async def score_texts(*texts):
+        return 0.9, True
+
+    monkeypatch.setattr(celery_app, "score_texts", score_texts)
+    today, past = datetime.now(timezone.utc).date(), date(2001, 2, 3)
+
+    async def rollup():
+        async with async_session_market() as db:
+            stats = {
+                stat.day: (stat.total_comments, stat.blocked_comments)
+                for stat in await db.scalars(select(CommentDailyStats))
+            }
+        return {day: stats.get(day, (0, 0)) for day in (today, past)}
+
+    before = await rollup()
+    data = {"title": "Counted", "content": "Counted content"}
+    response = await auth_client.post("/posts", json=data)
+    post_id = response.json()["id"]
+
+    async def comment(content, parent_id=None):
+        response = await auth_client.post(
+            f"/posts/{post_id}/comment",
+            json={"content": content, "parent_id": parent_id},
+        )
+        return response.json()["id"]
+
+    first = await comment("First")
+    reply = await comment("Reply", first)
+    await comment("Second")
+    await celery_app.moderate_comment_async(reply)
+    response = await auth_client.post(
+        f"/posts/{post_id}/comments/import",
+        json=[
+            {"id": index, "content": "Old", "created_at": f"{past}T12:00:00Z"}
+            for index in range(3)
+        ],
+    )
+    assert response.status_code == 201, "Failed to import comments"
+
+    after = await rollup()
+    assert after[today] == (before[today][0] + 3, before[today][1] + 1)
+    assert after[past] == (before[past][0] + 3, before[past][1])
+
+    response = await auth_client.delete(f"/comments/{first}")
+    assert response.status_code == 204, "Failed to delete comment"
+    after = await rollup()
+    assert after[today] == (before[today][0] + 1, before[today][1])
+
+    async with async_session_market() as db:
+        await refresh_comment_daily_stats(db)
+        await db.commit()
+    assert await rollup() == after, "A rebuild should find the same counts"
+
+    response = await auth_client.delete(f"/post/{post_id}")
+    assert response.status_code == 204, "Failed to delete post"
+    assert await rollup() == before, "Deleted posts should take their comments off"
+
+
+async def test_daily_breakdown_cache(auth_client):
+    today, past = datetime.now(timezone.utc).date(), date(2001, 2, 4)
+    response = await auth_client.post(
+        "/posts", json={"title": "Cached", "content": "Cached content"}
+    )
+    post_id = response.json()["id"]
+
+    async def breakdown(date_from, date_to):
+        response = await auth_client.get(
+            "/comments-daily-breakdown",
+            params={"date_from": str(date_from), "date_to": str(date_to)},
+        )
+        return {stat["date"]: stat["total_comments"] for stat in response.json()}
+
+    before = await breakdown(past, past)
+    response = await auth_client.post(
+        f"/posts/{post_id}/comments/import",
+        json=[
+            {"id": index, "content": "Old", "created_at": f"{past}T12:00:00Z"}
+            for index in range(2)
+        ],
+    )
+    old = response.json()["ids"]["0"]
+    counted = (await breakdown(past, past))[str(past)]
+
+    hits = metrics.counters["daily_breakdown_cache_memory_hits_total"]
+    assert await breakdown(past, past) == {str(past): counted}
+    assert metrics.counters["daily_breakdown_cache_memory_hits_total"] == hits + 1
+    assert breakdown_cache.memory[past] == (counted, 0)
+
+    response = await auth_client.delete(f"/comments/{old}")
+    assert response.status_code == 204, "Failed to delete comment"
+    assert past not in breakdown_cache.memory, "Deletes should invalidate the day"
+    assert await breakdown(past, past) == {str(past): counted - 1}
+
+    first = (await breakdown(past, today)).get(str(today), 0)
+    await auth_client.post(f"/posts/{post_id}/comment", json={"content": "New"})
+    assert today not in breakdown_cache.memory, "Today should never be cached"
+    assert (await breakdown(past, today))[str(today)] == first + 1
+
+    response = await auth_client.delete(f"/post/{post_id}")
+    assert response.status_code == 204, "Failed to delete post"
+    assert await breakdown(past, past) == before
@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import urllib.request
+from collections import Counter
+from http.server import ThreadingHTTPServer
+from types import SimpleNamespace
+
+from celery.utils.time import get_exponential_backoff_interval
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from config import settings
+from src.services import celery_app, metrics
+from src.services.worker import MetricsHandler, TaskTimer, WorkerLoop
+
+
+def test_tasks_share_one_event_loop():
+    worker_loop = WorkerLoop()
+
+    async def running_loop():
+        return asyncio.get_running_loop()
+
+    try:
+        loop = worker_loop.run(running_loop())
+        assert worker_loop.run(running_loop()) is loop, "The loop should be reused"
+        assert loop.is_running(), "The loop should outlive its tasks"
+    finally:
+        worker_loop.stop()
+
+
+def test_tasks_are_routed_by_kind():
+    router = celery_app.celery.amqp.router
+    for name, queue in [
+        ("flush_due_replies", celery_app.REPLY_QUEUE),
+        ("relay_reply_outbox", celery_app.REPLY_QUEUE),
+        ("moderate_comment", celery_app.MODERATION_QUEUE),
+        ("remoderate", celery_app.MODERATION_QUEUE),
+    ]:
+        route = router.route({}, f"src.services.celery_app.{name}")
+        assert route["queue"].name == queue, f"{name} should go to {queue}"
+    assert celery_app.moderate_comment.ignore_result, "Results should not be stored"
+
+
+def test_moderation_retry_delays():
+    options = celery_app.MODERATION_RETRY
+    delays = [
+        get_exponential_backoff_interval(
+            factor=options["retry_backoff"],
+            retries=retries,
+            maximum=600,
+            full_jitter=options.get("retry_jitter", True),
+        )
+        for retries in range(options["max_retries"])
+    ]
+    assert delays == [30, 60, 120, 240, 480], "Retries should wait as documented"
+
+
+def test_worker_process_set_up_for_any_pool(monkeypatch):
+    calls = []
+    monkeypatch.setattr(celery_app, "serve_metrics", lambda: None)
+    monkeypatch.setattr(celery_app, "setup_worker_process", lambda: calls.append(1))
+    for pool, set_up in [("prefork", False), ("solo", True), ("threads", True)]:
+        calls.clear()
+        celery_app.init_worker(sender=SimpleNamespace(pool_cls=pool))
+        assert bool(calls) == set_up, f"The {pool} worker process set-up is wrong"
+
+
+async def test_task_metrics(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "counters", Counter())
+    timer = TaskTimer()
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'worker.db'}")
+    timer.time_queries(engine)
+    task = SimpleNamespace(
+        name="moderate_post", request=SimpleNamespace(published_at=time.time() - 2)
+    )
+
+    timer.start(task)
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    timer.finish(task)
+    await engine.dispose()
+
+    dumped = metrics.load(str(tmp_path))
+    labels = '{task="moderate_post"}'
+    assert dumped[f"celery_task_queue_wait_seconds_sum{labels}"] >= 2
+    assert dumped[f"celery_task_run_seconds_count{labels}"] == 1
+    assert (
+        0
+        < dumped[f"celery_task_db_seconds_sum{labels}"]
+        <= dumped[f"celery_task_run_seconds_sum{labels}"]
+    ), "Database time should be part of the run time"
+
+
+def test_overlapping_tasks_are_timed_apart(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(metrics, "counters", Counter())
+    timer = TaskTimer()
+    worker_loop = WorkerLoop()
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'worker.db'}")
+    timer.time_queries(engine)
+    slow_query = text(
+        "WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n"
+        " WHERE x < 300000) SELECT count(*) FROM n"
+    )
+    started = threading.Barrier(2)
+    fast_queried, slow_queried = threading.Event(), threading.Event()
+
+    async def execute(query):
+        async with engine.connect() as conn:
+            await conn.execute(query)
+
+    # Both tasks start, then each runs its statement while the other is running.
+    def fast_task():
+        task = SimpleNamespace(name="fast", request=SimpleNamespace())
+        timer.start(task)
+        started.wait()
+        worker_loop.run(execute(text("SELECT 1")))
+        fast_queried.set()
+        slow_queried.wait()
+        timer.finish(task)
+
+    def slow_task():
+        task = SimpleNamespace(name="slow", request=SimpleNamespace())
+        timer.start(task)
+        started.wait()
+        fast_queried.wait()
+        worker_loop.run(execute(slow_query))
+        slow_queried.set()
+        timer.finish(task)
+
+    threads = [threading.Thread(target=fast_task), threading.Thread(target=slow_task)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        worker_loop.run(engine.dispose())
+        worker_loop.stop()
+
+    dumped = metrics.load(str(tmp_path))
+    for name in ["fast", "slow"]:
+        assert dumped[f'celery_task_run_seconds_count{{task="{name}"}}'] == 1
+    slow_db = dumped['celery_task_db_seconds_sum{task="slow"}']
+    fast_db = dumped['celery_task_db_seconds_sum{task="fast"}']
+    assert 0 < fast_db < slow_db, "Each task should count only its own statements"
+    assert (
+        slow_db <= dumped['celery_task_run_seconds_sum{task="slow"}']
+    ), "Database time should be part of the run time"
+
+
+def test_worker_metrics_are_summed(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "WORKER_METRICS_DIR", str(tmp_path))
+    for pid, counters in [(1, {"tasks_total": 2}), (2, {"tasks_total": 3})]:
+        monkeypatch.setattr(metrics, "counters", Counter(counters))
+        metrics.dump(str(tmp_path / f"{pid}.json"))
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.read().decode() == "tasks_total 5\n"
+    finally:
+        server.shutdown()